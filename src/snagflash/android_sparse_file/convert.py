@@ -0,0 +1,296 @@
+# This file is part of Snagboot
+# Copyright (C) 2026 Bootlin
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Raw to Android sparse image conversion, equivalent to AOSP's img2simg.
+
+The raw image is read in batches of blocks. Each block is classified as FILL
+if it is made of a single repeated 32-bit word, and as RAW otherwise. Block
+ranges which are not mapped in an optional bmap file are emitted as DONTCARE
+chunks without being read at all.
+"""
+
+import os
+import logging
+
+from snagflash.android_sparse_file.sparse import (
+	AndroidSparseFile,
+	AndroidSparseHeader,
+	AndroidChunkHeader,
+	DEFAULT_BLOCK_SIZE,
+	SPARSE_CHUNKHEADER_LEN,
+	CHUNK_TYPE_DONTCARE,
+	CHUNK_TYPE_RAW,
+	CHUNK_TYPE_FILL,
+)
+from snagflash.bmaptools.BmapCopy import Bmap
+
+logger = logging.getLogger("snagflash")
+
+# Number of blocks read from the raw image at once
+READ_BATCH_BLOCKS = 256
+
+# Upper bound for the payload of a single RAW chunk, this keeps memory usage
+# constant when streaming large images.
+RAW_CHUNK_MAX_BLOCKS = 256
+
+
+def get_block_map(src_file, raw_size: int, block_size: int, bmap_path: str = None):
+	"""
+	Return a (block_size, mapped_ranges) tuple for the raw image src_file.
+	mapped_ranges is a list of (first, last) block ranges. If bmap_path is
+	None, the whole image is considered to be mapped. Otherwise, the block
+	size and ranges are read from the bmap file.
+	"""
+	if bmap_path is None:
+		raw_blocks = (raw_size + block_size - 1) // block_size
+		return (block_size, [(0, raw_blocks - 1)] if raw_blocks else [])
+
+	with open(bmap_path, "rb") as bmap_file:
+		bmap = Bmap(src_file, bmap_file)
+		ranges = [(first, last) for first, last, _ in bmap._get_block_ranges()]
+
+	if bmap.image_size != raw_size:
+		raise ValueError(
+			f"bmap file {bmap_path} describes a {bmap.image_size} bytes image, {src_file.name} is {raw_size} bytes"
+		)
+
+	return (bmap.block_size, ranges)
+
+
+def is_fill(buf: bytes, start: int, end: int) -> bool:
+	"""
+	Return True if buf[start:end] is a single 4-byte word repeated, which is
+	the case exactly when it is equal to itself shifted by one word.
+	"""
+	return buf[start + 4 : end] == buf[start : end - 4]
+
+
+def classify_range(src_file, first: int, last: int, block_size: int):
+	"""
+	Read blocks first to last (included) of src_file and yield
+	(chunk_type, num_blocks, payload) tuples describing them.
+
+	FILL payloads are the 4-byte fill pattern. RAW payloads are at most
+	RAW_CHUNK_MAX_BLOCKS blocks long. Consecutive FILL blocks with the same
+	pattern are merged into a single chunk.
+	"""
+	# current run: chunk type, block count, fill pattern or list of RAW buffers
+	run_type = None
+	run_blocks = 0
+	run_data = None
+
+	def flush_run():
+		if run_type == CHUNK_TYPE_FILL:
+			return (CHUNK_TYPE_FILL, run_blocks, run_data)
+		return (CHUNK_TYPE_RAW, run_blocks, b"".join(run_data))
+
+	src_file.seek(first * block_size)
+	block = first
+	while block <= last:
+		batch_blocks = min(READ_BATCH_BLOCKS, last - block + 1)
+		batch_len = batch_blocks * block_size
+		buf = src_file.read(batch_len)
+		if len(buf) < batch_len:
+			# last block of the image is padded with zeroes
+			buf += b"\x00" * (batch_len - len(buf))
+
+		# Fast path: the whole batch extends the current FILL run
+		if (
+			run_type == CHUNK_TYPE_FILL
+			and buf[:4] == run_data
+			and is_fill(buf, 0, batch_len)
+		):
+			run_blocks += batch_blocks
+			block += batch_blocks
+			continue
+
+		view = memoryview(buf)
+		for offset in range(0, batch_len, block_size):
+			if is_fill(buf, offset, offset + block_size):
+				pattern = buf[offset : offset + 4]
+				if run_type == CHUNK_TYPE_FILL and run_data == pattern:
+					run_blocks += 1
+					continue
+				if run_type is not None:
+					yield flush_run()
+				run_type, run_blocks, run_data = CHUNK_TYPE_FILL, 1, pattern
+			else:
+				blk = view[offset : offset + block_size]
+				if run_type == CHUNK_TYPE_RAW and run_blocks < RAW_CHUNK_MAX_BLOCKS:
+					run_blocks += 1
+					run_data.append(blk)
+					continue
+				if run_type is not None:
+					yield flush_run()
+				run_type, run_blocks, run_data = CHUNK_TYPE_RAW, 1, [blk]
+
+		block += batch_blocks
+
+	if run_type is not None:
+		yield flush_run()
+
+
+def raw_chunks(src_file, raw_size: int, block_size: int, mapped_ranges=None):
+	"""
+	Generator yielding (chunk_type, num_blocks, payload) tuples describing
+	the raw image src_file as a sparse image. Unmapped ranges are described
+	by DONTCARE chunks with a None payload.
+	"""
+	raw_blocks = (raw_size + block_size - 1) // block_size
+	if mapped_ranges is None:
+		mapped_ranges = [(0, raw_blocks - 1)] if raw_blocks else []
+
+	block = 0
+	for first, last in mapped_ranges:
+		if first > block:
+			yield (CHUNK_TYPE_DONTCARE, first - block, None)
+
+		yield from classify_range(src_file, first, last, block_size)
+		block = last + 1
+
+	if block < raw_blocks:
+		yield (CHUNK_TYPE_DONTCARE, raw_blocks - block, None)
+
+
+def img2simg(
+	src: str, dest: str, block_size: int = DEFAULT_BLOCK_SIZE, bmap: str = None
+):
+	"""
+	Convert the raw image src into the Android sparse image dest.
+
+	Args:
+		src: Path to the raw input image
+		dest: Path to the sparse output image
+		block_size: Sparse image block size, must be a multiple of 4. It is
+		overridden by the bmap block size if a bmap file is given.
+		bmap: Optional path to a bmap file describing the mapped ranges of src
+
+	Returns:
+		The number of chunks written to dest
+	"""
+	raw_size = os.path.getsize(src)
+
+	with open(src, "rb") as src_file:
+		block_size, ranges = get_block_map(src_file, raw_size, block_size, bmap)
+		if block_size % 4:
+			raise ValueError(
+				f"Invalid block size {block_size}. Should be multiple of 4"
+			)
+
+		outf = AndroidSparseFile(False)
+		outf.open(dest, block_size)
+		try:
+			for chunk_type, blocks, payload in raw_chunks(
+				src_file, raw_size, block_size, ranges
+			):
+				outf.write_chunk(chunk_type, payload if payload else [], blocks)
+		finally:
+			outf.close()
+
+	logger.debug(
+		f"Converted {src} to sparse image {dest}: {outf.file_header.blocks} blocks, {outf.file_header.chunks} chunks"
+	)
+
+	return outf.file_header.chunks
+
+
+class RawSparseStream:
+	"""
+	Read-only file-like object presenting a raw image as an Android sparse
+	image, converting it on the fly. This can be given to split_streaming()
+	in place of a sparse file path, so that raw images can be flashed with
+	flash_sparse without a separate conversion step.
+
+	Since the chunk count is only known once the whole image has been read,
+	the chunk count of the streamed file header is left at 0. Consumers
+	should iterate on chunks until EOF, like split_streaming() does.
+	"""
+
+	def __init__(
+		self, path: str, block_size: int = DEFAULT_BLOCK_SIZE, bmap: str = None
+	):
+		self.name = path
+		self.src_file = open(path, "rb")
+		raw_size = os.path.getsize(path)
+
+		try:
+			block_size, ranges = get_block_map(
+				self.src_file, raw_size, block_size, bmap
+			)
+		except Exception:
+			self.src_file.close()
+			raise
+		raw_blocks = (raw_size + block_size - 1) // block_size
+
+		header = AndroidSparseHeader(block_size=block_size, blocks=raw_blocks)
+		header_buf = bytearray()
+		AndroidSparseHeader.write(header, header_buf)
+
+		self.pieces = self._generate(
+			bytes(header_buf), raw_chunks(self.src_file, raw_size, block_size, ranges)
+		)
+		self.buf = bytearray()
+		# offset of the first unread byte in buf
+		self.buf_off = 0
+
+	@staticmethod
+	def _generate(header_buf, chunks):
+		yield header_buf
+		for chunk_type, blocks, payload in chunks:
+			payload_len = len(payload) if payload else 0
+			chunk_header = AndroidChunkHeader(
+				type=chunk_type,
+				size=blocks,
+				total_size=SPARSE_CHUNKHEADER_LEN + payload_len,
+			)
+			header_buf = bytearray()
+			AndroidChunkHeader.write(chunk_header, header_buf)
+			yield bytes(header_buf)
+			if payload_len:
+				yield payload
+
+	def read(self, size: int = -1) -> bytes:
+		if size is None or size < 0:
+			data = bytes(self.buf[self.buf_off :]) + b"".join(self.pieces)
+			self.buf.clear()
+			self.buf_off = 0
+			return data
+
+		if self.buf_off:
+			# drop the bytes read previously, once per read
+			del self.buf[: self.buf_off]
+			self.buf_off = 0
+
+		while len(self.buf) < size:
+			piece = next(self.pieces, None)
+			if piece is None:
+				break
+			self.buf += piece
+
+		data = bytes(self.buf[:size])
+		self.buf_off = len(data)
+		return data
+
+	def close(self):
+		self.src_file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
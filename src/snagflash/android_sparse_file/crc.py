@@ -0,0 +1,130 @@
+# This file is part of Snagboot
+# Copyright (C) 2026 Bootlin
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+CRC32 of expanded sparse images.
+
+CRC32 chunks contain the CRC32 of all the raw data described by the chunks
+preceding them, DONTCARE chunks being counted as zeroes. RAW payloads are
+passed through zlib.crc32(). FILL and DONTCARE chunks are accounted for
+without expanding them, by combining the CRC of a single block with itself,
+as zlib's crc32_combine() does.
+"""
+
+import zlib
+
+from snagflash.android_sparse_file.sparse import SparseFileFormatError
+
+CRC32_POLY = 0xEDB88320
+
+
+def gf2_matrix_times(mat: list, vec: int) -> int:
+	result = 0
+	i = 0
+	while vec:
+		if vec & 1:
+			result ^= mat[i]
+		vec >>= 1
+		i += 1
+	return result
+
+
+def gf2_matrix_square(mat: list) -> list:
+	return [gf2_matrix_times(mat, mat[n]) for n in range(32)]
+
+
+# zero_ops[k] is the operator which feeds 2^k zero bytes to a CRC register
+zero_ops = []
+
+
+def get_zero_op(k: int) -> list:
+	if not zero_ops:
+		# operator for one zero bit, squared three times for one zero byte
+		op = [CRC32_POLY] + [1 << n for n in range(31)]
+		for _ in range(3):
+			op = gf2_matrix_square(op)
+		zero_ops.append(op)
+
+	while len(zero_ops) <= k:
+		zero_ops.append(gf2_matrix_square(zero_ops[-1]))
+
+	return zero_ops[k]
+
+
+def crc32_combine(crc1: int, crc2: int, len2: int) -> int:
+	"""
+	Return the CRC32 of A + B, given crc1 = CRC32(A), crc2 = CRC32(B) and
+	len2 = len(B).
+	"""
+	k = 0
+	while len2:
+		if len2 & 1:
+			crc1 = gf2_matrix_times(get_zero_op(k), crc1)
+		len2 >>= 1
+		k += 1
+
+	return crc1 ^ crc2
+
+
+def crc32_repeat(block_crc: int, block_len: int, count: int) -> int:
+	"""
+	Return the CRC32 of count repetitions of a block, given its CRC32.
+	"""
+	result = 0
+	while count:
+		if count & 1:
+			result = crc32_combine(result, block_crc, block_len)
+		block_crc = crc32_combine(block_crc, block_crc, block_len)
+		block_len *= 2
+		count >>= 1
+
+	return result
+
+
+class SparseCrc32:
+	"""
+	Running CRC32 of the raw image described by a sequence of sparse chunks.
+	"""
+
+	def __init__(self, block_size: int):
+		self.block_size = block_size
+		self.crc = 0
+		# CRC32 of one block, for each fill pattern
+		self.block_crcs = {}
+
+	def update_raw(self, data):
+		self.crc = zlib.crc32(data, self.crc)
+
+	def update_fill(self, pattern: bytes, blocks: int):
+		pattern = bytes(pattern)
+		block_crc = self.block_crcs.get(pattern)
+		if block_crc is None:
+			block_crc = zlib.crc32(pattern * (self.block_size // 4))
+			self.block_crcs[pattern] = block_crc
+
+		run_len = blocks * self.block_size
+		run_crc = crc32_repeat(block_crc, self.block_size, blocks)
+		self.crc = crc32_combine(self.crc, run_crc, run_len)
+
+	def update_dontcare(self, blocks: int):
+		self.update_fill(b"\x00" * 4, blocks)
+
+	def check(self, expected: int):
+		if expected != self.crc:
+			raise SparseFileFormatError(
+				f"CRC32 mismatch: expected 0x{expected:08x}, computed 0x{self.crc:08x}"
+			)
@@ -0,0 +1,181 @@
+# This file is part of Snagboot
+# Copyright (C) 2026 Bootlin
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Lazy sparse to raw image expansion, so that Android sparse images can be
+written with protocols which need raw data, such as UMS and DFU.
+"""
+
+import bisect
+import logging
+
+from snagflash.android_sparse_file.sparse import (
+	AndroidSparseFile,
+	SparseFileFormatError,
+	CHUNK_TYPE_DONTCARE,
+	CHUNK_TYPE_RAW,
+	CHUNK_TYPE_FILL,
+	CHUNK_TYPE_CRC32,
+)
+
+logger = logging.getLogger("snagflash")
+
+
+class SparseExpander:
+	"""
+	Read-only, seekable file-like object presenting an Android sparse image
+	as the raw image it describes. Data is only produced when read() is
+	called, the raw image is never materialized.
+
+	FILL chunks are expanded from their pattern, RAW chunks are read from
+	the sparse file and DONTCARE chunks read as zeroes. Writers which can
+	seek over DONTCARE regions, e.g. block device writers, should use the
+	bmap returned by write_bmap() to skip them altogether.
+	"""
+
+	def __init__(self, path: str):
+		self.name = path
+		self.sparse_file = AndroidSparseFile(True, use_mmap=True)
+		self.sparse_file.open(path)
+		self.block_size = self.sparse_file.file_header.block_size
+		self.size = self.sparse_file.file_header.get_raw_size()
+		self.pos = 0
+
+		try:
+			self._index_chunks()
+		except Exception:
+			self.sparse_file.close()
+			raise
+
+	def _index_chunks(self):
+		"""
+		Record where each chunk which covers raw data lands in the raw image.
+		"""
+		# raw offsets of chunk starts, for bisection
+		self.starts = []
+		# (raw length, chunk type, payload offset in sparse file or fill pattern)
+		self.chunks = []
+
+		for block, header, data_offset in self.sparse_file.build_index():
+			if header.size == 0 or header.type == CHUNK_TYPE_CRC32:
+				continue
+
+			if header.type == CHUNK_TYPE_FILL:
+				payload = bytes(self.sparse_file.get_data(data_offset, 4))
+				if len(payload) != 4:
+					raise SparseFileFormatError("Truncated FILL payload")
+			else:
+				payload = data_offset
+
+			self.starts.append(block * self.block_size)
+			self.chunks.append((header.size * self.block_size, header.type, payload))
+
+	def mapped_ranges(self) -> list:
+		"""
+		Return the list of (first, last) block ranges which are covered by
+		RAW or FILL chunks.
+		"""
+		ranges = []
+		for start, (raw_len, chunk_type, _) in zip(
+			self.starts, self.chunks, strict=True
+		):
+			if chunk_type == CHUNK_TYPE_DONTCARE:
+				continue
+
+			first = start // self.block_size
+			last = (start + raw_len) // self.block_size - 1
+			if ranges and ranges[-1][1] == first - 1:
+				ranges[-1] = (ranges[-1][0], last)
+			else:
+				ranges.append((first, last))
+
+		return ranges
+
+	def write_bmap(self, bmap_file):
+		"""
+		Write a bmap file describing the mapped ranges of the expanded image
+		to the text file object bmap_file.
+		"""
+		ranges = self.mapped_ranges()
+		mapped = sum(last - first + 1 for first, last in ranges)
+		blocks = self.size // self.block_size
+
+		bmap_file.write('<?xml version="1.0" ?>\n<bmap version="1.2">\n')
+		bmap_file.write(f"\t<ImageSize> {self.size} </ImageSize>\n")
+		bmap_file.write(f"\t<BlockSize> {self.block_size} </BlockSize>\n")
+		bmap_file.write(f"\t<BlocksCount> {blocks} </BlocksCount>\n")
+		bmap_file.write(f"\t<MappedBlocksCount> {mapped} </MappedBlocksCount>\n")
+		bmap_file.write("\t<BlockMap>\n")
+		for first, last in ranges:
+			bmap_file.write(f"\t\t<Range> {first}-{last} </Range>\n")
+		bmap_file.write("\t</BlockMap>\n</bmap>\n")
+
+	def _read_chunk(self, index: int, rel: int, length: int) -> bytes:
+		_, chunk_type, payload = self.chunks[index]
+
+		if chunk_type == CHUNK_TYPE_RAW:
+			data = self.sparse_file.get_data(payload + rel, length)
+			if len(data) != length:
+				raise SparseFileFormatError("Unexpected end of file in RAW chunk")
+			return data
+		elif chunk_type == CHUNK_TYPE_FILL:
+			phase = rel % 4
+			return (payload * ((phase + length + 3) // 4))[phase : phase + length]
+		else:
+			return bytes(length)
+
+	def read(self, size: int = -1) -> bytes:
+		if size is None or size < 0 or self.pos + size > self.size:
+			size = max(self.size - self.pos, 0)
+
+		pieces = []
+		end = self.pos + size
+		index = bisect.bisect_right(self.starts, self.pos) - 1
+		while self.pos < end:
+			start = self.starts[index]
+			raw_len = self.chunks[index][0]
+			rel = self.pos - start
+			length = min(raw_len - rel, end - self.pos)
+			pieces.append(self._read_chunk(index, rel, length))
+			self.pos += length
+			index += 1
+
+		return b"".join(pieces)
+
+	def seek(self, offset: int, whence: int = 0) -> int:
+		if whence == 1:
+			offset += self.pos
+		elif whence == 2:
+			offset += self.size
+
+		if offset < 0:
+			raise ValueError(f"Invalid seek offset {offset}")
+
+		self.pos = offset
+		return self.pos
+
+	def tell(self) -> int:
+		return self.pos
+
+	def close(self):
+		self.sparse_file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
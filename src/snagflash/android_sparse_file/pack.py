@@ -0,0 +1,358 @@
+# This file is part of Snagboot
+# Copyright (C) 2026 Bootlin
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Fragment packing for sparse images larger than the Fastboot buffer.
+
+Each fragment costs a download and a flash round trip, so packing aims at
+the smallest possible number of fragments. Unlike split_streaming(), the
+whole split is planned from the chunk index before any payload is read:
+
+- Input DONTCARE chunks are never sent. Gaps between the chunks of a
+  fragment, including the prefix and suffix, each cost a single DONTCARE
+  header.
+- Fragments which would only contain DONTCARE chunks are not sent.
+- RAW chunks are split so that fragments start on erase-block-friendly
+  boundaries, as long as this doesn't increase the fragment count.
+"""
+
+import logging
+from dataclasses import dataclass, field
+
+from snagflash.android_sparse_file.sparse import (
+	AndroidSparseFile,
+	SPARSE_CHUNKHEADER_LEN,
+	SPARSE_FILEHEADER_LEN,
+	CHUNK_TYPE_DONTCARE,
+	CHUNK_TYPE_RAW,
+	CHUNK_TYPE_FILL,
+	CHUNK_TYPE_CRC32,
+)
+from snagflash.android_sparse_file.crc import SparseCrc32
+
+logger = logging.getLogger("snagflash")
+
+# Default alignment in bytes of fragment boundaries inside RAW chunks. This
+# matches common eMMC erase group and NAND erase block sizes.
+DEFAULT_SPLIT_ALIGN = 0x80000
+
+
+@dataclass
+class PackedChunk:
+	type: int
+	# first raw block covered by the chunk
+	block: int
+	blocks: int
+	# offset in the sparse file of the payload of the first block
+	data_offset: int
+
+
+@dataclass
+class Fragment:
+	# RAW and FILL chunks to send, along with DONTCARE and CRC32 chunks of
+	# the input image, which are only used for CRC32 validation.
+	chunks: list = field(default_factory=list)
+	size: int = SPARSE_FILEHEADER_LEN
+
+	def data_chunks(self):
+		return [c for c in self.chunks if c.type in [CHUNK_TYPE_RAW, CHUNK_TYPE_FILL]]
+
+
+@dataclass
+class PackingReport:
+	fragments: int
+	wire_bytes: int
+	payload_bytes: int
+	aligned: bool
+
+	def __str__(self):
+		overhead = self.wire_bytes - self.payload_bytes
+		return (
+			f"{self.fragments} fragment(s), {self.wire_bytes} bytes on the wire "
+			f"({self.payload_bytes} bytes of payload, {overhead} bytes of headers)"
+			+ (", split on aligned boundaries" if self.aligned else "")
+		)
+
+
+class FragmentPacker:
+	"""
+	Plans how a sparse image is split into fragments of at most bufsize
+	bytes. The plan only depends on chunk headers, so it can be used as a
+	dry run.
+	"""
+
+	def __init__(self, sparse_file: AndroidSparseFile, bufsize: int, align: int):
+		self.sparse_file = sparse_file
+		self.bufsize = bufsize
+		self.block_size = sparse_file.file_header.block_size
+		self.total_blocks = sparse_file.file_header.blocks
+		self.align_blocks = max(align // self.block_size, 1)
+
+		min_required = (
+			SPARSE_FILEHEADER_LEN + 3 * SPARSE_CHUNKHEADER_LEN + self.block_size
+		)
+		if bufsize <= min_required:
+			raise IOError(
+				f"Buffer size {bufsize} too small. Need at least {min_required} bytes "
+				f"to fit one {self.block_size}-byte block with headers"
+			)
+
+	def _gap_cost(self, cursor: int, block: int) -> int:
+		# a DONTCARE header is needed if the chunk doesn't follow the last one
+		return SPARSE_CHUNKHEADER_LEN if block != cursor else 0
+
+	def _suffix_cost(self, end: int) -> int:
+		return SPARSE_CHUNKHEADER_LEN if end < self.total_blocks else 0
+
+	def plan(self, aligned: bool) -> list:
+		fragments = []
+		frag = Fragment()
+		# end block of the last data chunk of the current fragment
+		cursor = 0
+
+		def close_fragment():
+			nonlocal frag, cursor
+			fragments.append(frag)
+			frag = Fragment()
+			cursor = 0
+
+		for block, header, data_offset in self.sparse_file.build_index():
+			if header.type in [CHUNK_TYPE_DONTCARE, CHUNK_TYPE_CRC32]:
+				frag.chunks.append(
+					PackedChunk(header.type, block, header.size, data_offset)
+				)
+				continue
+
+			if header.type == CHUNK_TYPE_FILL:
+				cost = self._gap_cost(cursor, block) + SPARSE_CHUNKHEADER_LEN + 4
+				end = block + header.size
+				if frag.size + cost + self._suffix_cost(end) > self.bufsize:
+					close_fragment()
+					cost = self._gap_cost(cursor, block) + SPARSE_CHUNKHEADER_LEN + 4
+
+				frag.chunks.append(
+					PackedChunk(CHUNK_TYPE_FILL, block, header.size, data_offset)
+				)
+				frag.size += cost
+				cursor = end
+				continue
+
+			# RAW chunks are split as needed
+			off = 0
+			while off < header.size:
+				start = block + off
+				remaining = header.size - off
+				cost = self._gap_cost(cursor, start) + SPARSE_CHUNKHEADER_LEN
+				avail = self.bufsize - frag.size - cost
+				max_blks = min(avail // self.block_size, remaining)
+
+				if max_blks < remaining:
+					# the fragment will be full, a suffix is needed
+					max_blks = min(
+						(avail - SPARSE_CHUNKHEADER_LEN) // self.block_size, remaining
+					)
+					if aligned:
+						end = (
+							(start + max_blks) // self.align_blocks * self.align_blocks
+						)
+						if end > start:
+							max_blks = end - start
+				elif self._suffix_cost(start + max_blks):
+					if avail - max_blks * self.block_size < SPARSE_CHUNKHEADER_LEN:
+						max_blks -= 1
+
+				if max_blks <= 0:
+					close_fragment()
+					continue
+
+				frag.chunks.append(
+					PackedChunk(
+						CHUNK_TYPE_RAW,
+						start,
+						max_blks,
+						data_offset + off * self.block_size,
+					)
+				)
+				frag.size += cost + max_blks * self.block_size
+				cursor = start + max_blks
+				off += max_blks
+
+				if off < header.size:
+					close_fragment()
+
+		fragments.append(frag)
+
+		# account for suffixes, fold data-less fragments into their neighbours
+		packed = []
+		for frag in fragments:
+			data_chunks = frag.data_chunks()
+			if data_chunks:
+				last = data_chunks[-1]
+				frag.size += self._suffix_cost(last.block + last.blocks)
+				packed.append(frag)
+			elif packed:
+				packed[-1].chunks.extend(frag.chunks)
+			else:
+				packed.append(frag)
+
+		if len(packed) > 1 and not packed[0].data_chunks():
+			packed[1].chunks[0:0] = packed[0].chunks
+			packed.pop(0)
+		elif not packed[0].data_chunks():
+			# image without data, send a single DONTCARE chunk
+			packed[0].size += SPARSE_CHUNKHEADER_LEN
+
+		return packed
+
+	def best_plan(self) -> tuple:
+		"""
+		Return (fragments, aligned), aligned splits are used only if they
+		don't require more fragments.
+		"""
+		unaligned = self.plan(False)
+		if self.align_blocks <= 1:
+			return (unaligned, False)
+
+		aligned = self.plan(True)
+		if len(aligned) <= len(unaligned):
+			return (aligned, len(aligned) > 1)
+
+		return (unaligned, False)
+
+
+def check_crc(sparse_file: AndroidSparseFile):
+	"""
+	Check the CRC32 chunks and header checksum of the sparse file, if it has
+	any, so that a corrupted image is rejected before any fragment is sent.
+	"""
+	index = sparse_file.build_index()
+	has_crc_chunks = any(header.type == CHUNK_TYPE_CRC32 for _, header, _ in index)
+	if not has_crc_chunks and not sparse_file.file_header.csum:
+		return
+
+	block_size = sparse_file.file_header.block_size
+	crc = SparseCrc32(block_size)
+	for _, header, data_offset in index:
+		if header.type == CHUNK_TYPE_RAW:
+			payload = sparse_file.get_data(data_offset, header.size * block_size)
+			if len(payload) != header.size * block_size:
+				raise IOError("Unexpected end of file while reading RAW chunk data")
+			crc.update_raw(payload)
+		elif header.type == CHUNK_TYPE_FILL:
+			crc.update_fill(sparse_file.get_data(data_offset, 4), header.size)
+		elif header.type == CHUNK_TYPE_DONTCARE:
+			crc.update_dontcare(header.size)
+		elif header.type == CHUNK_TYPE_CRC32:
+			crc_data = sparse_file.get_data(data_offset, 4)
+			crc.check(int.from_bytes(crc_data, "little"))
+
+	if sparse_file.file_header.csum:
+		crc.check(sparse_file.file_header.csum)
+
+
+def write_fragment(sparse_file: AndroidSparseFile, frag: Fragment, dest: str) -> str:
+	"""
+	Serialize a planned fragment to dest.
+	"""
+	block_size = sparse_file.file_header.block_size
+	total_blocks = sparse_file.file_header.blocks
+
+	outf = AndroidSparseFile(False)
+	outf.open(dest, block_size)
+	cursor = 0
+
+	for chunk in frag.chunks:
+		if chunk.type in [CHUNK_TYPE_DONTCARE, CHUNK_TYPE_CRC32]:
+			continue
+
+		if chunk.block > cursor:
+			outf.write_chunk(CHUNK_TYPE_DONTCARE, [], chunk.block - cursor)
+
+		if chunk.type == CHUNK_TYPE_RAW:
+			payload = sparse_file.get_data(chunk.data_offset, chunk.blocks * block_size)
+			if len(payload) != chunk.blocks * block_size:
+				raise IOError("Unexpected end of file while reading RAW chunk data")
+		else:
+			payload = sparse_file.get_data(chunk.data_offset, 4)
+
+		outf.write_chunk(chunk.type, payload, chunk.blocks)
+		cursor = chunk.block + chunk.blocks
+
+	if cursor < total_blocks:
+		outf.write_chunk(CHUNK_TYPE_DONTCARE, [], total_blocks - cursor)
+
+	outf.close()
+	return dest
+
+
+def plan_split(path: str, bufsize: int, align: int = DEFAULT_SPLIT_ALIGN):
+	"""
+	Dry run: plan the split of the sparse file at path without reading any
+	payload, and return a PackingReport.
+	"""
+	sparse_file = AndroidSparseFile(True, use_mmap=True)
+	sparse_file.open(path)
+	try:
+		fragments, aligned = FragmentPacker(sparse_file, bufsize, align).best_plan()
+	finally:
+		sparse_file.close()
+
+	return make_report(fragments, aligned, sparse_file.file_header.block_size)
+
+
+def make_report(fragments: list, aligned: bool, block_size: int) -> PackingReport:
+	payload_bytes = 0
+	for frag in fragments:
+		for chunk in frag.data_chunks():
+			if chunk.type == CHUNK_TYPE_RAW:
+				payload_bytes += chunk.blocks * block_size
+			else:
+				payload_bytes += 4
+
+	return PackingReport(
+		fragments=len(fragments),
+		wire_bytes=sum(frag.size for frag in fragments),
+		payload_bytes=payload_bytes,
+		aligned=aligned,
+	)
+
+
+def split_packed(
+	path: str,
+	dest: str,
+	bufsize: int,
+	align: int = DEFAULT_SPLIT_ALIGN,
+	validate_crc: bool = True,
+):
+	"""
+	Generator which writes each planned fragment of the sparse file at path
+	to dest and yields dest, like split_streaming(). Use plan_split() to get
+	the fragment count beforehand. CRC32 checksums are validated before the
+	first fragment is yielded.
+	"""
+	sparse_file = AndroidSparseFile(True, use_mmap=True)
+	sparse_file.open(path)
+
+	try:
+		fragments, _ = FragmentPacker(sparse_file, bufsize, align).best_plan()
+		if validate_crc:
+			check_crc(sparse_file)
+
+		for frag in fragments:
+			yield write_fragment(sparse_file, frag, dest)
+	finally:
+		sparse_file.close()
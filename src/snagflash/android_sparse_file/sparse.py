@@ -6,6 +6,9 @@
 
 from snagrecover.utils import BinFileHeader
 from dataclasses import dataclass
+import bisect
+import mmap
+import os
 
 SPARSE_FILEHEADER_LEN = 28
 SPARSE_CHUNKHEADER_LEN = 12
@@ -28,6 +31,16 @@ class SparseFileFormatError(Exception):
 		return f"Sparse file format error: {self.message}"
 
 
+def is_sparse_file(path) -> bool:
+	"""
+	Check if the file at path starts with the Android sparse file magic.
+	"""
+	with open(path, "rb") as f:
+		magic = f.read(4)
+
+	return len(magic) == 4 and int.from_bytes(magic, "little") == MAGIC
+
+
 @dataclass
 class AndroidSparseHeader(BinFileHeader):
 	magic: int = MAGIC
@@ -99,11 +112,27 @@ class AndroidChunkHeader(BinFileHeader):
 
 
 class AndroidSparseFile:
-	def __init__(self, read):
+	"""
+	Android sparse file reader and writer.
+
+	In read mode, use_mmap=True maps the file in memory instead of reading
+	it: chunk headers are decoded in place and RAW payloads are returned as
+	memoryview slices of the mapping, without any copy.
+	"""
+
+	def __init__(self, read, use_mmap=False):
 		self.file_header = AndroidSparseHeader()
 		self.fd = None
 		self.size = 0
 		self.ro = read
+		self.use_mmap = use_mmap
+		self.mmap = None
+		self.view = None
+		# read position, only used in mmap mode
+		self.pos = 0
+		# (first raw block, chunk header, payload offset) for each chunk
+		self.index = None
+		self.index_blocks = None
 
 	def open(self, fname, block_size=0):
 		if self.ro is False:
@@ -113,8 +142,24 @@ class AndroidSparseFile:
 			self.fd.write(buf)
 			self.size = SPARSE_FILEHEADER_LEN
 			self.file_header.block_size = block_size
-		else:
+		elif self.use_mmap and not hasattr(fname, "read"):
 			self.fd = open(fname, "rb")
+			try:
+				# empty files can't be mapped
+				if os.fstat(self.fd.fileno()).st_size < SPARSE_FILEHEADER_LEN:
+					raise SparseFileFormatError(f"File {fname} is too small")
+				self.mmap = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+				self.view = memoryview(self.mmap)
+				self.file_header = AndroidSparseHeader.read(self.view, 0)
+				self.file_header.check()
+			except Exception:
+				self.close()
+				raise
+			self.pos = SPARSE_FILEHEADER_LEN
+		else:
+			# Readable file objects, such as on-the-fly converters, are
+			# accepted as well as paths.
+			self.fd = fname if hasattr(fname, "read") else open(fname, "rb")
 			h = self.fd.read(SPARSE_FILEHEADER_LEN)
 			self.file_header = AndroidSparseHeader.read(h, 0)
 			self.file_header.check()
@@ -125,28 +170,133 @@ class AndroidSparseFile:
 			buf = bytearray()
 			AndroidSparseHeader.write(self.file_header, buf)
 			self.fd.write(buf)
+		if self.view is not None:
+			self.view.release()
+			try:
+				self.mmap.close()
+			except BufferError:
+				# Payload slices are still referenced somewhere, the
+				# mapping will be unmapped once they are released.
+				pass
+			self.view = None
+			self.mmap = None
 		self.fd.close()
 
-	def read_chunk(self):
-		h = self.fd.read(self.file_header.chunk_header_len)
-		if not h:
-			return (None, None)
+	def read(self, size):
+		"""
+		Read size bytes from the current position. In mmap mode, this returns
+		a memoryview slice of the mapping.
+		"""
+		if self.view is None:
+			return self.fd.read(size)
+
+		data = self.view[self.pos : self.pos + size]
+		self.pos += len(data)
+		return data
+
+	def get_data(self, offset, size):
+		"""
+		Return size bytes located at offset in the sparse file, without
+		moving the current read position.
+		"""
+		if self.view is not None:
+			return self.view[offset : offset + size]
+
+		saved_pos = self.fd.tell()
+		self.fd.seek(offset)
+		data = self.fd.read(size)
+		self.fd.seek(saved_pos)
+		return data
+
+	def read_chunk_header(self):
+		"""
+		Read and check the chunk header at the current position, returns None
+		at the end of the file.
+		"""
+		hdr_len = self.file_header.chunk_header_len
+		if self.view is not None:
+			if self.pos + hdr_len > len(self.view):
+				return None
+			header = AndroidChunkHeader.read(self.view, self.pos)
+			self.pos += hdr_len
+		else:
+			h = self.fd.read(hdr_len)
+			if len(h) < hdr_len:
+				return None
+			header = AndroidChunkHeader.read(h, 0)
 
-		header = AndroidChunkHeader.read(h, 0)
 		header.check()
+		return header
+
+	def read_chunk(self):
+		header = self.read_chunk_header()
+		if header is None:
+			return (None, None)
 
 		data = None
 		chunk_len = header.get_data_size(self.file_header.block_size)
-		if header.type == CHUNK_TYPE_FILL:
-			val = self.fd.read(chunk_len)
-			data = val
-		elif header.type == CHUNK_TYPE_CRC32:
-			val = self.fd.read(chunk_len)
-			data = val
+		if header.type in [CHUNK_TYPE_FILL, CHUNK_TYPE_CRC32]:
+			data = bytes(self.read(chunk_len))
 		elif header.type == CHUNK_TYPE_RAW:
-			data = self.fd.read(chunk_len)
+			data = self.read(chunk_len)
 		return (header, data)
 
+	def build_index(self):
+		"""
+		Walk all chunk headers once, skipping payloads, so that chunks can
+		then be accessed randomly with find_chunk() and get_data(). The
+		current read position is left unchanged.
+		"""
+		hdr_len = self.file_header.chunk_header_len
+		block_size = self.file_header.block_size
+		self.index = []
+		self.index_blocks = []
+
+		if self.view is not None:
+			saved_pos = self.pos
+		else:
+			saved_pos = self.fd.tell()
+
+		offset = self.file_header.header_len
+		block = 0
+		try:
+			while True:
+				if self.view is not None:
+					self.pos = offset
+				else:
+					self.fd.seek(offset)
+
+				header = self.read_chunk_header()
+				if header is None:
+					break
+
+				self.index.append((block, header, offset + hdr_len))
+				self.index_blocks.append(block)
+				block += header.size
+				offset += hdr_len + header.get_data_size(block_size)
+		finally:
+			if self.view is not None:
+				self.pos = saved_pos
+			else:
+				self.fd.seek(saved_pos)
+
+		if block != self.file_header.blocks:
+			raise SparseFileFormatError(
+				f"Chunks cover {block} blocks, header specifies {self.file_header.blocks} blocks"
+			)
+
+		return self.index
+
+	def find_chunk(self, block):
+		"""
+		Return the position in the chunk index of the chunk containing the
+		given raw block.
+		"""
+		if self.index is None:
+			self.build_index()
+
+		return bisect.bisect_right(self.index_blocks, block) - 1
+
 	def write_chunk(self, type, data, blocks):
 		if self.ro is True:
 			return
@@ -26,7 +26,6 @@ import logging
 
 from snagflash.android_sparse_file.sparse import (
 	AndroidSparseFile,
-	AndroidChunkHeader,
 	SPARSE_CHUNKHEADER_LEN,
 	SPARSE_FILEHEADER_LEN,
 	CHUNK_TYPE_DONTCARE,
@@ -35,6 +34,8 @@ from snagflash.android_sparse_file.sparse import (
 	CHUNK_TYPE_CRC32,
 )
 
+from snagflash.android_sparse_file.crc import SparseCrc32
+
 logger = logging.getLogger("snagflash")
 
 # Reserve space for the trailing DONT_CARE suffix chunk header
@@ -160,14 +161,22 @@ def flush_fragment(state, dest, block_size, original_total_blks):
 
 
 def process_raw_chunk(
-	input_fd, header, state, blocks_done, bufsize, block_size, dest, original_total_blks
+	input_fd,
+	header,
+	state,
+	blocks_done,
+	bufsize,
+	block_size,
+	dest,
+	original_total_blks,
+	crc=None,
 ):
 	"""
 	Stage (and flush as needed) a RAW chunk, which may need to be split
 	across multiple fragments since RAW payloads can be large.
 
 	Args:
-		input_fd: Input sparse file handle, positioned at the start of the chunk payload
+		input_fd: Input AndroidSparseFile, positioned at the start of the chunk payload
 		header: AndroidChunkHeader for this RAW chunk
 		state: SplitFragmentState for the fragment currently being built
 		blocks_done: Cumulative blocks already written across all fragments
@@ -175,6 +184,7 @@ def process_raw_chunk(
 		block_size: Sparse image block size in bytes
 		dest: Output path for fragment files
 		original_total_blks: Total blocks in the original (unsplit) sparse image
+		crc: Optional SparseCrc32, updated with the payload as it is read
 
 	Yields:
 		Path to each fragment flushed while processing this chunk
@@ -214,6 +224,9 @@ def process_raw_chunk(
 		if len(part) < chunk_data_size:
 			raise IOError("Unexpected end of file while reading RAW chunk data")
 
+		if crc is not None:
+			crc.update_raw(part)
+
 		# Stage the slice as a RAW chunk in the current fragment
 		state.pending.append((CHUNK_TYPE_RAW, max_blks, part))
 		state.pending_payload_bytes += len(part)
@@ -227,11 +240,12 @@ def process_raw_chunk(
 
 
 def process_dontcare_chunk(
-	header, state, blocks_done, bufsize, block_size, dest, original_total_blks
+	header, state, blocks_done, bufsize, block_size, dest, original_total_blks, crc=None
 ):
 	"""
 	Stage a DONT_CARE chunk, flushing the current fragment first if the
-	chunk header doesn't fit within bufsize.
+	chunk header doesn't fit within bufsize. If crc is given, it is updated
+	as if the chunk was filled with zeroes.
 
 	Returns:
 		(updated blocks_done, flushed_fragment path or None)
@@ -252,6 +266,9 @@ def process_dontcare_chunk(
 		flushed_fragment = flush_fragment(state, dest, block_size, original_total_blks)
 		ensure_prefix_skip(state, blocks_done)
 
+	if crc is not None:
+		crc.update_dontcare(header.size)
+
 	# Stage DONT_CARE chunk
 	state.pending.append((CHUNK_TYPE_DONTCARE, header.size, None))
 	state.piece_blocks_sum += header.size
@@ -262,11 +279,20 @@ def process_dontcare_chunk(
 
 
 def process_fill_chunk(
-	input_fd, header, state, blocks_done, bufsize, block_size, dest, original_total_blks
+	input_fd,
+	header,
+	state,
+	blocks_done,
+	bufsize,
+	block_size,
+	dest,
+	original_total_blks,
+	crc=None,
 ):
 	"""
 	Stage a FILL chunk (always exactly 4 bytes of payload), flushing the
-	current fragment first if it doesn't fit within bufsize.
+	current fragment first if it doesn't fit within bufsize. If crc is
+	given, it is updated with the expanded chunk.
 
 	Returns:
 		(updated blocks_done, flushed_fragment path or None)
@@ -275,6 +301,9 @@ def process_fill_chunk(
 	if len(fill_value) != 4:
 		raise IOError("Truncated FILL payload")
 
+	if crc is not None:
+		crc.update_fill(fill_value, header.size)
+
 	ensure_prefix_skip(state, blocks_done)
 
 	# Check if adding this 4-byte payload + header fits within bufsize
@@ -302,27 +331,38 @@ def process_fill_chunk(
 	return blocks_done, flushed_fragment
 
 
-def split_streaming(path, dest, bufsize):
+def split_streaming(path, dest, bufsize, validate_crc=True):
 	"""
 	Generator that yields one split sparse file at a time for immediate processing.
 
 	This streaming approach minimizes memory usage by:
 	- Reading RAW chunk data incrementally (not loading entire chunk into RAM)
+	- Memory-mapping the input file, so that RAW data is never copied before
+	being written to a fragment
 	- Yielding each split file immediately after creation
 	- Reusing the same temporary file location
 	- Proper overhead calculation accounting for all headers
 
 	This allows processing of arbitrarily large sparse files with constant memory usage.
 
+	If validate_crc is set, the CRC32 of the expanded image is computed as
+	payloads are read, and checked against CRC32 chunks and the file header
+	checksum. A mismatch raises SparseFileFormatError as soon as the CRC32
+	chunk is reached, so the fragment holding it is never yielded.
+
 	Args:
-		path: Path to input sparse file
+		path: Path to input sparse file, or readable file object such as
+		a RawSparseStream
 		dest: Path for temporary output file (will be reused for each split)
 		bufsize: Maximum size for each output file
+		validate_crc: Check CRC32 chunks and the file header checksum
 
 	Yields:
 		Path to each split file (same path, but content changes each iteration)
 	"""
-	sparse_file = AndroidSparseFile(True)
+	# Sparse files are memory-mapped, so that RAW payloads are staged as
+	# slices of the mapping instead of copies.
+	sparse_file = AndroidSparseFile(True, use_mmap=True)
 	sparse_file.open(path)
 
 	# Store original total blocks for all output files
@@ -346,8 +386,9 @@ def split_streaming(path, dest, bufsize):
 	# Cumulative blocks across ALL fragments so far (used for DONT_CARE prefix)
 	blocks_done = 0
 	state = SplitFragmentState()
+	crc = SparseCrc32(block_size) if validate_crc else None
 
-	input_fd = sparse_file.fd  # Direct file handle for streaming reads
+	input_fd = sparse_file  # Streaming reads, zero-copy in mmap mode
 
 	logger.debug(
 		f"Starting streaming split: total_blocks={original_total_blks}, block_size={block_size}"
@@ -356,21 +397,16 @@ def split_streaming(path, dest, bufsize):
 	try:
 		while True:
 			# Read chunk header (not data yet)
-			chunk_header_bytes = input_fd.read(SPARSE_CHUNKHEADER_LEN)
-			if (
-				not chunk_header_bytes
-				or len(chunk_header_bytes) < SPARSE_CHUNKHEADER_LEN
-			):
+			header = sparse_file.read_chunk_header()
+			if header is None:
 				# End of input file - finalize current output
+				if crc is not None and sparse_file.file_header.csum:
+					crc.check(sparse_file.file_header.csum)
 				result = flush_fragment(state, dest, block_size, original_total_blks)
 				if result:
 					yield result
 				break
 
-			# Parse chunk header
-			header = AndroidChunkHeader.read(chunk_header_bytes, 0)
-			header.check()
-
 			logger.debug(
 				f"Processing chunk: type={chunk_type_name(header.type)} "
 				f"size={header.size} blocks ({header.total_size} bytes)"
@@ -386,6 +422,7 @@ def split_streaming(path, dest, bufsize):
 					block_size,
 					dest,
 					original_total_blks,
+					crc,
 				)
 				# process_raw_chunk is a generator that yields flushed fragment
 				# paths and returns the updated blocks_done via StopIteration.value
@@ -406,6 +443,7 @@ def split_streaming(path, dest, bufsize):
 					block_size,
 					dest,
 					original_total_blks,
+					crc,
 				)
 				if flushed_fragment:
 					yield flushed_fragment
@@ -420,6 +458,7 @@ def split_streaming(path, dest, bufsize):
 					block_size,
 					dest,
 					original_total_blks,
+					crc,
 				)
 				if flushed_fragment:
 					yield flushed_fragment
@@ -428,7 +467,9 @@ def split_streaming(path, dest, bufsize):
 				crc_data = input_fd.read(4)
 				if len(crc_data) != 4:
 					raise IOError("Truncated CRC32 payload")
-				logger.debug("Skipping CRC32 chunk (validation only)")
+				if crc is not None:
+					crc.check(int.from_bytes(crc_data, "little"))
+					logger.debug(f"CRC32 chunk 0x{crc.crc:08x} validated")
 				continue
 
 			else:
@@ -22,6 +22,7 @@ from snagrecover import __version__
 from snagflash.dfu import dfu_cli
 from snagflash.fastboot import fastboot
 from snagrecover.utils import cli_error
+from snagrecover import usb_stats
 import platform
 import logging
 import sys
@@ -73,6 +74,11 @@ def cli():
 		help="USB timeout, sometimes increasing this is necessary when downloading large files",
 		default=60000,
 	)
+	common.add_argument(
+		"--usb-stats",
+		help="log USB transfer statistics at the end of the run",
+		action="store_true",
+	)
 	dfuargs = parser.add_argument_group("DFU")
 	dfuargs.add_argument(
 		"-D",
@@ -86,6 +92,15 @@ def cli():
 		help="Avoid detaching DFU mode after download and keep the mode active",
 		action="store_true",
 	)
+	dfuargs.add_argument(
+		"--dfu-verify",
+		help="Read back each file after download and compare it to the original. "
+		"partial mode only reads back the first MiB of each file, so it doesn't "
+		"detect corrupted data past it",
+		nargs="?",
+		choices=["full", "partial"],
+		const="full",
+	)
 	dfuargs.add_argument(
 		"--dfu-detach", help="Only request detaching DFU mode", action="store_true"
 	)
@@ -158,18 +173,23 @@ def cli():
 	recovery_logger.parent = logger
 
 	logger.info(f"Running snagflash using protocol {args.protocol}")
-	if args.protocol == "dfu":
-		dfu_cli(args)
-	elif args.protocol == "ums":
-		if args.src is None or (args.blockdev is None and args.dest is None):
-			cli_error("missing an UMS config!")
-		ums(args)
-	elif args.protocol in ["fastboot", "fastboot-uboot"]:
-		if args.fastboot_cmd is None:
-			args.fastboot_cmd = []
-		fastboot(args)
-	else:
-		cli_error(f"unrecognized protocol {args.protocol}")
+	if args.usb_stats:
+		usb_stats.enable()
+	try:
+		if args.protocol == "dfu":
+			dfu_cli(args)
+		elif args.protocol == "ums":
+			if args.src is None or (args.blockdev is None and args.dest is None):
+				cli_error("missing an UMS config!")
+			ums(args)
+		elif args.protocol in ["fastboot", "fastboot-uboot"]:
+			if args.fastboot_cmd is None:
+				args.fastboot_cmd = []
+			fastboot(args)
+		else:
+			cli_error(f"unrecognized protocol {args.protocol}")
+	finally:
+		usb_stats.log_summary()
 
 
 if __name__ == "__main__":
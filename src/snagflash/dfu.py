@@ -17,6 +17,8 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import hashlib
+import os
 from snagrecover.protocols import dfu
 import logging
 
@@ -32,29 +34,94 @@ from snagrecover.utils import (
 	access_error,
 )
 from usb.core import Device
+from snagflash.android_sparse_file.sparse import is_sparse_file
+from snagflash.android_sparse_file.expand import SparseExpander
 
+# amount of data read back by partial verifications
+PARTIAL_VERIFY_SIZE = 0x100000
 
-def dfu_detach(dev: Device, altsetting: int = 0):
+
+def dfu_detach(dfu_cmd: dfu.DFU, altsetting: int = 0):
 	logger.info("Sending DFU detach command...")
-	dfu_cmd = dfu.DFU(dev, stm32=False)
-	dfu_cmd.get_status()
 	dfu_cmd.detach(altsetting)
 	logger.info("Done")
 
 
-def dfu_download(dev: Device, altsetting: int, path: str):
-	with open(path, "rb") as file:
-		blob = file.read(-1)
-	size = len(blob)
-	logger.info(f"Downloading {path} to altsetting {altsetting}...")
-	logger.debug(f"DFU config altsetting:{altsetting} size:0x{size:x} path:{path}")
-	dfu_cmd = dfu.DFU(dev, stm32=False)
-	dfu_cmd.get_status()
-	dfu_cmd.download_and_run(blob, altsetting, 0, size, show_progress=True)
-	dfu_cmd.get_status()
+def dfu_download(dfu_cmd: dfu.DFUSession, configs: list):
+	"""
+	Download each (altsetting, path) of configs in a single DFU session.
+	"""
+	blobs = []
+	try:
+		for altsetting, path in configs:
+			blob, size = open_image(path)
+			blobs.append(blob)
+			logger.info(f"Queuing {path} for altsetting {altsetting}")
+			logger.debug(
+				f"DFU config altsetting:{altsetting} size:0x{size:x} path:{path}"
+			)
+			dfu_cmd.queue_download(blob, altsetting, 0, size)
+
+		dfu_cmd.download_queued(show_progress=True)
+	finally:
+		for blob in blobs:
+			blob.close()
 	logger.info("Done")
 
 
+def open_image(path: str):
+	"""
+	Return a file object and size for the raw contents of the image at path.
+	"""
+	if is_sparse_file(path):
+		# Android sparse images are expanded while they are sent
+		logger.info(f"{path} is an Android sparse file, expanding it")
+		blob = SparseExpander(path)
+		return (blob, blob.size)
+
+	# the file is read one DFU transfer at a time
+	return (open(path, "rb"), os.path.getsize(path))
+
+
+def dfu_verify(dfu_cmd: dfu.DFU, altsetting: int, path: str, partial: bool = False):
+	"""
+	Read back the contents of altsetting and compare them to the image at
+	path. Both are hashed as they are read, so nothing is kept in memory.
+	DFU uploads are sequential, a partial verification only reads back the
+	first PARTIAL_VERIFY_SIZE bytes of the image, so corrupted data past
+	them isn't detected.
+	"""
+	blob, size = open_image(path)
+	if partial and size > PARTIAL_VERIFY_SIZE:
+		logger.warning(
+			f"Partial verification, only the first {PARTIAL_VERIFY_SIZE} of {size} bytes of {path} are checked"
+		)
+		size = PARTIAL_VERIFY_SIZE
+	logger.info(f"Verifying {size} bytes of {path} on altsetting {altsetting}...")
+
+	expected = hashlib.sha256()
+	actual = hashlib.sha256()
+	read = 0
+	try:
+		for block in dfu_cmd.upload(altsetting, size):
+			actual.update(block)
+			expected.update(blob.read(len(block)))
+			read += len(block)
+	finally:
+		blob.close()
+
+	if read < size:
+		raise ValueError(
+			f"Verification failed: the device only returned {read} of {size} bytes"
+		)
+	if actual.digest() != expected.digest():
+		raise ValueError(
+			f"Verification failed: SHA-256 {actual.hexdigest()} of the data read "
+			f"back doesn't match {expected.hexdigest()}"
+		)
+	logger.info("Verification successful")
+
+
 def dfu_reset(dev: Device):
 	logger.info("Sending DFU reset command...")
 	reset_usb(dev)
@@ -80,13 +147,21 @@ def dfu_cli(args):
 		access_error("USB DFU", args.port)
 	dev = get_usb(usb_addr)
 	dev.default_timeout = int(args.timeout)
+	dfu_cmd = dfu.DFUSession(dev, stm32=False)
 	altsetting = 0
 	if args.dfu_config:
+		configs = []
 		for dfu_config in args.dfu_config:
 			(altsetting, sep, path) = dfu_config.partition(":")
 			altsetting = int(altsetting)
-			dfu_download(dev, altsetting, path)
+			configs.append((altsetting, path))
+		dfu_download(dfu_cmd, configs)
+		if args.dfu_verify:
+			for config_altsetting, path in configs:
+				dfu_verify(
+					dfu_cmd, config_altsetting, path, args.dfu_verify == "partial"
+				)
 	if not args.dfu_keep or args.dfu_detach or args.dfu_reset:
-		dfu_detach(dev, altsetting)
+		dfu_detach(dfu_cmd, altsetting)
 	if args.dfu_reset:
 		dfu_reset(dev)
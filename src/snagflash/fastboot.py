@@ -114,6 +114,7 @@ def fastboot(args):
 		"oem_bootbus",
 		"reset",
 		"flash_sparse",
+		"flash_sparse_dry_run",
 	}
 
 	for cmd in args.fastboot_cmd:
@@ -22,6 +22,8 @@ import shutil
 import tempfile
 from snagflash.bmaptools import BmapCreate
 from snagflash.bmaptools import BmapCopy
+from snagflash.android_sparse_file.sparse import is_sparse_file
+from snagflash.android_sparse_file.expand import SparseExpander
 from snagrecover.utils import (
 	open_compressed_file,
 	get_bmap_path,
@@ -93,6 +95,21 @@ def bmap_copy(filepath: str, dev, src_size: int):
 			mapfile.close()
 
 
+def sparse_copy(filepath: str, dev):
+	"""
+	Expand an Android sparse image on the fly while writing it. DONTCARE
+	chunks are left out of the generated bmap, so they are skipped on the
+	block device instead of being written.
+	"""
+	with SparseExpander(filepath) as src_file:
+		with tempfile.NamedTemporaryFile("w+") as mapfile:
+			src_file.write_bmap(mapfile)
+			mapfile.flush()
+			with open(mapfile.name, "rb") as mapfileb:
+				writer = BmapCopy.BmapBdevCopy(src_file, dev, mapfileb, src_file.size)
+				writer.copy(False, True)
+
+
 def write_raw(args):
 	devpath = args.blockdev
 	filepath = args.src
@@ -106,7 +123,11 @@ def write_raw(args):
 	)
 	logger.info(f"Copying {filepath} to {devpath}...")
 	with open(devpath, "rb+") as dev:
-		bmap_copy(filepath, dev, size)
+		if size is not None and is_sparse_file(filepath):
+			logger.info(f"{filepath} is an Android sparse file, expanding it")
+			sparse_copy(filepath, dev)
+		else:
+			bmap_copy(filepath, dev, size)
 	logger.info("Done")
 
 
@@ -26,10 +26,12 @@
 #    certain PID:VID pair is registered.
 #    It will:
 #    2.1. Move the network interface to $NETNS_NAME
-#    2.2. Add a static IP address to the interface,
-#        so that the board can reach the recovery tool
-#    2.3. Route an arbitrary client ip to the interface,
-#        so that the recovery tool can reach the board
+#    2.2. Add a static IP address to the interface, in
+#        a /24 subnet which isn't used by any other
+#        interface, so that the board can reach the
+#        recovery tool and the recovery tool can reach
+#        the board. Each board is given its own subnet,
+#        so that several boards can be recovered at once.
 #    3.4. Route 255.255.255.255 to the interface, so
 #         that the recovery tool can reach the board
 #         using a broadcast, when the board does not
@@ -77,19 +79,27 @@ config_interface () {
 	#This sets up the necessary
 	#network config inside the recovery namespace
 
-	SERVER_IP="192.168.0.100"
-	CLIENT_IP="192.168.0.101"
 	IF_NAME=$1
 
+	#find the first subnet which isn't assigned to an interface yet
+	USED_ADDRS=$(ip netns exec "$NETNS_NAME" ip -4 -o addr show)
+	SUBNET=0
+	while echo "$USED_ADDRS" | grep -q "inet 192\.168\.$SUBNET\."; do
+		SUBNET=$((SUBNET + 1))
+		if [ $SUBNET -gt 255 ]; then
+			return 1
+		fi
+	done
+	SERVER_IP="192.168.$SUBNET.100"
+
 	#move interface to recovery network namespace
 	ip link set "$IF_NAME" down
 	ip link set "$IF_NAME" netns "$NETNS_NAME"
 	ip netns exec "$NETNS_NAME" ip link set "$IF_NAME" up
 
-	#assign static ip to interface, setup ip route
-	ip netns exec "$NETNS_NAME" ip addr add dev "$IF_NAME" "$SERVER_IP"
+	#assign static ip to interface, this also routes the subnet to it
+	ip netns exec "$NETNS_NAME" ip addr add dev "$IF_NAME" "$SERVER_IP/24"
 	ip netns exec "$NETNS_NAME" ip route add "255.255.255.255" dev "$IF_NAME"
-	ip netns exec "$NETNS_NAME" ip route add "$CLIENT_IP" dev "$IF_NAME"
 }
 
 
@@ -176,30 +186,26 @@ fi
 echo "Starting polling subprocess..."
 
 poll_interface () {
-	if_name=""
+	if_names=""
 
 	if [ -n "$USBPATH" ]; then
 		USB_DEVICES_PATH="/sys/bus/usb/devices"
 		if [ -d "$USB_DEVICES_PATH/$USBPATH:1.0/net" ]; then
-			if_name="$(ls -m $USB_DEVICES_PATH/$USBPATH:1.0/net 2>&1 || true)"
+			if_names="$(ls -m $USB_DEVICES_PATH/$USBPATH:1.0/net 2>&1 || true)"
 		elif [ -d "$USB_DEVICES_PATH/$USBPATH:2.0/net" ]; then
-			if_name="$(ls -m $USB_DEVICES_PATH/$USBPATH:2.0/net 2>&1 || true)"
+			if_names="$(ls -m $USB_DEVICES_PATH/$USBPATH:2.0/net 2>&1 || true)"
 		fi
 	else
+		#interfaces of all the boards, at the ROM code or SPL stage
 		UEVENTS=$(grep -s -l "DEVTYPE=usb_interface" /sys/class/net/*/device/uevent)
-		ROMNETDEV=$(grep -s -l "PRODUCT=$ROMUSB" $UEVENTS | cut -d '/' -f 5)
-		SPLNETDEV=$(grep -s -l "PRODUCT=$SPLUSB" $UEVENTS | cut -d '/' -f 5)
-
-		if [ -n "$ROMNETDEV" ]; then
-			if_name="$ROMNETDEV"
-		elif [ -n "$SPLNETDEV" ]; then
-			if_name="$SPLNETDEV"
+		if [ -n "$UEVENTS" ]; then
+			if_names=$(grep -s -l -e "PRODUCT=$ROMUSB" -e "PRODUCT=$SPLUSB" $UEVENTS | cut -d '/' -f 5)
 		fi
 	fi
 
-	if [ -n "$if_name" ]; then
-		config_interface  "$if_name" >/dev/null 2>&1
-	fi
+	for if_name in $if_names; do
+		config_interface "$if_name" >/dev/null 2>&1
+	done
 }
 
 #network namespace
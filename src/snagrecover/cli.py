@@ -20,6 +20,7 @@
 import sys
 import argparse
 from snagrecover import __version__
+from snagrecover import usb_stats
 from snagrecover.utils import cli_error, get_recovery, get_supported_socs
 import snagrecover.config as config
 import logging
@@ -72,11 +73,24 @@ Templates:
 		"--uart", help="use UART for AM335x recovery", metavar="/dev/ttyx"
 	)
 	optional.add_argument("--baudrate", help="UART baudrate", default=115200)
+	optional.add_argument(
+		"--uboot-baudrate",
+		help="UART baudrate used by SPL to receive U-Boot during AM335x UART "
+		"recovery, if SPL was built with a CONFIG_BAUDRATE different from --baudrate",
+		type=int,
+	)
 	optional.add_argument(
 		"--netns",
 		help="network namespace for AM335x USB recovery, defaults to 'snagbootnet'",
 		default="snagbootnet",
 	)
+	optional.add_argument(
+		"--am335x-boards",
+		help="number of boards to serve during AM335x USB recovery, "
+		"0 to serve boards until interrupted, defaults to 1",
+		type=int,
+		default=1,
+	)
 	optional.add_argument(
 		"--loglevel",
 		help="set loglevel",
@@ -85,6 +99,11 @@ Templates:
 	)
 	optional.add_argument("--logfile", help="set logfile", default="board_recovery.log")
 	optional.add_argument("--rom-usb", help="legacy, please use --usb-path")
+	optional.add_argument(
+		"--usb-stats",
+		help="log USB transfer statistics at the end of the recovery",
+		action="store_true",
+	)
 	optional.add_argument(
 		"--usb-path",
 		help="address of recovery USB device",
@@ -185,7 +204,12 @@ Templates:
 	logger.info(f"Starting recovery of {soc_model} board")
 
 	recovery = get_recovery(soc_family)
-	recovery()
+	if args.usb_stats:
+		usb_stats.enable()
+	try:
+		recovery()
+	finally:
+		usb_stats.log_summary()
 
 	logger.info(f"Done recovering {soc_model} board")
 	if args.loglevel != "silent":
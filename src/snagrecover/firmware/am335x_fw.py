@@ -19,24 +19,16 @@
 
 from snagrecover.config import recovery_config
 from snagrecover.protocols import bootp
-import socketserver
-import socket
+from snagrecover.protocols import tftp
+from snagrecover.protocols import ymodem
+import asyncio
 import time
+from dataclasses import dataclass
 import logging
 
 logger = logging.getLogger("snagrecover")
-from xmodem import XMODEM
-
-# setting this logger to the same format as the main
-# logger since it sometimes prints out messages that seem
-# like fatal errors but are apparently benign
-xmodem_logger = logging.getLogger("xmodem.XMODEM")
-xmodem_logger.parent = logger
-import tftpy
-import threading
 import os.path
 import collections
-import errno
 
 server_config = {
 	"listen": "0.0.0.0",
@@ -47,133 +39,223 @@ server_config = {
 	# used in the am335x helper scripts
 	"server_ip": "192.168.0.100",
 	"client_ip": "192.168.0.101",
+	# If the address of the interface a board is connected to is known,
+	# the board is assigned an address in the same /24 subnet, starting
+	# from this host number.
+	"client_host": 101,
+	# firmware served depending on the vendor class of BOOTP requests
+	"vendor_classes": {"AM335x ROM": "spl", "AM335x U-Boot SPL": "u-boot"},
 	"bootp_port": 9067,
-	"bootp_timeout": 10,
 	"tftp_port": 9069,
 	"tftp_start_timeout": 30,
 	"tftp_complete_timeout": 180,
+	# upper bounds for the TFTP options requested by the board, the ROM
+	# code doesn't request any, U-Boot does if configured to
+	"tftp_blksize": tftp.ETHERNET_BLKSIZE,
+	"tftp_windowsize": 16,
+	# timeout in seconds before resending unacknowledged TFTP blocks
+	"tftp_timeout": 1,
+	"tftp_retries": 5,
 }
 
 
-def tftp_proc(server: tftpy.TftpServer):
-	logger.info("Starting TFTP server...")
-	tftp_port = server_config["tftp_port"]
-	server.listen(server_config["listen"], tftp_port, timeout=1)
-	logger.info("TFTP server finished")
-
-
-def bootp_proc(server: socketserver.UDPServer):
-	logger.info("Starting BOOTP server...")
-	server.serve_forever()
-	logger.info("BOOTP server finished")
-
-
-class UDPHandler(socketserver.BaseRequestHandler):
-	def handle(self):
-		data = self.request[0].strip()
-		sock = self.request[1]
-		sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-		logger.debug(f"packet from {self.client_address[0]}")
-		bootp_req = bootp.BootpRequest(data)
-		bootp_req.log()
-		fw_name = self.server.fw_name
-		# address that the client will use as its IP source in further communications
-		assigned_client_ip = server_config["client_ip"]
-		# address that the board can use to contact the bootp and tftp servers
-		server_ip = server_config["server_ip"]
-		filename = os.path.basename(recovery_config["firmware"][fw_name]["path"])
-		reply = bootp_req.build_reply(assigned_client_ip, server_ip, filename)
-		try:
-			sock.sendto(reply, ("<broadcast>", self.client_address[1]))
-		except OSError as err:
-			if err.errno == errno.ENETUNREACH:
-				logger.warning("Error in UDP handler: network is unreachable")
-			else:
-				raise err
+@dataclass
+class Lease:
+	client_ip: str
+	server_ip: str
+	fw_name: str
+	# time since which the board hasn't had a TFTP transfer running, None
+	# while it has one
+	waiting_since: float | None = None
 
 
-def am335x_usb(port, fw_name: str):
-	tftp_start_timeout = server_config["tftp_start_timeout"]
-	tftp_complete_timeout = server_config["tftp_complete_timeout"]
-	# TFTP server thread
-	tftp_server = tftpy.TftpServer(
-		os.path.dirname(recovery_config["firmware"][fw_name]["path"])
-	)
-	tftp_thread = threading.Thread(
-		name="Recovery TFTP server for AM335x", target=tftp_proc, args=[tftp_server]
-	)
-	tftp_thread.daemon = True
-
-	# BOOTP server thread
-	listen_address = server_config["listen"]
-	bootp_port = server_config["bootp_port"]
-	bootp_server = socketserver.UDPServer((listen_address, bootp_port), UDPHandler)
-	bootp_server.timeout = server_config["bootp_timeout"]
-	bootp_server.fw_name = fw_name
-	bootp_thread = threading.Thread(
-		name="Recovery BOOTP server for AM335x", target=bootp_proc, args=[bootp_server]
-	)
-	bootp_thread.daemon = True
-
-	logger.info("Starting TFTP server...")
-	tftp_thread.start()
-	logger.info("Starting BOOTP server...")
-	bootp_thread.start()
+class AM335xNetboot:
+	"""
+	BOOTP and TFTP service for AM335x USB recovery, shared by all the boards
+	being recovered. Boards are identified by the MAC address in their BOOTP
+	requests, and each one is assigned its own IP address, in the subnet of
+	the interface it is connected to.
 
-	t0 = time.time()
-	while tftp_server.sessions == {}:
-		if time.time() - t0 > tftp_start_timeout:
-			raise Exception("Timeout waiting for TFTP request")
-		time.sleep(0.1)
-	t0 = time.time()
+	The firmware served to a board depends on the vendor class of its BOOTP
+	requests, so that boards can be at different stages of the recovery:
+	the ROM code is served SPL and SPL is served U-Boot.
+	"""
 
-	bootp_server.shutdown()
-	bootp_server.server_close()
-	logger.info("Waiting for BOOTP server to stop...")
+	def __init__(self, fw_names: list):
+		self.fw_names = fw_names
+		self.leases = {}
+		# number of firmwares transferred to each MAC address
+		self.progress = {}
+		self.recovered = set()
+		# boards which didn't send a TFTP request in time after their lease
+		self.failed = set()
+		self.bootp = bootp.BootpServer(self.lease)
+		self.tftp = tftp.TFTPServer(
+			{
+				fw_name: recovery_config["firmware"][fw_name]["path"]
+				for fw_name in fw_names
+			},
+			max_blksize=server_config["tftp_blksize"],
+			max_windowsize=server_config["tftp_windowsize"],
+			timeout=server_config["tftp_timeout"],
+			retries=server_config["tftp_retries"],
+			on_complete=self.transfer_done,
+		)
 
-	while tftp_server.sessions != {}:
-		if time.time() - t0 > tftp_complete_timeout:
-			raise Exception("Timeout waiting for TFTP transfer to complete")
-		time.sleep(0.1)
+	def get_fw_name(self, bootp_req: bootp.BootpRequest) -> str:
+		fw_name = server_config["vendor_classes"].get(bootp_req.vendor_class)
+		if fw_name in self.fw_names:
+			return fw_name
 
-	# Note that this will not interrupt a tftp transfer in progress
-	tftp_server.stop()
-	logger.info("Waiting for TFTP server to stop...")
+		# unknown stage, serve the firmwares in order
+		progress = self.progress.get(bootp_req.chaddr, 0)
+		return self.fw_names[min(progress, len(self.fw_names) - 1)]
 
-	logger.info("Waiting for BOOTP shutdown...")
-	bootp_thread.join()
-	logger.info("Waiting for TFTP shutdown...")
-	tftp_thread.join()
+	def allocate_ip(self, server_ip: str, local_ip: str) -> str:
+		if local_ip is None:
+			# the interface is unknown, so only one board can be served
+			return server_config["client_ip"]
 
+		prefix = server_ip.rsplit(".", 1)[0]
+		used = {lease.client_ip for lease in self.leases.values()}
+		for host in range(server_config["client_host"], 255):
+			client_ip = f"{prefix}.{host}"
+			if client_ip not in used and client_ip != server_ip:
+				return client_ip
 
-xmodem_total_size = 0
+		raise Exception(f"No IP address left to assign in {prefix}.0/24")
 
+	def lease(self, bootp_req: bootp.BootpRequest, local_ip: str) -> tuple:
+		fw_name = self.get_fw_name(bootp_req)
+		lease = self.leases.get(bootp_req.chaddr)
+		if lease is None:
+			server_ip = local_ip or server_config["server_ip"]
+			client_ip = self.allocate_ip(server_ip, local_ip)
+			lease = Lease(client_ip, server_ip, fw_name, time.monotonic())
+			self.leases[bootp_req.chaddr] = lease
+			# a board which timed out may retry
+			self.failed.discard(bootp_req.chaddr)
+			# let serve() schedule the start timeout of this board
+			self.tftp.transfers_changed.set()
+			logger.info(
+				f"Board {bootp_req.chaddr} ({bootp_req.vendor_class or 'no vendor class'}) "
+				f"assigned {client_ip}, serving {fw_name}"
+			)
 
-def xmodem_callback(total_packets: int, success_count: int, error_count: int):
-	"""
-	This is called during the xmodem transfer,
-	it prints a progress bar
-	"""
-	global xmodem_total_size
-	progress = int(100 * total_packets * 1.0 / xmodem_total_size)
-	print(f"\rprogress: {progress}%", end="")
+		lease.fw_name = fw_name
+		# the filename is only used to find the firmware in TFTP requests
+		return (lease.client_ip, lease.server_ip, fw_name)
+
+	def transfer_done(self, name: str, client: tuple):
+		mac = next(
+			(mac for mac, lease in self.leases.items() if lease.client_ip == client[0]),
+			None,
+		)
+		if mac is None:
+			return
+
+		# the next stage may use another MAC address, don't hold its IP
+		del self.leases[mac]
+		self.failed.discard(mac)
+		self.progress[mac] = self.fw_names.index(name) + 1
+		if name == self.fw_names[-1]:
+			self.recovered.add(mac)
+			logger.info(f"Board {mac} done, {len(self.recovered)} board(s) served")
+
+	def check_leases(self, boards: int) -> float | None:
+		"""
+		Fail the boards which haven't sent a TFTP request within
+		tftp_start_timeout of getting their lease, or of the end of their
+		last transfer. Return the time left before the next one would fail,
+		None if no board is waiting.
+		"""
+		now = time.monotonic()
+		start_timeout = server_config["tftp_start_timeout"]
+		active = {client[0] for client in self.tftp.transfers}
+		next_timeout = None
+		for mac, lease in list(self.leases.items()):
+			if lease.client_ip in active:
+				lease.waiting_since = None
+				continue
+			if lease.waiting_since is None:
+				lease.waiting_since = now
+
+			remaining = lease.waiting_since + start_timeout - now
+			if remaining > 0:
+				next_timeout = min(remaining, next_timeout or remaining)
+				continue
+
+			if boards == 1:
+				raise Exception("Timeout waiting for TFTP request")
+			logger.error(f"Board {mac}: timeout waiting for TFTP request")
+			del self.leases[mac]
+			self.failed.add(mac)
+
+		return next_timeout
+
+	async def serve(self, boards: int):
+		"""
+		Serve boards until the last firmware has been transferred to the
+		given number of boards, or forever if it is 0. Boards which don't
+		send a TFTP request in time after getting their BOOTP lease count
+		as failed, the other ones are still served.
+		"""
+		logger.info("Starting TFTP server...")
+		await self.tftp.start(server_config["listen"], server_config["tftp_port"])
+		logger.info("Starting BOOTP server...")
+		await self.bootp.start(server_config["listen"], server_config["bootp_port"])
+		# a single board is expected to show up right away, several ones
+		# can be plugged in one by one
+		idle_timeout = server_config["tftp_start_timeout"] if boards == 1 else None
+
+		try:
+			while boards == 0 or len(self.recovered) + len(self.failed) < boards:
+				lease_timeout = self.check_leases(boards)
+				if self.tftp.transfers:
+					timeout = server_config["tftp_complete_timeout"]
+					msg = "Timeout waiting for TFTP transfer to complete"
+				elif not self.leases:
+					timeout, msg = idle_timeout, "Timeout waiting for TFTP request"
+				else:
+					timeout, msg = None, None
+				if lease_timeout is not None and (
+					timeout is None or lease_timeout < timeout
+				):
+					# the waiting board is failed by check_leases()
+					timeout, msg = lease_timeout, None
+
+				self.tftp.transfers_changed.clear()
+				try:
+					await asyncio.wait_for(self.tftp.transfers_changed.wait(), timeout)
+				except asyncio.TimeoutError:
+					if msg is not None:
+						raise Exception(msg) from None
+		finally:
+			logger.info("Stopping BOOTP and TFTP servers...")
+			self.bootp.close()
+			self.tftp.close()
+
+		if self.failed:
+			raise Exception(f"{len(self.failed)} board(s) failed to be served")
+
+
+def am335x_netboot(fw_names: list, boards: int = 1):
+	asyncio.run(AM335xNetboot(fw_names).serve(boards))
+
+
+def am335x_usb(port, fw_name: str):
+	am335x_netboot([fw_name])
+
+
+def print_progress(sent: int, size: int):
+	print(f"\rprogress: {100 * sent // size}%", end="")
 
 
 def am335x_uart(port, fw_name: str):
 	TRANSFER_WAIT_TIMEOUT = 30
-	global xmodem_total_size
-	if fw_name == "u-boot":
-		print("Transfering U-Boot over a UART connection, this could take a while...")
 	port.write_timeout = 5
-	port.timeout = 5
-
-	def getc(size, timeout=1):
-		return port.read(size) or None
-
-	def putc(data, timeout=1):
-		return port.write(data)
+	port.timeout = 1
 
-	modem = XMODEM(getc, putc)
 	"""
 	snagrecover sometimes confuses standard SPL console output
 	with xmodem pings (see issue #14), we wait for three pings
@@ -187,12 +269,18 @@ def am335x_uart(port, fw_name: str):
 		if time.time() - t0 > TRANSFER_WAIT_TIMEOUT:
 			raise Exception("Timeout waiting for UART pings")
 	fw_path = recovery_config["firmware"][fw_name]["path"]
-	xmodem_total_size = int(os.path.getsize(fw_path) / 128)
+	size = os.path.getsize(fw_path)
+	sender = ymodem.ModemSender(port, callback=print_progress)
 	with open(fw_path, "rb") as file:
-		logger.info(f"Transfering {fw_path} using xmodem...")
-		modem.send(file, callback=xmodem_callback)
+		if fw_name == "u-boot":
+			# SPL's loader supports YMODEM with 1K blocks
+			logger.info(f"Transfering {fw_path} using ymodem...")
+			sender.send(file, size, name=os.path.basename(fw_path))
+		else:
+			logger.info(f"Transfering {fw_path} using xmodem...")
+			sender.send(file, size, block_size=ymodem.SHORT_BLOCK_SIZE)
 		print("")
-	logger.info("xmodem transfer done")
+	logger.info("transfer done")
 
 
 def am335x_run(port, fw_name: str):
@@ -49,6 +49,7 @@ from snagrecover.protocols.amlogic import (
 	run,
 	get_next_AMLC_block,
 	write_AMLC_block,
+	AMLSChecksums,
 	write_blob_simple_memory,
 	ROM_STAGE_MINOR,
 	ROM_STAGE_MINOR_SPL,
@@ -150,6 +151,10 @@ def protocol_1_run(port, fw_name: str, fw_blob: bytes, subfw_name: str) -> None:
 		prev_offset = -1
 		seq = 0
 		uboot_fip_size = len(fw_blob)
+		# requested blocks are served as slices of the firmware, with
+		# checksums computed before BL2 starts requesting them
+		fip = memoryview(fw_blob)
+		checksums = AMLSChecksums(fip)
 
 		(length, offset) = get_next_AMLC_block(port)
 		while (length, offset) != (prev_length, prev_offset):
@@ -176,7 +181,10 @@ def protocol_1_run(port, fw_name: str, fw_blob: bytes, subfw_name: str) -> None:
 				logger.critical(ve)
 				raise ve
 
-			write_AMLC_block(port, seq, offset, fw_blob[offset : offset + length])
+			block = fip[offset : offset + length]
+			write_AMLC_block(
+				port, seq, offset, block, checksums.checksum(block, offset)
+			)
 
 			(prev_length, prev_offset) = (length, offset)
 			seq += 1
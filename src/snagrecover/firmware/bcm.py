@@ -1,4 +1,7 @@
+import hashlib
 import logging
+import mmap
+import os
 import tarfile
 import struct
 
@@ -10,10 +13,9 @@ from snagrecover.firmware.fat import FAT
 from io import BytesIO
 from pathlib import Path
 from os.path import normpath
-from tempfile import TemporaryDirectory
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 from shutil import copy2
 from time import sleep
-from contextlib import nullcontext
 from snagrecover.firmware.firmware import load_fw, get_fw_path
 from snagrecover.protocols.bcm import (
 	rom_code_send_file,
@@ -23,6 +25,7 @@ from snagrecover.protocols.bcm import (
 	bootcode_send_file,
 )
 from snagrecover.config import recovery_config
+from snagrecover import __version__
 
 SNAGRECOVER_CONFIG_SECTION = """
 # Start of settings added by snagrecover
@@ -32,95 +35,161 @@ arm_64bit=1
 # End of settings added by snagrecover
 """
 
+BOOT_FW_HASH_CHUNK_SIZE = 0x100000
+# Part of the keys of cached 'boot' firmwares, along with the snagboot
+# version. Bump it when the output of modify_boot_fw() or of the FAT writer
+# changes.
+BOOT_FW_PATCH_VERSION = 1
+# number of patched 'boot' firmwares kept in the cache, least recently used
+# ones are deleted first
+BOOT_FW_CACHE_ENTRIES = 4
 
-def tar_getmember(tar: bytes | tarfile.TarFile, member_path: str) -> tarfile.TarInfo:
-	"""
-	return member (TarInfo) from tar archive.
-
-	raise KeyError if member_path is not found in tar  archive.
-	"""
-
-	if isinstance(tar, tarfile.TarFile):
-		bytes_context = nullcontext()
-		tar_context = nullcontext(tar)
-	else:
-		bytes_context = BytesIO(tar)
-		tar_context = tarfile.open(fileobj=bytes_context)
-
-	with bytes_context, tar_context as tar_file:
-		members_names = tar_file.getnames()
-
-		# tar archive allows to update a file without recreating all the archive.
-		# To do so, it append the new version to the archive, keeping the old version inside the archive.
-		# We want to have the last version of a given file, look at lastly added file first (reverse).
-		members_names.reverse()
-		if len(members_names) == 0:
-			err_msg = f"tar archive is empty, can't contain '{member_path}'"
-			logger.warning(err_msg)
-			raise KeyError(err_msg)
-
-		for member_name in members_names:
-			# Fix an "issue" where `tar_file.getmember("bootcode4.bin")` doesn't find "./bootcode4.bin" (and vice versa) inside the archive.
-			# Depending on how you create the tar archive, file can be prepended with "./".
-			if normpath(member_path) == normpath(member_name):
-				if member_path != member_name:
-					logger.debug(
-						f"Tar member '{member_name}' match '{member_path}' using normalized path '{normpath(member_path)}'"
-					)
-				return tar_file.getmember(member_name)
-
-		_norm_path = (
-			f" ({normpath(member_path)})"
-			if normpath(member_path) != member_path
-			else ""
-		)
-		raise KeyError(f"{member_path}{_norm_path} is not present in the tar archive")
 
-
-def tar_member_exist(tar: bytes | tarfile.TarFile, member_path: str) -> bool:
+def decompress_tar(tar_blob: bytes) -> bytes:
 	"""
-	Test if member_path is present in the given archive.
+	Return the uncompressed content of a tar archive.
 	"""
-	file_exists = False
 	try:
-		tar_getmember(tar, member_path)
-		file_exists = True
-	except KeyError:
+		with (
+			BytesIO(tar_blob) as tar_bin_file,
+			tarfile.open(fileobj=tar_bin_file, mode="r:"),
+		):
+			return tar_blob
+	except tarfile.ReadError:
 		pass
 
-	return file_exists
+	if tar_blob.startswith(b"\x1f\x8b"):
+		import gzip
+
+		return gzip.decompress(tar_blob)
+	elif tar_blob.startswith(b"BZh"):
+		import bz2
+
+		return bz2.decompress(tar_blob)
+	elif tar_blob.startswith(b"\xfd7zXZ\x00"):
+		import lzma
 
+		return lzma.decompress(tar_blob)
 
-def tar_extract_file(tar_blob: bytes, file_path: str) -> bytes:
+	raise tarfile.ReadError(
+		"'bootfiles' is not a tar archive, or is compressed with an unsupported format"
+	)
+
+
+class BootFiles:
 	"""
-	Extract file_path from tar_blob tar archive. file_path must point to a file/link inside tar_blob.
-	raise ValueError if file_path is not a file/link (ie if extractfile returns None)
+	Index of the members of the 'bootfiles' tar archive, so that the archive
+	is only parsed once, however many files bootcode requests. Compressed
+	archives are decompressed once. Files are served as slices of the
+	uncompressed archive, without copies.
 	"""
-	with (
-		BytesIO(tar_blob) as bootfiles_bin_file,
-		tarfile.open(fileobj=bootfiles_bin_file) as tar_file,
-	):
-		member = tar_getmember(tar_file, file_path)
-		member = tar_file.extractfile(member)
+
+	def __init__(self, tar_blob: bytes):
+		self.tar_blob = tar_blob
+		self.tar = decompress_tar(tar_blob)
+		self.members = {}
+
+		with (
+			BytesIO(self.tar) as tar_bin_file,
+			tarfile.open(fileobj=tar_bin_file, mode="r:") as tar_file,
+		):
+			# tar archive allows to update a file without recreating all the archive.
+			# To do so, it append the new version to the archive, keeping the old version inside the archive.
+			# We want to have the last version of a given file, so later members replace earlier ones.
+			# Paths are normalized, since depending on how you create the tar archive,
+			# file can be prepended with "./".
+			for member in tar_file:
+				self.members[normpath(member.name)] = member
+
+		if len(self.members) == 0:
+			logger.warning("'bootfiles' tar archive is empty")
+
+	def getmember(self, member_path: str) -> tarfile.TarInfo:
+		"""
+		return member (TarInfo) from tar archive.
+
+		raise KeyError if member_path is not found in tar  archive.
+		"""
+		member = self.members.get(normpath(member_path))
 		if member is None:
+			_norm_path = (
+				f" ({normpath(member_path)})"
+				if normpath(member_path) != member_path
+				else ""
+			)
+			raise KeyError(
+				f"{member_path}{_norm_path} is not present in the tar archive"
+			)
+
+		if member.name != member_path:
+			logger.debug(
+				f"Tar member '{member.name}' match '{member_path}' using normalized path '{normpath(member_path)}'"
+			)
+		return member
+
+	def member_exist(self, member_path: str) -> bool:
+		"""
+		Test if member_path is present in the archive.
+		"""
+		return normpath(member_path) in self.members
+
+	def extract_file(self, file_path: str) -> memoryview:
+		"""
+		Return the content of file_path. file_path must point to a file/link inside the archive.
+		raise ValueError if file_path is not a file/link
+		"""
+		member = self.getmember(file_path)
+		# follow links, at most once per member to avoid loops
+		for _ in range(len(self.members)):
+			if member.issym():
+				member = self.getmember(
+					os.path.join(os.path.dirname(member.name), member.linkname)
+				)
+			elif member.islnk():
+				member = self.getmember(member.linkname)
+			else:
+				break
+
+		if not member.isreg():
 			raise ValueError(
 				f"{file_path} exists in tar archive but is is not a file or link"
 			)
-		file_bytes = member.read(-1)
 
-	return file_bytes
+		if member.sparse is not None:
+			with (
+				BytesIO(self.tar) as tar_bin_file,
+				tarfile.open(fileobj=tar_bin_file, mode="r:") as tar_file,
+			):
+				return memoryview(tar_file.extractfile(member).read(-1))
+
+		return memoryview(self.tar)[
+			member.offset_data : member.offset_data + member.size
+		]
+
+
+# 'bootfiles' is loaded once per stage of the recovery, keep its index
+last_bootfiles = None
+
+
+def get_bootfiles(tar_blob: bytes) -> BootFiles:
+	global last_bootfiles
+
+	if last_bootfiles is None or last_bootfiles.tar_blob != tar_blob:
+		last_bootfiles = BootFiles(tar_blob)
+
+	return last_bootfiles
 
 
 def get_fileblob_from_bootfiles(
-	tar_blob: bytes, file_name: str, file_paths: [str]
-) -> bytes:
+	bootfiles: BootFiles, file_name: str, file_paths: [str]
+) -> memoryview:
 	"""
-	tar_blob: bootfiles tar archive
+	bootfiles: bootfiles tar archive
 	file_name: name of file, used for logging
 	file_paths: paths to look for file_name inside the tar archive
 	"""
 	logger.debug(f"Searching for {file_paths} in 'bootfiles'")
-	file_exist_paths = [x for x in file_paths if tar_member_exist(tar_blob, x)]
+	file_exist_paths = [x for x in file_paths if bootfiles.member_exist(x)]
 	logger.debug(f"Found {file_exist_paths} in 'bootfiles'")
 	if len(file_exist_paths) == 0:
 		err_msg = (
@@ -137,7 +206,7 @@ def get_fileblob_from_bootfiles(
 
 	logger.debug(f"Extracting '{file_name}' from 'bootfiles'...")
 	try:
-		return tar_extract_file(tar_blob, file_path)
+		return bootfiles.extract_file(file_path)
 	except ValueError as ve:
 		err_msg = f"'bootfile'/{file_path} exists but is is not a file or link"
 		logger.critical(err_msg)
@@ -310,6 +379,167 @@ def modify_boot_fw(boot_path: str, uboot_blob: bytes) -> None:
 		logger.debug(f"'boot' firmware '/' directory content: {bootimgfs.list_files()}")
 
 
+def get_cache_dir() -> Path:
+	"""
+	Return the directory where patched 'boot' firmwares are cached,
+	SNAGBOOT_CACHE_DIR if set, else a snagboot subdirectory of the user's
+	cache directory.
+	"""
+	cache_dir = os.environ.get("SNAGBOOT_CACHE_DIR")
+	if cache_dir:
+		return Path(cache_dir)
+
+	cache_home = os.environ.get("XDG_CACHE_HOME") or (Path.home() / ".cache")
+	return Path(cache_home) / "snagboot"
+
+
+def patched_boot_fw_key(boot_path: str, uboot_blob: bytes) -> str:
+	"""
+	Return a key identifying the result of modify_boot_fw(): a hash of the
+	hashes of its inputs and of the version of the code patching them.
+	"""
+	boot_hash = hashlib.sha256()
+	with open(boot_path, "rb") as boot_file:
+		while chunk := boot_file.read(BOOT_FW_HASH_CHUNK_SIZE):
+			boot_hash.update(chunk)
+
+	key = hashlib.sha256(boot_hash.digest())
+	key.update(hashlib.sha256(uboot_blob).digest())
+	key.update(hashlib.sha256(SNAGRECOVER_CONFIG_SECTION.encode("ascii")).digest())
+	key.update(f"{__version__}/{BOOT_FW_PATCH_VERSION}".encode("ascii"))
+	return key.hexdigest()
+
+
+def prune_boot_fw_cache(cache_dir: Path):
+	"""
+	Delete the least recently used patched 'boot' firmwares, keeping
+	BOOT_FW_CACHE_ENTRIES of them.
+	"""
+	entries = []
+	for path in cache_dir.glob("boot-*.img"):
+		try:
+			entries.append((path.stat().st_mtime, path))
+		except OSError:
+			# deleted by a concurrent recovery
+			continue
+
+	entries.sort(reverse=True)
+	for _, path in entries[BOOT_FW_CACHE_ENTRIES:]:
+		logger.debug(f"Deleting cached 'boot' firmware {path}")
+		try:
+			path.unlink()
+		except OSError as err:
+			logger.warning(f"Failed to delete cached 'boot' firmware {path}: {err}")
+
+
+def get_patched_boot_fw(boot_path: str, uboot_blob: bytes, tempdir: str) -> str:
+	"""
+	Return the path of a copy of 'boot_path' modified by modify_boot_fw().
+	Copies are cached, keyed by the content of their inputs, so that the
+	same image is only patched once. If the cache can't be written to, the
+	copy is made in tempdir.
+	"""
+	key = patched_boot_fw_key(boot_path, uboot_blob)
+	cache_dir = get_cache_dir() / "bcm"
+	cached_path = cache_dir / f"boot-{key}.img"
+	if cached_path.exists():
+		logger.info(f"Using cached updated 'boot' firmware ({cached_path})")
+		try:
+			# mark it as recently used
+			os.utime(cached_path)
+		except OSError:
+			pass
+		return str(cached_path)
+
+	try:
+		cache_dir.mkdir(parents=True, exist_ok=True)
+		# recoveries can run in parallel, so the image is patched under a
+		# temporary name and then atomically moved to its final path
+		with NamedTemporaryFile(dir=cache_dir, suffix=".tmp", delete=False) as tmp:
+			tmp_path = tmp.name
+	except OSError as err:
+		logger.warning(f"Failed to create cache directory {cache_dir}: {err}")
+		cached_path = Path(tempdir) / "boot.img"
+		tmp_path = str(cached_path)
+
+	logger.info(f"Copying 'boot' firmware to {cached_path} and updating it")
+	try:
+		copy2(boot_path, tmp_path)
+		modify_boot_fw(tmp_path, uboot_blob)
+		os.replace(tmp_path, cached_path)
+	except BaseException:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+		raise
+
+	if cached_path.parent == cache_dir:
+		# copy2() kept the modification time of the original image
+		os.utime(cached_path)
+		prune_boot_fw_cache(cache_dir)
+	return str(cached_path)
+
+
+def serve_bootcode_requests(
+	port,
+	bootfiles: BootFiles,
+	subfolder_name: str,
+	boot_fw_path: str | None = None,
+	boot_blob=None,
+) -> None:
+	"""
+	bootcode functions as a file client. It issues requests (GET_FILE_SIZE, GET_FILE) that we must serve.
+
+	Procedure is as follows:
+	1. get command and file name (bootcode_get_command)
+	2. GET_FILE_SIZE command: send file size (bootcode_send_file_size)
+	3. GET_FILE command: send file (bootcode_send_file)
+	4. repeat above steps until DONE command
+
+	If boot_blob is given, it is served instead of the 'boot' firmware.
+	"""
+	logger.info("Serving bootcode requests...")
+	command, file_name = bootcode_get_command(port)
+	previous_file_name, previous_fw_blob = None, None
+	while command != BootcodeCommand.DONE:
+		logger.debug(f"Serving command '{command!r}' on requested file '{file_name}'")
+
+		if file_name == previous_file_name:
+			# We expect GET_FILE_SIZE then GET_FILE on the same file, save us from reloading the blob
+			requested_fw_blob = previous_fw_blob
+		elif file_name in ["boot.img", "config.txt"]:
+			firmware_name = Path(file_name).stem
+			if firmware_name == "boot" and boot_blob is not None:
+				file_path = boot_fw_path
+				requested_fw_blob = boot_blob
+			else:
+				file_path = get_fw_path(firmware_name)
+				requested_fw_blob = load_fw(
+					firmware_name, check_fw=(file_name != "config.txt")
+				)
+			logger.debug(
+				f"'Requested file is '{file_name}', using firmware '{firmware_name}' ({file_path})"
+			)
+		else:
+			file_paths = [f"{subfolder_name}/{file_name}", file_name]
+			requested_fw_blob = get_fileblob_from_bootfiles(
+				bootfiles, file_name, file_paths
+			)
+
+		if command == BootcodeCommand.GET_FILE_SIZE:
+			bootcode_send_file_size(port, requested_fw_blob)
+		elif command == BootcodeCommand.GET_FILE:
+			bootcode_send_file(port, requested_fw_blob)
+			logger.info(f"Served requested file for '{file_name}'")
+			if file_name == "boot.img":
+				logger.info("Waiting for 'boot' firmware to load...")
+				sleep(3)
+
+		previous_file_name, previous_fw_blob = file_name, requested_fw_blob
+		(command, file_name) = bootcode_get_command(port)
+
+	logger.info("Done serving bootcode requests")
+
+
 def bcm_run(port, fw_name: str, fw_blob: bytes, subfw_name: str) -> None:
 	if fw_name != "bootfiles":
 		# sanity check, right now we only have 'bootfiles' firmware
@@ -317,7 +547,7 @@ def bcm_run(port, fw_name: str, fw_blob: bytes, subfw_name: str) -> None:
 		logger.critical(err_msg)
 		raise ValueError(err_msg)
 
-	tar_blob = fw_blob
+	bootfiles = get_bootfiles(fw_blob)
 	soc_model = recovery_config["soc_model"]
 	if soc_model == "bcm2711":
 		subfolder_name = "2711"
@@ -332,7 +562,7 @@ def bcm_run(port, fw_name: str, fw_blob: bytes, subfw_name: str) -> None:
 	if subfw_name == "bootcode":
 		bootcode_paths = [f"{subfolder_name}/{bootcode_name}", bootcode_name]
 		bootcode_blob = get_fileblob_from_bootfiles(
-			tar_blob, bootcode_name, bootcode_paths
+			bootfiles, bootcode_name, bootcode_paths
 		)
 
 		logger.info(f"Sending 'bootfiles'/{bootcode_name} to ROM Code...")
@@ -343,76 +573,29 @@ def bcm_run(port, fw_name: str, fw_blob: bytes, subfw_name: str) -> None:
 
 	elif subfw_name == "bootcode_firmwares":
 		# Also handle firmwares 'boot' and 'u-boot'
-		"""
-		bootcode functions as a file client. It issues requests (GET_FILE_SIZE, GET_FILE) that we must serve.
-
-		Procedure is as follows:
-		1. get command and file name (bootcode_get_command)
-		2. GET_FILE_SIZE command: send file size (bootcode_send_file_size)
-		3. GET_FILE command: send file (bootcode_send_file)
-		4. repeat above steps until DONE command
-		"""
-
 		if should_modify_boot_fw():
-			boot_fw_path = get_fw_path("boot")
-			tempdir = TemporaryDirectory()
-			boot_fw_path_copy = copy2(boot_fw_path, f"{tempdir.name}/boot.img")
 			logger.info(
-				"U-Boot found in recovery config, copying 'boot' firmware and update it"
+				"U-Boot found in recovery config, using a 'boot' firmware updated with it"
 			)
-			uboot_blob = load_fw("u-boot")
-			modify_boot_fw(boot_fw_path_copy, uboot_blob)
+			with (
+				TemporaryDirectory() as tempdir,
+				open(
+					get_patched_boot_fw(
+						get_fw_path("boot"), load_fw("u-boot"), tempdir
+					),
+					"rb",
+				) as boot_file,
+				mmap.mmap(boot_file.fileno(), 0, access=mmap.ACCESS_READ) as boot_map,
+				memoryview(boot_map) as boot_blob,
+			):
+				serve_bootcode_requests(
+					port, bootfiles, subfolder_name, boot_file.name, boot_blob
+				)
 		else:
 			logger.debug(
 				"U-Boot not found in recovery config, use unmodified 'boot' firmware"
 			)
-
-		logger.info("Serving bootcode requests...")
-		command, file_name = bootcode_get_command(port)
-		previous_file_name, previous_fw_blob = None, None
-		while command != BootcodeCommand.DONE:
-			logger.debug(
-				f"Serving command '{command!r}' on requested file '{file_name}'"
-			)
-
-			if file_name == previous_file_name:
-				# We expect GET_FILE_SIZE then GET_FILE on the same file, save us from reloading the blob
-				requested_fw_blob = previous_fw_blob
-			elif file_name in ["boot.img", "config.txt"]:
-				firmware_name = Path(file_name).stem
-				if firmware_name == "boot" and should_modify_boot_fw():
-					file_path = boot_fw_path_copy
-					requested_fw_blob = Path(file_path).read_bytes()
-				else:
-					file_path = get_fw_path(firmware_name)
-					requested_fw_blob = load_fw(
-						firmware_name, check_fw=(file_name != "config.txt")
-					)
-				logger.debug(
-					f"'Requested file is '{file_name}', using firmware '{firmware_name}' ({file_path})"
-				)
-			else:
-				file_paths = [f"{subfolder_name}/{file_name}", file_name]
-				requested_fw_blob = get_fileblob_from_bootfiles(
-					tar_blob, file_name, file_paths
-				)
-
-			if command == BootcodeCommand.GET_FILE_SIZE:
-				bootcode_send_file_size(port, requested_fw_blob)
-			elif command == BootcodeCommand.GET_FILE:
-				bootcode_send_file(port, requested_fw_blob)
-				logger.info(f"Served requested file for '{file_name}'")
-				if file_name == "boot.img":
-					logger.info("Waiting for 'boot' firmware to load...")
-					sleep(3)
-
-			previous_file_name, previous_fw_blob = file_name, requested_fw_blob
-			(command, file_name) = bootcode_get_command(port)
-
-		logger.info("Done serving bootcode requests")
-		if should_modify_boot_fw():
-			logger.debug(f"Cleanup temporary files ({boot_fw_path})")
-			tempdir.cleanup()
+			serve_bootcode_requests(port, bootfiles, subfolder_name)
 
 	else:
 		# sanity check
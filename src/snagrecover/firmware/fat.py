@@ -18,9 +18,12 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 #
 
-from snagrecover.utils import BinFileHeader, dnload_iter
-from dataclasses import dataclass
+from snagrecover.utils import BinFileHeader
+from dataclasses import astuple, dataclass
+from array import array
 from math import floor
+import struct
+import sys
 import logging
 
 logger = logging.getLogger("snagrecover")
@@ -144,16 +147,15 @@ def dirent_sub_name(dirent: FATDirent) -> tuple:
 	name_ord = 0
 
 	if dirent.Attr == FAT_ATTR_LONG_NAME:
-		dirent_bytes = bytearray()
-		FATDirent.write(dirent, dirent_bytes)
+		dirent_bytes = struct.pack(FATDirent.fmt, *astuple(dirent))
 
 		l_dirent = FATLongDirent.read(dirent_bytes)
 
 		name = l_dirent.Name1 + l_dirent.Name2 + l_dirent.Name3
 		name_ord = l_dirent.Ord
 	else:
-		if bytes(dirent.Name[0]) == b"\x05":
-			name = chr(b"\xe5") + dirent.Name[1:]
+		if dirent.Name[0:1] == b"\x05":
+			name = b"\xe5" + dirent.Name[1:]
 		else:
 			name = dirent.Name
 
@@ -176,6 +178,14 @@ class FAT:
 	"""
 	A minimal subset of FAT filesystem support. Handles creation and
 	deletion of top-level regular files.
+
+	The FAT and the root directory are loaded in memory when the filesystem
+	is opened. Free clusters are tracked in a bitmap and root directory
+	entries are indexed by name. Changes to the FAT and to the root
+	directory are only written back by flush(), which is called when
+	leaving the context manager without an exception. All copies of the
+	FAT are then updated. File data is written right away, in one write
+	per run of contiguous clusters.
 	"""
 
 	def __init__(self, path: str, offset: int):
@@ -200,13 +210,31 @@ class FAT:
 		else:
 			self.fat_type = 32
 
+		self.cluster_size = self.sec_to_bytes(self.bpb.SecPerClus)
+
+		self.fat = bytearray(
+			self.read_sectors(self.fat_copy_first_sector(0), self.get_fat_sz())
+		)
+		self.fat_dirty = False
+		self.load_free_clusters()
+
+		self.root_dir = self.read_root_dir()
+		self.root_dir_dirty = False
+		self.entries = {}
+		for f_entry in self.walk_root_dir():
+			self.entries[f_entry.name.lower()] = f_entry
+
 		logger.debug(f"FAT{self.fat_type} filesystem at {path}")
 
 	def __enter__(self):
 		return self
 
 	def __exit__(self, exc_type, exc_value, traceback):
-		self.fs.close()
+		try:
+			if exc_type is None:
+				self.flush()
+		finally:
+			self.fs.close()
 
 	def fat_eoc_value(self) -> bytes:
 		if self.fat_type == 12:
@@ -251,6 +279,20 @@ class FAT:
 		else:
 			return self.cluster_n_first_sector(self.bpb_tail.RootClus)
 
+	def fat_copy_first_sector(self, index: int) -> int:
+		return self.bpb.RsvdSecCnt + index * self.get_fat_sz()
+
+	def active_fat_copies(self) -> list:
+		"""
+		Return the indexes of the FAT copies to update. On FAT32, mirroring
+		can be disabled, in which case only the active FAT is used.
+		"""
+		ext_flags = int.from_bytes(self.bpb_tail.ExtFlags, "little")
+		if self.fat_type == 32 and ext_flags & 0x80:
+			return [ext_flags & 0xF]
+
+		return list(range(self.bpb.NumFATs))
+
 	#### I/O on self.fs BEGIN ####
 
 	"""
@@ -270,8 +312,61 @@ class FAT:
 	def read_sectors(self, start_sc, size_sc) -> bytes:
 		return self.read_bytes(self.sec_to_bytes(start_sc), self.sec_to_bytes(size_sc))
 
+	def read_root_dir(self) -> bytearray:
+		if self.fat_type in [12, 16]:
+			self.root_dir_clusters = None
+			return bytearray(
+				self.read_sectors(self.first_root_dir_sec(), self.root_dir_sectors())
+			)
+
+		self.root_dir_clusters = self.get_cluster_chain(self.bpb_tail.RootClus)
+		root_dir = bytearray()
+		for cluster in self.root_dir_clusters:
+			root_dir += self.read_sectors(
+				self.cluster_n_first_sector(cluster), self.bpb.SecPerClus
+			)
+		return root_dir
+
+	def flush(self):
+		"""
+		Write the in-memory FAT and root directory back to the filesystem.
+		"""
+		if self.fat_dirty:
+			for index in self.active_fat_copies():
+				self.write_bytes(
+					self.sec_to_bytes(self.fat_copy_first_sector(index)), self.fat
+				)
+			self.fat_dirty = False
+
+		if self.root_dir_dirty:
+			if self.root_dir_clusters is None:
+				self.write_bytes(
+					self.sec_to_bytes(self.first_root_dir_sec()), self.root_dir
+				)
+			else:
+				for i, cluster in enumerate(self.root_dir_clusters):
+					self.write_bytes(
+						self.sec_to_bytes(self.cluster_n_first_sector(cluster)),
+						self.root_dir[
+							i * self.cluster_size : (i + 1) * self.cluster_size
+						],
+					)
+			self.root_dir_dirty = False
+
+		self.fs.flush()
+
 	#### I/O on self.fs END ####
 
+	def read_dirent(self, dirent_pos: int) -> FATDirent:
+		"""
+		Read the root directory entry at dirent_pos, or an entry marking
+		the end of the directory if dirent_pos is past its end.
+		"""
+		if dirent_pos + FAT_DIRENT_SIZE > len(self.root_dir):
+			return FATDirent.read(bytes(FAT_DIRENT_SIZE))
+
+		return FATDirent.read(self.root_dir, dirent_pos)
+
 	def get_dirent_long_name(self, dirent: FATDirent, dirent_pos: int) -> str:
 		num_dirents = 1
 		name, name_ord = dirent_sub_name(dirent)
@@ -289,8 +384,7 @@ class FAT:
 		name_dirent_pos = dirent_pos + FAT_DIRENT_SIZE
 
 		while name_ord > 1:
-			dirent_bytes = self.read_bytes(name_dirent_pos, FAT_DIRENT_SIZE)
-			dirent = FATDirent.read(dirent_bytes)
+			dirent = self.read_dirent(name_dirent_pos)
 			sub_name, new_name_ord = dirent_sub_name(dirent)
 
 			assert new_name_ord == name_ord - 1
@@ -304,8 +398,7 @@ class FAT:
 		return name.decode("utf-16"), num_dirents
 
 	def get_file_entry(self, dirent_pos: int) -> tuple:
-		dirent_bytes = self.read_bytes(dirent_pos, FAT_DIRENT_SIZE)
-		dirent = FATDirent.read(dirent_bytes)
+		dirent = self.read_dirent(dirent_pos)
 
 		if dirent_is_free(dirent):
 			return FATFileEntry(dirent, dirent_pos, 1, None)
@@ -321,11 +414,11 @@ class FAT:
 
 		long_name, num_name_dirents = self.get_dirent_long_name(dirent, dirent_pos)
 
-		dirent_bytes = self.read_bytes(
-			dirent_pos + FAT_DIRENT_SIZE * num_name_dirents, FAT_DIRENT_SIZE
-		)
 		return FATFileEntry(
-			FATDirent.read(dirent_bytes), dirent_pos, 1 + num_name_dirents, long_name
+			self.read_dirent(dirent_pos + FAT_DIRENT_SIZE * num_name_dirents),
+			dirent_pos,
+			1 + num_name_dirents,
+			long_name,
 		)
 
 	def write_file_entry(self, f_entry: FATFileEntry):
@@ -336,41 +429,26 @@ class FAT:
 		if len(dirent.Name) < DIRENT_NAME_SIZE:
 			dirent.Name += b"\x00" * (DIRENT_NAME_SIZE - len(dirent.Name))
 
-		buf = bytearray()
-		FATDirent.write(dirent, buf)
-
-		self.write_bytes(f_entry.dirent_start, buf)
+		dirent.offset = f_entry.dirent_start
+		FATDirent.write(dirent, self.root_dir)
+		self.root_dir_dirty = True
 
 	def free_dirent(self, dirent_pos: int):
-		dirent_bytes = bytearray(self.read_bytes(dirent_pos, FAT_DIRENT_SIZE))
-
-		dirent = FATDirent.read(dirent_bytes)
+		dirent = self.read_dirent(dirent_pos)
 
 		if dirent.Attr & FAT_ATTR_LONG_NAME != FAT_ATTR_LONG_NAME:
 			clusters = self.get_clusters(dirent)
 			for cluster in clusters:
 				self.write_cluster_fat(cluster, 0)
 
-		dirent.Name = b"\xe5"
-
-		FATDirent.write(dirent, dirent_bytes)
-
-		self.write_bytes(dirent_pos, dirent_bytes)
+		self.root_dir[dirent_pos] = 0xE5
+		self.root_dir_dirty = True
 
 	def walk_root_dir(self):
-		dirent_pos = self.sec_to_bytes(self.first_root_dir_sec())
+		dirent_pos = 0
 		entries = []
 
-		f_entry = self.get_file_entry(dirent_pos)
-		if is_last_dirent(f_entry.dirent):
-			return entries
-
-		if not dirent_is_free(f_entry.dirent):
-			entries.append(f_entry)
-
-		dirent_pos += f_entry.num_dirents * FAT_DIRENT_SIZE
-
-		while True:
+		while dirent_pos < len(self.root_dir):
 			f_entry = self.get_file_entry(dirent_pos)
 			dirent_pos += f_entry.num_dirents * FAT_DIRENT_SIZE
 
@@ -380,30 +458,27 @@ class FAT:
 			if dirent_is_free(f_entry.dirent):
 				continue
 
+			if dirent_has_attr(f_entry.dirent, FAT_ATTR_VOLUME_ID):
+				continue
+
 			entries.append(f_entry)
 
 		return entries
 
 	def list_files(self) -> list:
-		return [f_entry.name for f_entry in self.walk_root_dir()]
+		return [f_entry.name for f_entry in self.entries.values()]
 
 	def find_free_entry(self) -> FATFileEntry:
-		dirent_pos = self.sec_to_bytes(self.first_root_dir_sec())
-		max_root_dirents = floor(
-			self.sec_to_bytes(self.root_dir_sectors()) / FAT_DIRENT_SIZE
-		)
+		dirent_pos = 0
 
-		dirent_index = 0
-
-		while dirent_index < max_root_dirents:
+		while dirent_pos + FAT_DIRENT_SIZE <= len(self.root_dir):
 			f_entry = self.get_file_entry(dirent_pos)
 
 			if is_last_dirent(f_entry.dirent):
 				# Mark next dirent as last dirent
-				next_f_entry = self.get_file_entry(dirent_pos + FAT_DIRENT_SIZE)
-				next_f_entry.dirent.Name = b"\x00"
-
-				self.write_file_entry(next_f_entry)
+				if dirent_pos + 2 * FAT_DIRENT_SIZE <= len(self.root_dir):
+					self.root_dir[dirent_pos + FAT_DIRENT_SIZE] = 0
+					self.root_dir_dirty = True
 
 				return f_entry
 
@@ -418,24 +493,24 @@ class FAT:
 		return (n - 2) * self.bpb.SecPerClus + self.cluster_2_first_sector()
 
 	def cluster_n_fat_offset(self, n: int) -> int:
+		"""
+		Offset of the FAT entry of cluster n, relative to the start of
+		the FAT.
+		"""
 		if self.fat_type == 16:
-			fat_offset = n * 2
+			return n * 2
 		elif self.fat_type == 32:
-			fat_offset = n * 4
+			return n * 4
 		else:
-			fat_offset = n + floor(n / 2)
-
-		return self.sec_to_bytes(self.bpb.RsvdSecCnt) + fat_offset
+			return n + floor(n / 2)
 
 	def get_cluster_fat(self, cluster) -> int:
 		fat_offset = self.cluster_n_fat_offset(cluster)
 
-		if self.fat_type == 16:
-			fat_bytes = self.read_bytes(fat_offset, 2)
-		elif self.fat_type == 32:
-			fat_bytes = self.read_bytes(fat_offset, 4)
+		if self.fat_type == 32:
+			fat_bytes = self.fat[fat_offset : fat_offset + 4]
 		else:
-			fat_bytes = self.read_bytes(fat_offset, 2)
+			fat_bytes = self.fat[fat_offset : fat_offset + 2]
 
 		fat = int.from_bytes(fat_bytes, "little")
 
@@ -449,11 +524,25 @@ class FAT:
 
 		return fat
 
-	def write_cluster(self, cluster: int, data: bytes):
-		assert len(data) <= self.bpb.BytsPerSec * self.bpb.SecPerClus
-
-		sector = self.cluster_n_first_sector(cluster)
-		self.write_bytes(self.sec_to_bytes(sector), data)
+	def load_free_clusters(self):
+		"""
+		Build the free cluster bitmap: self.free_clusters[n] is 1 if cluster
+		n is free.
+		"""
+		max_cluster = self.count_of_clusters + 2
+		if self.fat_type == 12:
+			entries = [self.get_cluster_fat(n) for n in range(max_cluster)]
+		else:
+			entries = array("H" if self.fat_type == 16 else "I")
+			entries.frombytes(self.fat[: max_cluster * entries.itemsize])
+			if sys.byteorder == "big":
+				entries.byteswap()
+
+		mask = 0x0FFFFFFF if self.fat_type == 32 else 0xFFFF
+		self.free_clusters = bytearray(
+			1 if n >= 2 and entry & mask == 0 else 0 for n, entry in enumerate(entries)
+		)
+		self.next_free_cluster = 2
 
 	def write_cluster_fat(self, cluster: int, fat: int):
 		fat_offset = self.cluster_n_fat_offset(cluster)
@@ -461,30 +550,35 @@ class FAT:
 		if self.fat_type == 16:
 			assert fat & 0xFFFF == fat
 
-			fat_bytes = int.to_bytes(fat, 2, "little")
+			self.fat[fat_offset : fat_offset + 2] = int.to_bytes(fat, 2, "little")
 		elif self.fat_type == 32:
 			assert fat & 0x0FFFFFFF == fat
 
-			prev_fat = int.from_bytes(self.read_bytes(fat_offset, 4), "little")
-			fat_bytes = int.to_bytes(fat | (prev_fat & 0xF0000000), 4, "little")
+			prev_fat = int.from_bytes(self.fat[fat_offset : fat_offset + 4], "little")
+			self.fat[fat_offset : fat_offset + 4] = int.to_bytes(
+				fat | (prev_fat & 0xF0000000), 4, "little"
+			)
 		else:
 			assert fat & 0x0FFF == fat
 
-			prev_fat = int.from_bytes(self.read_bytes(fat_offset, 2), "little")
+			prev_fat = int.from_bytes(self.fat[fat_offset : fat_offset + 2], "little")
 
 			if cluster % 2 == 0:
 				fat_bytes = int.to_bytes(fat | (prev_fat & 0xF000), 2, "little")
 			else:
 				fat_bytes = int.to_bytes((fat << 4) | (prev_fat & 0xF), 2, "little")
 
-		self.write_bytes(fat_offset, fat_bytes)
-
-	def get_clusters(self, dirent) -> int:
-		clusters = []
+			self.fat[fat_offset : fat_offset + 2] = fat_bytes
 
-		first_cluster = (dirent.FstClusHI << 16) | dirent.FstClusLO
+		self.fat_dirty = True
+		if fat == 0:
+			self.free_clusters[cluster] = 1
+			self.next_free_cluster = min(self.next_free_cluster, cluster)
+		else:
+			self.free_clusters[cluster] = 0
 
-		clusters.append(first_cluster)
+	def get_cluster_chain(self, first_cluster: int) -> list:
+		clusters = [first_cluster]
 
 		fat_entry = self.get_cluster_fat(first_cluster)
 
@@ -495,14 +589,32 @@ class FAT:
 
 		return clusters
 
-	def find_free_cluster(self):
-		cluster = 2
+	def get_clusters(self, dirent) -> int:
+		first_cluster = (dirent.FstClusHI << 16) | dirent.FstClusLO
+		if first_cluster == 0:
+			# empty file
+			return []
+
+		return self.get_cluster_chain(first_cluster)
+
+	def cluster_runs(self, clusters: list):
+		"""
+		Yield (first cluster, index in clusters, count) for each run of
+		contiguous clusters.
+		"""
+		start = 0
+		for i in range(1, len(clusters) + 1):
+			if i == len(clusters) or clusters[i] != clusters[i - 1] + 1:
+				yield (clusters[start], start, i - start)
+				start = i
 
-		while cluster < self.count_of_clusters:
-			if self.get_cluster_fat(cluster) == 0:
-				return cluster
+	def find_free_cluster(self):
+		cluster = self.free_clusters.find(1, self.next_free_cluster)
+		if cluster == -1:
+			return None
 
-			cluster += 1
+		self.next_free_cluster = cluster
+		return cluster
 
 	def mark_cluster_eoc(self, cluster: int):
 		self.write_cluster_fat(cluster, self.fat_eoc_value())
@@ -511,11 +623,10 @@ class FAT:
 		self.write_cluster_fat(end_of_chain, next_cluster)
 
 	def delete_file(self, name: str):
-		if not self.file_exists(name):
+		f_entry = self.entries.pop(name.lower(), None)
+		if f_entry is None:
 			return
 
-		f_entry = self.find_file_entry(name)
-
 		for dirent_i in range(f_entry.num_dirents):
 			self.free_dirent(f_entry.dirent_start + dirent_i * FAT_DIRENT_SIZE)
 
@@ -542,70 +653,58 @@ class FAT:
 		f_entry.dirent.Name = (f"{f_name:<8}" + f"{ext:<3}").encode("ascii")
 		f_entry.dirent.FileSize = len(data)
 		f_entry.dirent.NTRes = b"\x00"
+		f_entry.set_first_cluster(0)
 
-		end_of_chain = None
-
-		for chunk in dnload_iter(data, self.bpb.BytsPerSec * self.bpb.SecPerClus):
+		clusters = []
+		for _ in range(-(-len(data) // self.cluster_size)):
 			cluster = self.find_free_cluster()
 			if cluster is None:
+				for cluster in clusters:
+					self.write_cluster_fat(cluster, 0)
 				raise ValueError(
 					f"Failed to find a free FAT cluster to create {name}, no space left!"
 				)
 
-			if end_of_chain is None:
+			if clusters == []:
 				f_entry.set_first_cluster(cluster)
-				self.mark_cluster_eoc(cluster)
-				end_of_chain = cluster
 			else:
-				self.append_cluster(end_of_chain, cluster)
-				self.mark_cluster_eoc(cluster)
-
-			self.write_cluster(cluster, chunk)
-			end_of_chain = cluster
+				self.append_cluster(clusters[-1], cluster)
+			self.mark_cluster_eoc(cluster)
+			clusters.append(cluster)
+
+		data = memoryview(data)
+		for cluster, index, count in self.cluster_runs(clusters):
+			self.write_bytes(
+				self.sec_to_bytes(self.cluster_n_first_sector(cluster)),
+				data[index * self.cluster_size : (index + count) * self.cluster_size],
+			)
 
 		self.write_file_entry(f_entry)
+		f_entry.name = name
+		self.entries[name.lower()] = f_entry
 
 	def file_exists(self, name):
-		return any([f_entry.name_matches(name) for f_entry in self.walk_root_dir()])
+		return name.lower() in self.entries
 
 	def get_file_size(self, name):
-		dirent = None
-
-		for f_entry in self.walk_root_dir():
-			if f_entry.name_matches(name):
-				dirent = f_entry.dirent
-				break
-
-		if dirent is None:
-			raise ValueError(f"File {name} not found")
-
-		return dirent.FileSize
+		return self.find_file_entry(name).dirent.FileSize
 
 	def find_file_entry(self, name: str):
-		for f_entry in self.walk_root_dir():
-			if f_entry.name_matches(name):
-				return f_entry
+		f_entry = self.entries.get(name.lower())
+		if f_entry is None:
+			raise ValueError(f"File {name} not found")
 
-		raise ValueError(f"File {name} not found")
+		return f_entry
 
 	def read_file(self, name):
 		f_entry = self.find_file_entry(name)
 		dirent = f_entry.dirent
 
 		data = bytearray()
-		left = dirent.FileSize
-
-		clusters = self.get_clusters(dirent)
-
-		for cluster in clusters:
-			sector = self.cluster_n_first_sector(cluster)
-
-			new_data = self.read_bytes(
-				self.sec_to_bytes(sector),
-				min(left, self.sec_to_bytes(self.bpb.SecPerClus)),
+		for cluster, _, count in self.cluster_runs(self.get_clusters(dirent)):
+			size = min(dirent.FileSize - len(data), count * self.cluster_size)
+			data += self.read_bytes(
+				self.sec_to_bytes(self.cluster_n_first_sector(cluster)), size
 			)
 
-			left -= len(new_data)
-			data += bytearray(new_data)
-
 		return data
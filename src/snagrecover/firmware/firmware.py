@@ -18,6 +18,7 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 import logging
+import mmap
 
 logger = logging.getLogger("snagrecover")
 from snagrecover.protocols import dfu
@@ -26,7 +27,7 @@ from snagrecover.config import recovery_config
 from snagrecover.utils import cli_error
 
 
-def stm32mp_run(port, fw_name: str, fw_blob: bytes):
+def stm32mp_run(dfu_cmd: dfu.DFUSession, fw_name: str, fw_blob: bytes):
 	"""
 	There isn't a lot of complicated logic to handle stm32mp firmware
 	so we can leave it in the common module for now
@@ -44,26 +45,25 @@ def stm32mp_run(port, fw_name: str, fw_blob: bytes):
 
 	partid = None
 	for partprefix in partprefixes:
-		partid = dfu.search_partid(port, partprefix, match_prefix=True)
+		partid = dfu_cmd.search_partid(partprefix, match_prefix=True)
 		if partid is not None:
 			break
 
 	if partid is None:
 		raise Exception(f"No DFU altsetting found with iInterface in '{partprefixes}*'")
-	dfu_cmd = dfu.DFU(port)
 	logger.info("Downloading file...")
 	dfu_cmd.download_and_run(fw_blob, partid, offset=0, size=len(fw_blob))
 
 	if fw_name == "fip-ddr":
 		logger.info("Sending detach command...")
-		partid = dfu.search_partid(port, "@FIP", match_prefix=True)
+		partid = dfu_cmd.search_partid("@FIP", match_prefix=True)
 		dfu_cmd.detach(partid)
 
 	logger.info("Done")
 	return None
 
 
-def am6x_run(dev, fw_name: str, fw_blob: bytes):
+def am6x_run(dfu_cmd: dfu.DFUSession, fw_name: str, fw_blob: bytes):
 	"""
 	There isn't a lot of complicated logic to handle am6x firmware
 	so we can leave it in the common module for now
@@ -80,10 +80,9 @@ def am6x_run(dev, fw_name: str, fw_blob: bytes):
 	else:
 		cli_error(f"unsupported firmware {fw_name}")
 	logger.info("Searching for partition id...")
-	partid = dfu.search_partid(dev, partname)
+	partid = dfu_cmd.search_partid(partname)
 	if partid is None:
 		raise Exception(f"No DFU altsetting found with iInterface='{partname}'")
-	dfu_cmd = dfu.DFU(dev, stm32=False)
 	logger.info("Downloading file...")
 	dfu_cmd.download_and_run(fw_blob, partid, offset=0, size=len(fw_blob))
 	logger.info("Done")
@@ -92,7 +91,7 @@ def am6x_run(dev, fw_name: str, fw_blob: bytes):
 		dfu_cmd.detach(partid)
 
 
-def am62lx_run(dev, fw_name: str, fw_blob: bytes):
+def am62lx_run(dfu_cmd: dfu.DFUSession, fw_name: str, fw_blob: bytes):
 	# find firmware altsetting (i.e. partition id)
 	if fw_name == "tiboot3":
 		partname = "bootloader"
@@ -103,10 +102,9 @@ def am62lx_run(dev, fw_name: str, fw_blob: bytes):
 	else:
 		cli_error(f"unsupported firmware {fw_name}")
 	logger.info("Searching for partition id...")
-	partid = dfu.search_partid(dev, partname)
+	partid = dfu_cmd.search_partid(partname)
 	if partid is None:
 		raise Exception(f"No DFU altsetting found with iInterface='{partname}'")
-	dfu_cmd = dfu.DFU(dev, stm32=False)
 	logger.info("Downloading file...")
 	dfu_cmd.download_and_run(fw_blob, partid, offset=0, size=len(fw_blob))
 	logger.info("Done")
@@ -150,7 +148,7 @@ def check_fw_blob(fw_blob: bytes):
 	the wrong file to snagrecover.
 	"""
 
-	first_512 = fw_blob[:512]
+	first_512 = bytes(fw_blob[:512])
 
 	try:
 		first_512.decode("ascii")
@@ -189,21 +187,48 @@ def load_fw(fw_name: str, check_fw: bool = True) -> bytes:
 	return fw_blob
 
 
+def map_fw(fw_name: str, check_fw: bool = True) -> memoryview:
+	"""
+	Like load_fw(), but map the firmware file in memory instead of reading
+	it, for protocols which serve arbitrary ranges of possibly large images.
+	The mapping is released along with the returned memoryview.
+	"""
+	fw_path = get_fw_path(fw_name)
+
+	with open(fw_path, "rb") as file:
+		try:
+			fw_blob = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+		except ValueError:
+			# empty files can't be mapped
+			fw_blob = memoryview(b"")
+
+	if check_fw and not check_fw_blob(fw_blob):
+		logger.warning(f"File {fw_path} looks like a text file!")
+
+	return fw_blob
+
+
 def run_firmware(port, fw_name: str, subfw_name: str = ""):
 	"""
 	The "subfw_name" option allows selecting firmware
 	subimages inside the same image. This avoids
 	having the user pass the same binary in two different
 	configs.
+	For the DFU-based families (stm32mp, am6x, am62lx), port is a
+	dfu.DFUSession which is kept for all the images sent to the same
+	device, so that its altsetting names are only fetched once.
 	"""
 
-	fw_blob = load_fw(fw_name)
+	soc_family = recovery_config["soc_family"]
+	if soc_family == "qcom":
+		fw_blob = map_fw(fw_name)
+	else:
+		fw_blob = load_fw(fw_name)
 
 	logger.info(f"Installing firmware {fw_name}")
 	if subfw_name != "":
 		logger.info(f"Subfirmware: {subfw_name}")
 
-	soc_family = recovery_config["soc_family"]
 	if soc_family == "sama5":
 		from snagrecover.firmware.sama5_fw import sama5_run
 
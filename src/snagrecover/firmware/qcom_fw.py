@@ -20,12 +20,64 @@ Qualcomm firmware handling for Sahara protocol.
 """
 
 import logging
+import mmap
+from concurrent.futures import ThreadPoolExecutor
 from snagrecover.config import recovery_config
+from snagrecover.firmware.firmware import map_fw
 from snagrecover.utils import cli_error
 
 logger = logging.getLogger("snagrecover")
 
 
+def qcom_image_id(fw_name: str) -> int:
+	"""
+	Return the Sahara image ID of a firmware.
+	"""
+	image_id = recovery_config["firmware"][fw_name].get("image_id")
+	if image_id is None:
+		cli_error(f"Firmware {fw_name} has no image_id in recovery config")
+
+	logger.debug(f"Firmware '{fw_name}' maps to image ID {image_id:#x}")
+	return image_id
+
+
+def preload_fw(fw_name: str) -> memoryview:
+	fw_blob = map_fw(fw_name)
+	# start reading the whole image now, instead of on the first request
+	if isinstance(fw_blob.obj, mmap.mmap) and hasattr(mmap, "MADV_WILLNEED"):
+		fw_blob.obj.madvise(mmap.MADV_WILLNEED)
+
+	return fw_blob
+
+
+def qcom_load_images() -> dict:
+	"""
+	Map and validate all configured firmwares concurrently, before the
+	device requests any of them.
+
+	Returns:
+		dict: Firmware binary data by Sahara image ID
+
+	Raises:
+		cli_error: If a firmware is empty or two firmwares share an image ID
+	"""
+	fw_names = list(recovery_config["firmware"].keys())
+	with ThreadPoolExecutor() as executor:
+		fw_blobs = list(executor.map(preload_fw, fw_names))
+
+	images = {}
+	for fw_name, fw_blob in zip(fw_names, fw_blobs, strict=True):
+		image_id = qcom_image_id(fw_name)
+		if len(fw_blob) == 0:
+			cli_error(f"Firmware {fw_name} is empty")
+		if image_id in images:
+			cli_error(f"Firmware {fw_name} has the same image ID as another firmware")
+
+		images[image_id] = fw_blob
+
+	return images
+
+
 def qcom_run(sahara, fw_name: str, fw_blob: bytes):
 	"""
 	Transfer Qualcomm firmware via Sahara protocol.
@@ -37,18 +89,14 @@ def qcom_run(sahara, fw_name: str, fw_blob: bytes):
 	Args:
 		sahara: QSahara protocol instance
 		fw_name: Firmware name (e.g., 'xbl', 'u-boot')
-		fw_blob: Firmware binary data (bytes)
+		fw_blob: Firmware binary data (bytes or memoryview of the mapped file)
 
 	Raises:
 		cli_error: If firmware name is unknown or firmware is empty
 		Exception: If transfer fails
 	"""
 	# Get Sahara image ID for this firmware
-	image_id = 0
-	for key, value in recovery_config["firmware"].items():
-		if key == fw_name:
-			image_id = value["image_id"]
-	logger.debug(f"Firmware '{fw_name}' maps to image ID {image_id:#x}")
+	image_id = qcom_image_id(fw_name)
 
 	# Validate firmware size
 	if len(fw_blob) == 0:
@@ -78,12 +78,10 @@ def restore(port: fel.FEL, soc_info: dict, tt: bytes, tt_addr: int):
 	tt_words[0xFFF] &= ~((7 << 12) | (1 << 3) | (1 << 2))
 	tt_words[0xFFF] |= (1 << 12) | (1 << 3) | (1 << 2)
 
-	# write MMU TT
+	# write MMU TT, it is contiguous so a single download is enough
+	tt = b"".join(tt_word.to_bytes(4, "little") for tt_word in tt_words)
 	memops = memory_ops.MemoryOps(port)
-	c = 0
-	for addr in range(tt_addr, tt_addr + MMU_SIZE, 4):
-		memops.write32(addr, tt_words[c])
-		c += 1
+	memops.write_blob(tt, tt_addr, 0, len(tt))
 	memops.write_blob(restore_prog, soc_info["safe_addr"], 0, len(restore_prog))
 	memops.jump(soc_info["safe_addr"])
 
@@ -181,18 +179,13 @@ def check(port: fel.FEL, soc_info: dict) -> tuple:
 			f"Invalid MMU TT address 0x{tt_addr:x} with alignment mask 0x{tt_addr_mask:x}"
 		)
 	logger.debug(f"MMU TT address 0x{tt_addr:x} alignment mask 0x{tt_addr_mask:x}")
-	tt_barr = bytearray()
-	for addr in range(tt_addr, tt_addr + MMU_SIZE, 4):
-		entry = memops.read32(addr)
+	# read the whole TT at once, like sunxi-fel does
+	tt = bytes(port.message("FEL_UPLOAD", tt_addr, MMU_SIZE))
+	for i in range(0, MMU_SIZE, 4):
+		entry = int.from_bytes(tt[i : i + 4], "little")
 		# check MMU entry
-		if (
-			(entry >> 1) & 1 != 1
-			or (entry >> 18) & 1 != 0
-			or (entry >> 20) != (addr - tt_addr) // 4
-		):
+		if (entry >> 1) & 1 != 1 or (entry >> 18) & 1 != 0 or (entry >> 20) != i // 4:
 			raise ValueError(f"Not a valid MMU TT entry 0x{entry:x}")
-		tt_barr += entry.to_bytes(4, "little")
-	tt = bytes(tt_barr)
 	return (tt, tt_addr)
 
 
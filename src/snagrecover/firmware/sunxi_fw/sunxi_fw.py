@@ -37,6 +37,29 @@ import importlib.resources
 
 UBOOT_MIN_OFFSET = 0x8000
 MAX_DT_NAME_SIZE = 512
+# FEL_DOWNLOAD size used unless soc_info.yaml sets fel_max_msg_len, which
+# no supported SoC currently does. Like sunxi-fel, whole images fit in a
+# single message.
+FEL_MAX_MSG_LEN = 0x400000
+
+
+def get_soc_info(port: fel.FEL) -> dict:
+	"""
+	Read the soc_info.yaml entry for the current SoC model, and configure
+	the FEL message size accordingly.
+	"""
+	sunxi_fw_path = str(
+		importlib.resources.files("snagrecover")
+		.joinpath("firmware")
+		.joinpath("sunxi_fw")
+		.resolve()
+	)
+
+	with open(sunxi_fw_path + "/soc_info.yaml", "r") as file:
+		soc_info = yaml.safe_load(file)[recovery_config["soc_model"]]
+
+	port.max_msg_len = soc_info.get("fel_max_msg_len", FEL_MAX_MSG_LEN)
+	return soc_info
 
 
 def rmr_jump(port: fel.FEL, entry_addr: int, soc_info: dict):
@@ -330,15 +353,7 @@ def sunxi_spl(port: fel.FEL, fw_blob: bytes) -> tuple:
 	"""
 	logger.info("Reading SoC info...")
 
-	sunxi_fw_path = str(
-		importlib.resources.files("snagrecover")
-		.joinpath("firmware")
-		.joinpath("sunxi_fw")
-		.resolve()
-	)
-
-	with open(sunxi_fw_path + "/soc_info.yaml", "r") as file:
-		soc_info = yaml.safe_load(file)[recovery_config["soc_model"]]
+	soc_info = get_soc_info(port)
 	# check SPL header magic and checksum
 	logger.info("Checking header and checksum...")
 	if fw_blob[4:12] != b"eGON.BT0":
@@ -442,14 +457,14 @@ def sunxi_spl(port: fel.FEL, fw_blob: bytes) -> tuple:
 		mmu.restore(port, soc_info, tt, tt_addr)
 
 	# check return code
-	h1 = memops.read32(soc_info["spl_start"] + 4).to_bytes(4, "little")
-	h2 = memops.read32(soc_info["spl_start"] + 8).to_bytes(4, "little")
-	if h1 + h2 != b"eGON.FEL":
+	# both words are contiguous, read them with a single message
+	if bytes(port.message("FEL_UPLOAD", soc_info["spl_start"] + 4, 8)) != b"eGON.FEL":
 		raise ValueError("Invalid return value found in SPL SRAM")
 	return (spl_len, dt_name)
 
 
 def sunxi_uboot(port: fel.FEL, fw_blob: bytes, dt_name: str):
+	soc_info = get_soc_info(port)
 	# determine image type
 	magic = int.from_bytes(fw_blob[0:4], "big")
 	arm64_entry = False
@@ -462,15 +477,6 @@ def sunxi_uboot(port: fel.FEL, fw_blob: bytes, dt_name: str):
 
 	logger.info("Jumping to U-Boot...")
 	if arm64_entry:
-		sunxi_fw_path = str(
-			importlib.resources.files("snagrecover")
-			.joinpath("firmware")
-			.joinpath("sunxi_fw")
-			.resolve()
-		)
-
-		with open(sunxi_fw_path + "/soc_info.yaml", "r") as file:
-			soc_info = yaml.safe_load(file)[recovery_config["soc_model"]]
 		rmr_jump(port, entry_addr, soc_info)
 	else:
 		memops = memory_ops.MemoryOps(port)
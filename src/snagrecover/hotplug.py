@@ -0,0 +1,160 @@
+# This file is part of Snagboot
+# Copyright (C) 2026 Bootlin
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+USB hotplug events, so that waiting for a device to (re)enumerate doesn't
+take longer than the enumeration itself.
+
+On Linux, uevents are received from a netlink socket. Both kernel events
+and udev events are listened to: kernel events are sent as soon as the
+device is registered, udev events once its device file access rights have
+been set. On other systems, or if the socket can't be opened, waiting for
+an event is a plain sleep and callers fall back to polling.
+"""
+
+import logging
+import platform
+import select
+import socket
+import struct
+import time
+
+logger = logging.getLogger("snagrecover")
+
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_GROUP_KERNEL = 1
+UEVENT_GROUP_UDEV = 2
+UEVENT_BUFSIZE = 16384
+
+UDEV_MONITOR_MAGIC = 0xFEEDCAFE
+# prefix[8], magic (big endian), header_size, properties_off, properties_len
+UDEV_HEADER = struct.Struct("=8sIIII")
+
+
+def parse_uevent(msg: bytes) -> dict:
+	"""
+	Return the properties of a kernel or udev uevent message.
+	"""
+	if msg.startswith(b"libudev\x00"):
+		if len(msg) < UDEV_HEADER.size:
+			return {}
+		(_, magic, _, props_off, props_len) = UDEV_HEADER.unpack_from(msg)
+		if socket.ntohl(magic) != UDEV_MONITOR_MAGIC:
+			return {}
+		fields = msg[props_off : props_off + props_len].split(b"\x00")
+	else:
+		# ACTION@DEVPATH header, followed by the properties
+		fields = msg.split(b"\x00")[1:]
+
+	props = {}
+	for field in fields:
+		key, sep, value = field.partition(b"=")
+		if sep:
+			props[key.decode(errors="replace")] = value.decode(errors="replace")
+	return props
+
+
+def usb_path_match(usb_path: tuple):
+	"""
+	Return a predicate matching uevents of the USB device at usb_path.
+	"""
+	name = f"{usb_path[0]}-{'.'.join([str(x) for x in usb_path[1]])}"
+	return lambda props: props.get("DEVPATH", "").rsplit("/", 1)[-1] == name
+
+
+def usb_ids_match(vid: int, pid: int):
+	"""
+	Return a predicate matching uevents of USB devices with IDs vid:pid.
+	"""
+
+	def match(props: dict) -> bool:
+		product = props.get("PRODUCT", "").split("/")
+		try:
+			return int(product[0], 16) == vid and int(product[1], 16) == pid
+		except (ValueError, IndexError):
+			return False
+
+	return match
+
+
+class USBEventMonitor:
+	"""
+	Source of USB device addition events. It should be created before
+	checking whether the device is present, so that no event is lost
+	between the check and the wait.
+	"""
+
+	def __init__(self):
+		self.sock = None
+		if platform.system() != "Linux":
+			return
+
+		try:
+			sock = socket.socket(
+				socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT
+			)
+			sock.bind((0, UEVENT_GROUP_KERNEL | UEVENT_GROUP_UDEV))
+		except OSError as err:
+			logger.debug(f"Failed to open uevent socket, polling instead: {err}")
+			return
+
+		sock.setblocking(False)
+		self.sock = sock
+
+	def wait(self, timeout: float, match=None) -> bool:
+		"""
+		Wait for at most timeout seconds for a USB device to be added.
+		Return True as soon as an event accepted by match arrives, False
+		once the timeout has expired.
+		"""
+		if self.sock is None:
+			time.sleep(timeout)
+			return False
+
+		deadline = time.monotonic() + timeout
+		while (remaining := deadline - time.monotonic()) > 0:
+			r, _, _ = select.select([self.sock], [], [], remaining)
+			if not r:
+				break
+
+			try:
+				msg = self.sock.recv(UEVENT_BUFSIZE)
+			except BlockingIOError:
+				continue
+
+			props = parse_uevent(msg)
+			if (
+				props.get("SUBSYSTEM") == "usb"
+				and props.get("DEVTYPE") == "usb_device"
+				and props.get("ACTION") in ["add", "bind"]
+				and (match is None or match(props))
+			):
+				logger.debug(f"USB device added at {props.get('DEVPATH')}")
+				return True
+
+		return False
+
+	def close(self):
+		if self.sock is not None:
+			self.sock.close()
+			self.sock = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
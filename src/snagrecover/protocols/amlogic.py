@@ -42,6 +42,8 @@ import logging
 
 logger = logging.getLogger("snagrecover")
 
+import sys
+from array import array
 from struct import pack, unpack
 from usb.util import (
 	ENDPOINT_IN,
@@ -168,6 +170,41 @@ def write_blob_simple_memory(dev, address: int, blob: bytes) -> None:
 		offset += len(chunk)
 
 
+def get_max_packet_size(dev) -> int:
+	"""
+	Return wMaxPacketSize of the bulk OUT endpoint, or 0 if it isn't found.
+	"""
+	for cfg in dev:
+		for intf in cfg:
+			for ep in intf:
+				if ep.bEndpointAddress == ENDPOINT_OUT | EP_OUT:
+					return ep.wMaxPacketSize
+	return 0
+
+
+def write_blocks(dev, data, block_length: int, max_packet_size: int) -> None:
+	"""
+	Send data as a sequence of bulk writes of block_length bytes, the last
+	one possibly shorter.
+
+	If block_length is a multiple of the endpoint's packet size, these
+	writes produce the same packets on the bus as a single write of the
+	whole data, since only the last one can end with a short packet. In
+	this case, data is sent in one transfer and packetized by the USB
+	stack. Otherwise, each block has to end with a short packet and is sent
+	separately.
+
+	Data is passed to pyusb as bytes: it copies memoryviews one element at
+	a time, but bytes in a single copy.
+	"""
+	if max_packet_size and block_length % max_packet_size == 0:
+		dev.write(ENDPOINT_OUT | EP_OUT, bytes(data), TRANSFERT_TIMEOUT)
+		return
+
+	for chunk in dnload_iter(data, block_length):
+		dev.write(ENDPOINT_OUT | EP_OUT, bytes(chunk), TRANSFERT_TIMEOUT)
+
+
 def write_large_memory(
 	dev, address: int, data: bytes, block_length: int = 64, append_zeros: bool = False
 ) -> None:
@@ -185,8 +222,9 @@ def write_large_memory(
 			f"'data' length ({len(data)}) is not a multiple of block_length ({block_length})"
 		)
 
+	max_packet_size = get_max_packet_size(dev)
 	offset = 0
-	for block in dnload_iter(data, MAX_LARGE_BLOCK_COUNT):
+	for block in dnload_iter(memoryview(data), MAX_LARGE_BLOCK_COUNT):
 		block_count = len(block) // block_length + (
 			1 if len(block) % block_length else 0
 		)
@@ -199,8 +237,7 @@ def write_large_memory(
 			data_or_wLength=control_data,
 		)
 
-		for chunk in dnload_iter(block, block_length):
-			dev.write(ENDPOINT_OUT | EP_OUT, chunk, TRANSFERT_TIMEOUT)
+		write_blocks(dev, block, block_length, max_packet_size)
 
 		offset += len(block)
 
@@ -244,19 +281,60 @@ def get_next_AMLC_block(dev) -> tuple[int, int]:
 	return (length, offset)
 
 
+UINT32_MASK = 0xFFFF_FFFF
+
+
 def compute_AMLS_checksum(data: bytes) -> int:
 	"""
 	Calculate data checksum for AMLS transfert.
-	unsigned 32 bit additive checksum
+	unsigned 32 bit additive checksum of little endian words, a trailing
+	partial word being padded with zeros
 	"""
-	checksum = 0
-	UINT32_MASK = 0xFFFF_FFFF
+	data = memoryview(data).cast("B")
+	tail = len(data) % 4
+	words = data[: len(data) - tail].cast("I")
+	if sys.byteorder == "big":
+		words = array("I", words)
+		words.byteswap()
 
-	for chunk in dnload_iter(data, 4):
-		val = int.from_bytes(chunk, byteorder="little", signed=False)
-		checksum = (checksum + val) & UINT32_MASK
+	checksum = sum(words)
+	if tail:
+		checksum += int.from_bytes(data[-tail:], byteorder="little")
 
-	return checksum
+	return checksum & UINT32_MASK
+
+
+class AMLSChecksums:
+	"""
+	Table of the checksums of each AMLC_AMLS_BLOCK_LENGTH-byte block of a
+	firmware. BL2 requests blocks at aligned offsets, so the checksum of
+	a requested block can be computed from the table without reading the
+	firmware data again.
+	"""
+
+	def __init__(self, data: bytes):
+		self.size = len(data)
+		self.table = array(
+			"I",
+			[
+				compute_AMLS_checksum(block)
+				for block in dnload_iter(memoryview(data), AMLC_AMLS_BLOCK_LENGTH)
+			],
+		)
+
+	def checksum(self, data: bytes, offset: int) -> int:
+		"""
+		Return the checksum of data, found at offset in the firmware.
+		"""
+		end = offset + len(data)
+		if offset % AMLC_AMLS_BLOCK_LENGTH == 0 and (
+			len(data) % AMLC_AMLS_BLOCK_LENGTH == 0 or end == self.size
+		):
+			first = offset // AMLC_AMLS_BLOCK_LENGTH
+			last = -(-end // AMLC_AMLS_BLOCK_LENGTH)
+			return sum(self.table[first:last]) & UINT32_MASK
+
+		return compute_AMLS_checksum(data)
 
 
 def write_AMLC_sub_blocks(dev, offset: int, data: bytes) -> None:
@@ -269,8 +347,7 @@ def write_AMLC_sub_blocks(dev, offset: int, data: bytes) -> None:
 		data_or_wLength=None,
 	)
 
-	for chunk in dnload_iter(data, AMLC_MAX_BLOCK_LENGTH):
-		dev.write(ENDPOINT_OUT | EP_OUT, chunk, TRANSFERT_TIMEOUT)
+	write_blocks(dev, data, AMLC_MAX_BLOCK_LENGTH, get_max_packet_size(dev))
 
 	ack_in = dev.read(ENDPOINT_IN | EP_IN, 16, TRANSFERT_TIMEOUT)
 	if "OKAY" not in "".join(map(chr, ack_in[0:4])):
@@ -279,15 +356,21 @@ def write_AMLC_sub_blocks(dev, offset: int, data: bytes) -> None:
 		raise ValueError(err_msg)
 
 
-def write_AMLC_block(dev, seq: int, amlc_offset: int, data: bytes) -> None:
-	"""Write requested u-boot-fip block (retrieved by 'get_next_AMLC_block') to BL2."""
+def write_AMLC_block(
+	dev, seq: int, amlc_offset: int, data: bytes, checksum: int | None = None
+) -> None:
+	"""
+	Write requested u-boot-fip block (retrieved by 'get_next_AMLC_block') to BL2.
+	The checksum of data is computed if it isn't given.
+	"""
 	offset = 0
 	for chunk in dnload_iter(data, AMLC_MAX_TRANSFERT_LENGTH):
 		write_AMLC_sub_blocks(dev, offset, chunk)
 		offset += len(chunk)
 
 	# Write AMLS with checksum over full block, while transferring part of the first 512 bytes
-	checksum = compute_AMLS_checksum(data)
+	if checksum is None:
+		checksum = compute_AMLS_checksum(data)
 	logger.debug(f"Sending {checksum=} for sequence {seq}")
 	amls = (
 		pack("<4sBBBBII", bytes("AMLS", "ascii"), seq, 0, 0, 0, checksum, 0)
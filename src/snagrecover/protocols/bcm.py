@@ -44,11 +44,14 @@ def send_blob(dev, blob: bytes) -> None:
 		data_or_wLength=0,
 	)
 
-	# we then send the blob in several bulk transfers
+	# we then send the blob in several bulk transfers, blob can be a
+	# memoryview of a file, which pyusb would copy one element at a time,
+	# so chunks are passed as bytes
 	for chunk in dnload_iter(blob, 16384):
+		chunk = bytes(chunk)
 		bulk_res = dev.write(1, chunk)
 		if bulk_res != len(chunk):
-			raise Exception(f"BULK OUT sent only {bulk_res}/{len(bulk_res)} bytes")
+			raise Exception(f"BULK OUT sent only {bulk_res}/{len(chunk)} bytes")
 
 
 def rom_code_send_file(dev, file_blob: bytes) -> int:
@@ -17,10 +17,22 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import asyncio
+import errno
 import logging
+import socket
+import struct
 
 logger = logging.getLogger("snagrecover")
 
+BOOTP_BUFSIZE = 1500
+DHCP_MAGIC_COOKIE = b"\x63\x82\x53\x63"
+
+# from linux/in.h, not exported by the socket module of all Python versions
+IP_PKTINFO = getattr(socket, "IP_PKTINFO", 8)
+# struct in_pktinfo: interface index, local address, destination address
+IN_PKTINFO = struct.Struct("=i4s4s")
+
 
 def parse_ipv4(addr: bytes) -> str:
 	return f"{addr[0]}.{addr[1]}.{addr[2]}.{addr[3]}"
@@ -38,10 +50,35 @@ def encode_filename(filename: str) -> bytes:
 	return filename.encode("ascii") + b"\x00" * (128 - len(filename))
 
 
+def parse_options(vend: bytes) -> dict:
+	"""
+	Parse the options (RFC 1533) in the vendor area of a BOOTP packet.
+	"""
+	options = {}
+	if not vend.startswith(DHCP_MAGIC_COOKIE):
+		return options
+
+	i = len(DHCP_MAGIC_COOKIE)
+	while i < len(vend):
+		tag = vend[i]
+		if tag == BootpRequest.PAD_TAG:
+			i += 1
+			continue
+		if tag == BootpRequest.STOP_TAG or i + 1 >= len(vend):
+			break
+		length = vend[i + 1]
+		options[tag] = vend[i + 2 : i + 2 + length]
+		i += 2 + length
+
+	return options
+
+
 class BootpRequest:
 	op_field = {1: "BOOT_REQUEST", 2: "BOOT_REPLY"}
 
+	PAD_TAG = 0
 	DHCP_MSG_TYPE_TAG = 53
+	VENDOR_CLASS_TAG = 60
 	DHCPACK = 5
 	STOP_TAG = 255
 
@@ -65,6 +102,11 @@ class BootpRequest:
 		# sname[44:108] optional server name
 		self.file = packet[108:236]  # boot file name
 		# the rest of the packet contains vendor data and padding
+		self.options = parse_options(packet[236:])
+		# e.g. "AM335x ROM" or "AM335x U-Boot SPL"
+		self.vendor_class = self.options.get(BootpRequest.VENDOR_CLASS_TAG, b"").decode(
+			"ascii", errors="replace"
+		)
 
 	def build_reply(self, client_ip: str, server_ip: str, filename: str) -> bytes:
 		reply = bytearray(self.packet)
@@ -99,4 +141,87 @@ class BootpRequest:
 		logger.debug(f"server ip: {self.siaddr}\n")
 		logger.debug(f"client hardware address: {self.chaddr}\n")
 		logger.debug(f"boot file name: {self.file}\n")
+		logger.debug(f"vendor class identifier: {self.vendor_class}\n")
 		logger.debug("End of BootpRequest received packet")
+
+
+class BootpServer:
+	"""
+	BOOTP server, which replies to each request with the (client_ip,
+	server_ip, filename) lease returned by lease(request, local_ip), or
+	ignores it if lease() returns None.
+
+	Replies are broadcast, since clients don't have an IP address yet. On
+	Linux, they are sent on the interface the request was received from, and
+	local_ip is the address of this interface, so that clients on several
+	interfaces can be served at the same time. Elsewhere, local_ip is None.
+	"""
+
+	def __init__(self, lease):
+		self.lease = lease
+		self.sock = None
+
+	async def start(self, host: str, port: int):
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+		try:
+			sock.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+		except OSError:
+			logger.debug("IP_PKTINFO not supported, BOOTP replies use default routes")
+		sock.bind((host, port))
+		sock.setblocking(False)
+		self.sock = sock
+		asyncio.get_running_loop().add_reader(sock.fileno(), self.on_readable)
+
+	def on_readable(self):
+		try:
+			packet, ancdata, _, addr = self.sock.recvmsg(
+				BOOTP_BUFSIZE, socket.CMSG_SPACE(IN_PKTINFO.size)
+			)
+		except (BlockingIOError, InterruptedError):
+			return
+
+		pktinfo = None
+		for level, cmsg_type, data in ancdata:
+			if level == socket.IPPROTO_IP and cmsg_type == IP_PKTINFO:
+				pktinfo = IN_PKTINFO.unpack_from(data)
+
+		try:
+			self.handle(packet, addr, pktinfo)
+		except OSError as err:
+			if err.errno == errno.ENETUNREACH:
+				logger.warning("Error in BOOTP server: network is unreachable")
+			else:
+				raise err
+
+	def handle(self, packet: bytes, addr: tuple, pktinfo):
+		logger.debug(f"packet from {addr[0]}")
+		try:
+			bootp_req = BootpRequest(packet)
+		except (KeyError, IndexError):
+			logger.debug("Ignoring malformed BOOTP packet")
+			return
+
+		if bootp_req.op != "BOOT_REQUEST":
+			return
+
+		bootp_req.log()
+		local_ip = parse_ipv4(pktinfo[1]) if pktinfo is not None else None
+		lease = self.lease(bootp_req, local_ip)
+		if lease is None:
+			return
+
+		reply = bootp_req.build_reply(*lease)
+		dest = ("255.255.255.255", addr[1])
+		if pktinfo is None:
+			self.sock.sendto(reply, dest)
+		else:
+			ifindex, spec_dst, _ = pktinfo
+			cmsg = IN_PKTINFO.pack(ifindex, spec_dst, bytes(4))
+			self.sock.sendmsg([reply], [(socket.IPPROTO_IP, IP_PKTINFO, cmsg)], dest)
+
+	def close(self):
+		if self.sock is not None:
+			asyncio.get_running_loop().remove_reader(self.sock.fileno())
+			self.sock.close()
+			self.sock = None
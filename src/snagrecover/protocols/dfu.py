@@ -17,14 +17,17 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import array
 import usb.core
 import usb.util
 import time
 import logging
+from dataclasses import dataclass
 
 logger = logging.getLogger("snagrecover")
 from errno import EIO, ENODEV, EPIPE
 from snagrecover import utils
+from snagrecover import usb_stats
 
 
 def list_partids(dev: usb.core.Device):
@@ -52,6 +55,33 @@ def search_partid(dev: usb.core.Device, partname: str, match_prefix=False) -> in
 	return partid
 
 
+@dataclass
+class DFUTransferStats:
+	"""
+	Breakdown of the time spent in a DFU download, in seconds.
+	"""
+
+	blocks: int = 0
+	bytes: int = 0
+	# DFU_DNLOAD control transfers
+	transfer_time: float = 0.0
+	# DFU_GETSTATUS control transfers
+	status_time: float = 0.0
+	status_requests: int = 0
+	# waiting for bwPollTimeout to expire
+	sleep_time: float = 0.0
+
+	def __str__(self):
+		total = self.transfer_time + self.status_time + self.sleep_time
+		throughput = self.bytes / total / 1024 if total else 0
+		return (
+			f"{self.bytes} bytes in {self.blocks} blocks, {total:.3f}s "
+			f"({throughput:.1f} KiB/s): transfer {self.transfer_time:.3f}s, "
+			f"{self.status_requests} status requests {self.status_time:.3f}s, "
+			f"poll timeout sleep {self.sleep_time:.3f}s"
+		)
+
+
 class DFU:
 	DESC_TYPE_DFU = 0x21
 	MAN_TOLERANT_MASK = 4
@@ -90,7 +120,7 @@ class DFU:
 	}
 
 	def __init__(self, dev: usb.core.Device, stm32: bool = True):
-		self.dev = dev
+		self.dev = usb_stats.instrument(dev, "dfu")
 		self.stm32 = stm32  # set when dfu is used to recover stm32mp boards
 		# try to find wTransferSize
 		bMaxPacketSize0 = dev.bMaxPacketSize0
@@ -116,27 +146,123 @@ class DFU:
 				logger.info(
 					f"Found DFU Functional descriptor: wTransferSize = {self.transfer_size}"
 				)
-		self.status_timeout = 100
+		# bwPollTimeout reported by the last DFU_GETSTATUS, in milliseconds
+		self.status_timeout = 0
+		# time at which the last DFU_GETSTATUS response was received
+		self.last_status_time = None
+		# state reported by the last DFU_GETSTATUS, None if it may have
+		# changed since then
+		self.state = None
+		self.stats = DFUTransferStats()
+
+	def wait_poll_timeout(self):
+		"""
+		Wait until the poll timeout reported by the last status has expired.
+		The timeout runs from the moment the status was received, so time
+		spent in other transfers since then is deducted. Nothing is waited
+		before the first status request, and a zero timeout, as reported by
+		most devices in the dfuDNBUSY state, means polling again right away.
+		"""
+		if self.last_status_time is None:
+			return
+
+		elapsed = time.monotonic() - self.last_status_time
+		remaining = self.status_timeout / 1000.0 - elapsed
+		if remaining > 0:
+			time.sleep(remaining)
+			self.stats.sleep_time += remaining
 
 	def get_status(self) -> tuple:
 		# make sure to wait long enough after last get_status()
-		time.sleep(self.status_timeout / 1000.0)
+		self.wait_poll_timeout()
 		# status = status polltimeout state iString
-		status = self.dev.ctrl_transfer(
-			0xA1, 3, wValue=0, wIndex=0, data_or_wLength=6
-		)  # DFU_GETSTATUS
+		t0 = time.monotonic()
+		with usb_stats.label(self.dev, usb_stats.RESPONSE):
+			status = self.dev.ctrl_transfer(
+				0xA1, 3, wValue=0, wIndex=0, data_or_wLength=6
+			)  # DFU_GETSTATUS
+		self.last_status_time = time.monotonic()
+		self.stats.status_time += self.last_status_time - t0
+		self.stats.status_requests += 1
 		state = status[4]
-		self.status_timeout = int.from_bytes(bytes(status[1:3]), "little")
+		self.state = state
+		# bwPollTimeout is a 24-bit field
+		self.status_timeout = int.from_bytes(bytes(status[1:4]), "little")
 		logger.debug(f"DFU state: {state} DFU status: {DFU.status_codes[status[0]]}")
 		return state
 
+	def check_idle(self):
+		"""
+		Make sure that the device is in the dfuIDLE state. The status is
+		only requested if the device could have left dfuIDLE since the last
+		one.
+		"""
+		state = self.state
+		if state != DFU.state_codes["dfuIDLE"]:
+			state = self.get_status()
+			if state != DFU.state_codes["dfuIDLE"]:
+				raise ValueError(f"Incompatible state {state} detected")
+
+		# the next requests will change the state
+		self.state = None
+
+	def dnload_blocks(self, source, offset: int, size: int):
+		"""
+		Yield the size bytes of source starting at offset, one wTransferSize
+		block at a time. source can be a bytes-like object, a seekable file
+		object or an iterator of bytes-like objects. Every block but the
+		last one is copied into the same buffer, so the yielded arrays must
+		be consumed before the next iteration.
+		"""
+		# pyusb uses byte arrays as is, other buffers, including memoryviews,
+		# are copied one element at a time
+		buf = array.array("B", bytes(self.transfer_size))
+		view = memoryview(buf)
+		fill = 0
+
+		if hasattr(source, "read"):
+			source.seek(offset)
+			pieces = iter(lambda: source.read(self.transfer_size - fill), b"")
+		elif hasattr(source, "__next__"):
+			if offset:
+				raise ValueError("Cannot download from an offset in an iterator")
+			pieces = source
+		else:
+			pieces = [memoryview(source)[offset : offset + size]]
+
+		for piece in pieces:
+			piece = memoryview(piece).cast("B")
+			while len(piece) and size:
+				length = min(len(piece), self.transfer_size - fill, size)
+				view[fill : fill + length] = piece[:length]
+				piece = piece[length:]
+				fill += length
+				size -= length
+				if fill == self.transfer_size:
+					yield buf
+					fill = 0
+
+			if not size:
+				break
+
+		if size:
+			raise ValueError(f"Unexpected end of data, {size} bytes left to download")
+		if fill:
+			yield buf[:fill]
+
 	def download_and_run(
-		self, blob: bytes, partid: int, offset: int, size: int, show_progress=False
+		self, blob, partid: int, offset: int, size: int, show_progress=False
 	) -> bool:
+		"""
+		blob can be any source accepted by dnload_blocks(), so that large
+		files can be downloaded without being loaded in memory.
+
+		A breakdown of the time spent transferring data, requesting status
+		and waiting for poll timeouts is kept in self.stats.
+		"""
+		self.stats = DFUTransferStats()
 		self.set_partition(partid)
-		state = self.get_status()
-		if state != DFU.state_codes["dfuIDLE"]:
-			raise ValueError(f"Incompatible state {state} detected")
+		self.check_idle()
 
 		if self.stm32:
 			block_index = 2  # wValue 0 and 1 seem to be reserved
@@ -144,12 +270,21 @@ class DFU:
 			block_index = 0
 		# for other commands (erase, set exec address, etc.)
 		bytes_written = 0
-		for chunk in utils.dnload_iter(
-			blob[offset : offset + size], self.transfer_size
-		):
-			bytes_written += self.dev.ctrl_transfer(
-				0x21, 1, wValue=block_index, wIndex=0, data_or_wLength=chunk
-			)
+		percent = -1
+
+		for chunk in self.dnload_blocks(blob, offset, size):
+			t0 = time.monotonic()
+			with usb_stats.label(self.dev, "DFU_DNLOAD"):
+				bytes_written += self.dev.ctrl_transfer(
+					0x21, 1, wValue=block_index, wIndex=0, data_or_wLength=chunk
+				)
+			self.stats.transfer_time += time.monotonic() - t0
+			self.stats.blocks += 1
+			self.stats.bytes += len(chunk)
+
+			if show_progress and 100 * bytes_written // size != percent:
+				percent = 100 * bytes_written // size
+				print(f"{utils.progress_bar(bytes_written, size)}\r", end="")
 
 			# make sure to wait enough before sending next get_status
 			state = self.get_status()
@@ -159,6 +294,10 @@ class DFU:
 				state = self.get_status()
 			block_index += 1
 
+		if show_progress:
+			print("")
+			logger.info(f"Downloaded {self.stats}")
+
 		# send zero-length download command to leave DFU mode and manifest
 		# firmware
 		bytes_written += self.dev.ctrl_transfer(
@@ -172,6 +311,7 @@ class DFU:
 					state = self.get_status()
 				except usb.core.USBError:
 					logger.info("Could not read status after end of manifest phase")
+					self.state = None
 					return True
 				time.sleep(1)
 			elif state == DFU.state_codes["dfuMANIFEST-SYNC"]:
@@ -182,18 +322,60 @@ class DFU:
 					logger.info(
 						"Could not read status after end of manifest-sync phase"
 					)
+					self.state = None
 					return True
 			elif state == DFU.state_codes["dfuMANIFEST-WAIT-RESET"]:
 				self.detach()
 				return True
 
-		if show_progress:
-			logger.info("")
 		logger.info("Done manifesting firmware")
+		logger.debug(f"DFU download stats: {self.stats}")
 		return True
 
+	def upload(self, partid: int, size: int):
+		"""
+		Read back up to size bytes from altsetting partid, yielding one
+		wTransferSize block at a time. The upload ends early if the device
+		sends a short block, which marks the end of its data. Devices only
+		accept block numbers in sequence, so data can't be skipped.
+		"""
+		self.set_partition(partid)
+		self.check_idle()
+
+		if self.stm32:
+			block_index = 2
+		else:
+			block_index = 0
+
+		while size > 0:
+			with usb_stats.label(self.dev, "DFU_UPLOAD"):
+				block = self.dev.ctrl_transfer(
+					0xA1,
+					2,
+					wValue=block_index,
+					wIndex=0,
+					data_or_wLength=self.transfer_size,
+				)  # DFU_UPLOAD
+			self.stats.blocks += 1
+			self.stats.bytes += len(block)
+			block_index += 1
+
+			if len(block) > size:
+				block = block[:size]
+			size -= len(block)
+			yield block
+
+			if len(block) < self.transfer_size and size > 0:
+				# short frame, the device is back to dfuIDLE
+				self.state = DFU.state_codes["dfuIDLE"]
+				return
+
+		# stop the upload before the end of the device's data
+		self.dfu_abort()
+
 	def dfu_abort(self):
 		self.dev.ctrl_transfer(0x21, 6, wValue=0, wIndex=0, data_or_wLength=None)
+		self.state = DFU.state_codes["dfuIDLE"]
 
 	def detach(self, partid: int):
 		self.set_partition(partid)
@@ -206,18 +388,22 @@ class DFU:
 				logger.warning(f"EIO, ENODEV or EPIPE: {e.errno} on DFU_DETACH")
 			else:
 				raise e
+		self.state = None
 		return None
 
 	def set_partition(self, partid: int):
 		self.dev.set_interface_altsetting(interface=0, alternate_setting=partid)
 		return None
 
+	def search_partid(self, partname: str, match_prefix=False) -> int:
+		return search_partid(self.dev, partname, match_prefix)
+
 	def stm32_get_phase(self) -> int:
 		"""
 		This returns the next partition to be executed and other
 		information I haven't identified yet.
 		"""
-		partid = search_partid(self.dev, "@virtual", match_prefix=True)
+		partid = self.search_partid("@virtual", match_prefix=True)
 		if partid is None:
 			raise Exception("No DFU altsetting found with iInterface='@virtual*'")
 		self.set_partition(partid)
@@ -230,3 +416,60 @@ class DFU:
 		logger.info(f"Phase id: {phase_id}")
 		self.get_status()
 		return phase_id
+
+
+class DFUSession(DFU):
+	"""
+	DFU object meant to be kept for a whole session with a device. The
+	functional descriptor is only parsed once, altsetting names are only
+	fetched on the first lookup, and queued images are downloaded in a row
+	without checking the device state between them, since each download
+	ends in a known dfuIDLE state.
+	"""
+
+	def __init__(self, dev: usb.core.Device, stm32: bool = True):
+		super().__init__(dev, stm32)
+		# (iInterface string, altsetting) for each altsetting
+		self.partnames = None
+		# (source, partid, offset, size) for each queued download
+		self.queue = []
+
+	def get_partnames(self) -> list:
+		if self.partnames is None:
+			self.partnames = []
+			cfg = self.dev.get_active_configuration()
+			for intf in cfg.interfaces():
+				desc = usb.util.get_string(self.dev, intf.iInterface)
+				self.partnames.append((desc, intf.bAlternateSetting))
+
+		return self.partnames
+
+	def search_partid(self, partname: str, match_prefix=False) -> int:
+		"""
+		Cached equivalent of search_partid()
+		"""
+		partid = None
+		for desc, altsetting in self.get_partnames():
+			if desc is None:
+				continue
+			if (match_prefix and desc.startswith(partname)) or desc == partname:
+				partid = altsetting
+		return partid
+
+	def queue_download(self, source, partid: int, offset: int = 0, size: int = None):
+		if size is None:
+			size = len(source) - offset
+		self.queue.append((source, partid, offset, size))
+
+	def download_queued(self, show_progress=False):
+		"""
+		Download and manifest all queued images in order, then empty the
+		queue.
+		"""
+		queue = self.queue
+		self.queue = []
+		for i, (source, partid, offset, size) in enumerate(queue):
+			logger.info(
+				f"Downloading image {i + 1}/{len(queue)} to altsetting {partid}..."
+			)
+			self.download_and_run(source, partid, offset, size, show_progress)
@@ -24,7 +24,11 @@ import tempfile
 from typing import Optional, Union
 
 from snagrecover import utils
+from snagrecover import usb_stats
 from snagflash.android_sparse_file.utils import split_streaming
+from snagflash.android_sparse_file.convert import RawSparseStream
+from snagflash.android_sparse_file.pack import plan_split, split_packed
+from snagflash.android_sparse_file.sparse import MAGIC as SPARSE_MAGIC
 
 import logging
 
@@ -52,9 +56,15 @@ class FastbootError(Exception):
 		return f"Fastboot error: {self.message}"
 
 
+def command_name(packet) -> str:
+	if isinstance(packet, bytes):
+		packet = packet.decode("ascii", errors="replace")
+	return packet.split(":")[0].rstrip("\x00")
+
+
 class Fastboot:
 	def __init__(self, dev: usb.core.Device, timeout: int = 10000):
-		self.dev = dev
+		self.dev = usb_stats.instrument(dev, "fastboot")
 		cfg = dev.get_active_configuration()
 		# select the first interface we find with a bulk in ep and a bulk out ep
 		eps_found = False
@@ -103,10 +113,12 @@ class Fastboot:
 		self, packet: Optional[bytes] = None, loglevel=logging.DEBUG
 	) -> Union[bytes, int]:
 		if packet is not None:
-			self.dev.write(self.ep_out, packet, timeout=self.timeout)
+			with usb_stats.label(self.dev, command_name(packet)):
+				self.dev.write(self.ep_out, packet, timeout=self.timeout)
 		t0 = time.time()
 		while time.time() - t0 < 10 * self.timeout:
-			ret = self.dev.read(self.ep_in, 256, timeout=self.timeout)
+			with usb_stats.label(self.dev, usb_stats.RESPONSE):
+				ret = self.dev.read(self.ep_in, 256, timeout=self.timeout)
 			status = bytes(ret[:4])
 			data = bytes(ret[4:256])
 			if status in [b"INFO", b"TEXT"]:
@@ -131,8 +143,9 @@ class Fastboot:
 	def send(self, blob: bytes, padding: int = 0):
 		packet = f"download:{len(blob) + padding:08x}".encode()
 		self.cmd(packet)
-		for chunk in utils.dnload_iter(blob + b"\x00" * padding, self.max_size):
-			self.dev.write(self.ep_out, chunk, timeout=self.timeout)
+		with usb_stats.label(self.dev, "download data"):
+			for chunk in utils.dnload_iter(blob + b"\x00" * padding, self.max_size):
+				self.dev.write(self.ep_out, chunk, timeout=self.timeout)
 		self.cmd(loglevel=logging.INFO)
 
 	def download(self, path: str, padding: int = 0):
@@ -239,12 +252,7 @@ class Fastboot:
 
 		self.dev.write(self.ep_out, packet, timeout=self.timeout)
 
-	def flash_sparse(self, args: str):
-		"""
-		Download and flash an android sparse file.
-		If the file is too big, it's splitting into
-		smaller android sparse files.
-		"""
+	def get_max_download_size(self) -> int:
 		try:
 			maxsize = int(self.getvar("max-download-size"), 0)
 		except Exception as e:
@@ -253,6 +261,29 @@ class Fastboot:
 			) from e
 		if maxsize == 0:
 			raise FastbootError("Fastboot variable max-download-size is 0")
+		return maxsize
+
+	def flash_sparse_dry_run(self, fname: str):
+		"""
+		Report how flash_sparse would split an android
+		sparse file, without downloading anything.
+		"""
+		if not os.path.exists(fname):
+			raise FastbootError(f"File {fname} does not exist")
+
+		report = plan_split(fname, self.get_max_download_size())
+		logger.info(f"Sparse file {fname} would be flashed as {report}")
+		return report
+
+	def flash_sparse(self, args: str):
+		"""
+		Download and flash an android sparse file.
+		If the file is too big, it's splitting into
+		smaller android sparse files. Raw images are
+		converted to sparse images on the fly, using
+		their bmap file if there is one.
+		"""
+		maxsize = self.get_max_download_size()
 		arg_list = args.split(":", 1)
 		cnt = len(arg_list)
 		if cnt != 2:
@@ -263,24 +294,41 @@ class Fastboot:
 		if not os.path.exists(fname):
 			raise FastbootError(f"File {fname} does not exist")
 
-		# Verify the file is a valid Android sparse file by checking magic cookie
+		# Raw images are converted to sparse images on the fly
 		try:
 			with open(fname, "rb") as f:
 				magic_bytes = f.read(4)
 				if len(magic_bytes) < 4:
 					raise FastbootError(
-						f"File {fname} is too small to be a valid sparse file"
+						f"File {fname} is too small to be a valid image file"
 					)
 				magic = int.from_bytes(magic_bytes, byteorder="little")
-				if magic != 0xED26FF3A:
-					raise FastbootError(
-						f"File {fname} is not a valid Android sparse file. "
-						f"Expected magic 0xED26FF3A, got 0x{magic:08X}"
-					)
-				logger.info(f"Verified {fname} is a valid Android sparse file")
 		except IOError as e:
 			raise FastbootError(f"Failed to read file {fname}: {e}") from e
 
+		if magic == SPARSE_MAGIC:
+			logger.info(f"Verified {fname} is a valid Android sparse file")
+			report = plan_split(fname, maxsize)
+			logger.info(f"Split plan: {report}")
+
+			def split_source(temppath):
+				return split_packed(fname, temppath, maxsize)
+		else:
+			bmap = utils.get_bmap_path(fname)
+			if not os.path.exists(bmap):
+				bmap = None
+			logger.info(
+				f"{fname} is not an Android sparse file, converting it on the fly"
+				+ (f" using {bmap}" if bmap else "")
+			)
+
+			report = None
+
+			def split_source(temppath):
+				return split_streaming(
+					RawSparseStream(fname, bmap=bmap), temppath, maxsize
+				)
+
 		part = arg_list[1]
 
 		# Use streaming approach to minimize memory usage
@@ -289,42 +337,47 @@ class Fastboot:
 		with tempfile.TemporaryDirectory() as tmp:
 			temppath = os.path.join(tmp, "sparse.img")
 			try:
-				# Count total splits upfront for "split X/N" logging below
-				total_splits = sum(1 for _ in split_streaming(fname, temppath, maxsize))
+				# Sparse images are planned upfront, so the split count is
+				# known for "split X/N" logging. Counting the splits of raw
+				# images would need an extra conversion pass, so it is omitted.
+				if report is not None:
+					of_total = f"/{report.fragments}"
+					logger.info(
+						f"Starting streaming sparse file flash ({report.fragments} split(s))..."
+					)
+				else:
+					of_total = ""
+					logger.info("Starting streaming sparse file flash...")
 
 				split_count = 0
-				logger.info(
-					f"Starting streaming sparse file flash ({total_splits} split(s))..."
-				)
-
-				for split_file in split_streaming(fname, temppath, maxsize):
+				for split_file in split_source(temppath):
 					split_count += 1
 					logger.info(
-						f"Processing split {split_count}/{total_splits}: Downloading {split_file}"
+						f"Processing split {split_count}{of_total}: Downloading {split_file}"
 					)
 					try:
 						self.download(split_file)
 					except Exception as e:
 						raise FastbootError(
-							f"Failed to download split {split_count}/{total_splits}: {e}"
+							f"Failed to download split {split_count}{of_total}: {e}"
 						) from e
 
 					logger.info(
-						f"Processing split {split_count}/{total_splits}: Flashing to {part}"
+						f"Processing split {split_count}{of_total}: Flashing to {part}"
 					)
 					try:
 						self.flash(part)
 					except Exception as e:
 						raise FastbootError(
-							f"Failed to flash split {split_count}/{total_splits}: {e}"
+							f"Failed to flash split {split_count}{of_total}: {e}"
 						) from e
 
 					logger.debug(
-						f"Split {split_count}/{total_splits} completed successfully"
+						f"Split {split_count}{of_total} completed successfully"
 					)
 
 				logger.info(
-					f"Successfully flashed {split_count}/{total_splits} split file(s) to {part}"
+					f"Successfully flashed {split_count}{of_total} split file(s) to {part}"
 				)
 			except Exception as e:
 				raise FastbootError(f"Streaming sparse flash failed: {e}") from e
@@ -22,12 +22,29 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import struct
 import usb
-from snagrecover import utils
+from snagrecover import usb_stats
 
 
 class FEL:
 	MAX_MSG_LEN = 65536
+	# data phases are sent in bulk transfers of at most this size, so that
+	# each of them completes well within the USB timeout
+	MAX_BULK_LEN = 0x80000
+	"""
+	magic[4] + reserved[4]
+	len
+	reserved[3]
+	cmd_len
+	cmd
+	reserved
+	len2
+	reserved[10]
+	"""
+	AWUC_HEADER = struct.Struct("<4s4xI3xBBxI10x")
+	# request, reserved[2], addr, len, reserved[4]
+	MESSAGE_HEADER = struct.Struct("<H2xII4x")
 	"""
 	For some of these requests, I haven't
 	been able to find any detailed
@@ -45,7 +62,7 @@ class FEL:
 	}
 
 	def __init__(self, dev: usb.core.Device, timeout: int):
-		self.dev = dev
+		self.dev = usb_stats.instrument(dev, "fel")
 		cfg = dev.get_active_configuration()
 		# select the first interface we find with a bulk in ep and a bulk out ep
 		eps_found = False
@@ -70,39 +87,35 @@ class FEL:
 		self.ep_in = ep_in
 		self.ep_out = ep_out
 		self.timeout = timeout
+		# largest FEL_DOWNLOAD or FEL_UPLOAD message
+		self.max_msg_len = FEL.MAX_MSG_LEN
+		# AWUC headers already built, by (length, out)
+		self.awuc_headers = {}
+
+	def awuc_header(self, length: int, out: bool) -> bytes:
+		header = self.awuc_headers.get((length, out))
+		if header is None:
+			# USB request
+			cmd = 0x12 if out else 0x11
+			header = FEL.AWUC_HEADER.pack(b"AWUC", length, 0x0C, cmd, length)
+			self.awuc_headers[(length, out)] = header
+		return header
 
 	def aw_exchange(self, length: int, out: bool, packet: bytes = b"") -> bytes:
-		# USB request
-		if out:
-			cmd = b"\x12"
-		else:
-			cmd = b"\x11"
-		"""
-		magic[4] + reserved[4]
-		len
-		reserved[3]
-		cmd_len
-		cmd
-		reserved
-		len2
-		reserved[10]
-		"""
-		packet0 = (
-			b"AWUC\x00\x00\x00\x00"
-			+ length.to_bytes(4, "little")
-			+ b"\x00\x00\x00"
-			+ b"\x0c"
-			+ cmd
-			+ b"\x00"
-			+ length.to_bytes(4, "little")
-			+ (10 * b"\x00")
-		)
-		self.dev.write(self.ep_out, packet0, timeout=self.timeout)
+		self.dev.write(self.ep_out, self.awuc_header(length, out), timeout=self.timeout)
 		# main action
 		if out:
-			ret = (self.dev.write(self.ep_out, packet, timeout=self.timeout)).to_bytes(
-				4, "little"
-			)
+			view = memoryview(packet)
+			nbytes = 0
+			for start in range(0, len(view), FEL.MAX_BULK_LEN):
+				# pyusb copies memoryviews one element at a time, but
+				# bytes in a single copy
+				nbytes += self.dev.write(
+					self.ep_out,
+					bytes(view[start : start + FEL.MAX_BULK_LEN]),
+					timeout=self.timeout,
+				)
+			ret = nbytes.to_bytes(4, "little")
 		else:
 			ret = self.dev.read(self.ep_in, length, timeout=self.timeout)
 		# USB response
@@ -134,17 +147,13 @@ class FEL:
 		return response
 
 	def message(self, request: str, addr: int, length: int, data: bytes = b"") -> bytes:
-		if length > FEL.MAX_MSG_LEN:
+		if length > self.max_msg_len:
 			raise Exception("Data is too long for FEL message")
 		if request == "FEL_DOWNLOAD" and len(data) != length:
 			raise Exception("Data does not match length parameter")
 		# send message
-		message = (
-			(FEL.standard_request_codes[request]).to_bytes(2, "little")
-			+ b"\x00\x00"
-			+ addr.to_bytes(4, "little")
-			+ length.to_bytes(4, "little")
-			+ b"\x00\x00\x00\x00"
+		message = FEL.MESSAGE_HEADER.pack(
+			FEL.standard_request_codes[request], addr, length
 		)
 		self.aw_exchange(len(message), out=True, packet=message)
 		# get/send data
@@ -190,14 +199,15 @@ class FEL:
 		return int.from_bytes(nbytes, "little") == 4
 
 	def write_blob(self, blob: bytes, addr: int, offset: int, size: int) -> bool:
-		# chop up download in muliple chunks if necessary
+		# chop up download in muliple chunks if necessary, each bulk
+		# transfer is copied by aw_exchange()
 		ret = True
-		chunk_addr = addr
-		for chunk in utils.dnload_iter(blob[offset : offset + size], FEL.MAX_MSG_LEN):
+		view = memoryview(blob)[offset : offset + size]
+		for start in range(0, size, self.max_msg_len):
+			chunk = view[start : start + self.max_msg_len]
 			N = len(chunk)
-			nbytes = self.message("FEL_DOWNLOAD", chunk_addr, N, chunk)
+			nbytes = self.message("FEL_DOWNLOAD", addr + start, N, chunk)
 			ret &= int.from_bytes(nbytes, "little") == N
-			chunk_addr += N
 		return ret
 
 	def jump(self, addr: int) -> bool:
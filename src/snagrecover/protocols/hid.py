@@ -44,6 +44,10 @@ CTRL_HID_SET_IDLE = 0xA
 REPORT_TYPE_INPUT = 0x1
 REPORT_TYPE_OUTPUT = 0x2
 
+# maximum number of reports submitted with a single writev() on hidraw,
+# this is IOV_MAX on Linux
+HIDRAW_WRITEV_MAX = 1024
+
 
 def get_descriptor(dev, desc_size, desc_type, desc_index):
 	return dev.ctrl_transfer(
@@ -251,3 +255,31 @@ class HIDDevice:
 
 	def hidraw_write(self, data: bytes):
 		return self.hidraw.write(data)
+
+	def write_reports(self, data, report_size: int):
+		"""
+		Send data as consecutive reports of report_size bytes, the last one
+		may be shorter. Each hidraw write() sends a single report, so
+		batches of reports are submitted with one writev() system call. On
+		libusb, each report is a separate interrupt transfer.
+		"""
+		view = memoryview(data)
+		reports = [view[i : i + report_size] for i in range(0, len(view), report_size)]
+
+		if self.hidraw is None or not hasattr(os, "writev"):
+			for report in reports:
+				# pyusb copies memoryviews byte by byte
+				self.write(bytes(report))
+			return
+
+		fd = self.hidraw.fileno()
+		i = 0
+		while i < len(reports):
+			written = os.writev(fd, reports[i : i + HIDRAW_WRITEV_MAX])
+			# writev() stops at the first report which isn't fully written
+			start = i
+			while i < len(reports) and written >= len(reports[i]):
+				written -= len(reports[i])
+				i += 1
+			if written != 0 or i == start:
+				self.err(f"Failed to write report {i} to hidraw device")
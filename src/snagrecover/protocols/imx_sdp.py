@@ -55,15 +55,37 @@ reference manual
 import logging
 
 logger = logging.getLogger("snagrecover")
-from snagrecover import utils
 from snagrecover.protocols import hab_constants
 from snagrecover.config import recovery_config
 from snagrecover.protocols.hid import HIDDevice, HIDError
+from snagrecover import usb_stats
 from usb.core import USBError
 import struct
 import time
 
 
+def build_report2_frames(data, chunk_size: int, pad: bool) -> bytearray:
+	"""
+	Build all the report 2 frames carrying data in one contiguous buffer.
+	Each frame holds up to chunk_size bytes of data after the report id. If
+	pad is set, the last frame is padded with zeroes to the full frame size.
+	"""
+	frame_size = chunk_size + 1
+	nframes = -(-len(data) // chunk_size)
+	if pad:
+		frames = bytearray(nframes * frame_size)
+	else:
+		frames = bytearray(len(data) + nframes)
+
+	frames[::frame_size] = b"\x02" * nframes
+	view = memoryview(frames)
+	for i in range(nframes):
+		chunk = data[i * chunk_size : (i + 1) * chunk_size]
+		view[i * frame_size + 1 : i * frame_size + 1 + len(chunk)] = chunk
+
+	return frames
+
+
 class SDPCommand:
 	command_codes = {
 		"READ_REGISTER": b"\x01\x01",
@@ -89,7 +111,7 @@ class SDPCommand:
 	FT_UNUSED = b"\x00"
 
 	def __init__(self, dev):
-		self.dev = dev
+		self.dev = usb_stats.instrument(dev, "sdp")
 		self.clear()
 
 	def clear(self):
@@ -280,16 +302,12 @@ class SDPCommand:
 		self.dev.write(packet1)
 
 		if self.is_hid():
-			for chunk in utils.dnload_iter(
-				blob[offset : offset + size], __class__.REPORT2_PACKET_SIZE - 1
-			):
-				packet2 = b"\x02" + chunk
-				if len(packet2) < __class__.REPORT2_PACKET_SIZE:
-					packet2 = packet2 + b"\x00" * (
-						__class__.REPORT2_PACKET_SIZE
-						- (len(packet2) % __class__.REPORT2_PACKET_SIZE)
-					)
-				self.dev.write(packet2)
+			frames = build_report2_frames(
+				memoryview(blob)[offset : offset + size],
+				__class__.REPORT2_PACKET_SIZE - 1,
+				pad=True,
+			)
+			self.write_report2_frames(frames, __class__.REPORT2_PACKET_SIZE)
 
 			self.check_hab()
 			complete_status = self.dev.read(64, timeout=5)[:4]
@@ -381,9 +399,10 @@ class SDPCommand:
 		else:
 			transfer_size = 1024
 
-		for chunk in utils.dnload_iter(blob[0:size], transfer_size):
-			packet2 = b"\x02" + chunk
-			self.dev.write(packet2)
+		frames = build_report2_frames(
+			memoryview(blob)[0:size], transfer_size, pad=False
+		)
+		self.write_report2_frames(frames, transfer_size + 1)
 		"""
 		self.check_hab()
 		complete_status = self.dev.read(64, timeout=5)[:4]
@@ -392,8 +411,19 @@ class SDPCommand:
 		"""
 		return True
 
+	def write_report2_frames(self, frames: bytearray, frame_size: int):
+		start = time.monotonic()
+		self.dev.write_reports(frames, frame_size)
+		elapsed = time.monotonic() - start
+		nframes = -(-len(frames) // frame_size)
+		throughput = len(frames) / elapsed / 1024 if elapsed else 0
+		logger.info(
+			f"Sent {len(frames)} bytes in {nframes} reports in {elapsed:.3f}s "
+			f"({throughput:.1f} KiB/s)"
+		)
+
 	def is_hid(self):
-		return self.dev.__class__ == HIDDevice
+		return usb_stats.unwrap(self.dev).__class__ == HIDDevice
 
 	def close(self):
 		if self.is_hid():
@@ -29,9 +29,25 @@ import logging
 from dataclasses import dataclass
 
 from snagrecover.utils import BinFileHeader as Header, dnload_iter
+from snagrecover import usb_stats
 
 logger = logging.getLogger("snagrecover")
 
+HEXDUMP_SIZE = 24
+
+
+def log_hexdump(data):
+	"""
+	Log the first and last bytes of a packet. This is skipped entirely when
+	debug logs are disabled, as it is done for every data request.
+	"""
+	if not logger.isEnabledFor(logging.DEBUG) or len(data) == 0:
+		return
+
+	logger.debug(f"  First {HEXDUMP_SIZE} bytes: {data[:HEXDUMP_SIZE].hex(' ')}")
+	if len(data) > HEXDUMP_SIZE:
+		logger.debug(f"  Last {HEXDUMP_SIZE} bytes: {data[-HEXDUMP_SIZE:].hex(' ')}")
+
 
 @dataclass
 class SaharaHelloReq(Header):
@@ -143,11 +159,17 @@ class QSahara:
 	COMMAND_HANDLERS = {
 		SAHARA_HELLO_REQ: "handle_hello",
 		SAHARA_READ_DATA: "handle_read_data",
-		SAHARA_READ_DATA_64: "handle_read_data_64",
+		SAHARA_READ_DATA_64: "handle_read_data",
 		SAHARA_END_IMAGE_TX: "handle_end_image_tx",
 		SAHARA_DONE_RESP: "handle_done_resp",
 	}
 
+	# Maps each READ_DATA command to its packet layout and field width
+	READ_DATA_REQS = {
+		SAHARA_READ_DATA: (SaharaReadDataReq, "32-bit"),
+		SAHARA_READ_DATA_64: (SaharaReadData64Req, "64-bit"),
+	}
+
 	def __init__(self, usb_dev):
 		"""
 		Initialize QSahara protocol handler.
@@ -155,14 +177,16 @@ class QSahara:
 		Args:
 			usb_dev: PyUSB device object for the Qualcomm device in EDL mode
 		"""
-		self.dev = usb_dev
+		self.dev = usb_stats.instrument(usb_dev, "sahara")
 		self.ep_in = None
 		self.ep_out = None
 
 		# State management for event-driven processing
 		self.running = False
 		self.error = None
-		self.current_image_id = None
+		# Images to serve, by image ID, and IDs of those not transferred yet
+		self.images = {}
+		self.pending_images = set()
 		self.current_image_data = None
 
 		# Track active image ID for validation
@@ -302,23 +326,39 @@ class QSahara:
 
 	def transfer_image(self, image_id, data):
 		"""
-		Transfer firmware image to device.
-		Main entry point that starts the event-driven processing loop.
+		Transfer a single firmware image to device.
 
 		Args:
 			image_id: Sahara image ID
-			data: Firmware binary data (bytes)
+			data: Firmware binary data (bytes or any buffer, e.g. a mapped file)
 
 		Raises:
 			Exception: Any error that occurred during transfer
 		"""
-		logger.debug(
-			f"Starting transfer of image ID {image_id:#x}, size {len(data)} bytes"
-		)
+		self.transfer_images({image_id: data})
+
+	def transfer_images(self, images):
+		"""
+		Transfer a set of firmware images to device.
+		Main entry point that starts the event-driven processing loop.
+
+		The device chooses which image it requests next, so images are
+		served in whichever order it asks for them, in a single loop which
+		ends once all of them have been transferred.
+
+		Args:
+			images: dict mapping Sahara image IDs to firmware binary data
+				(bytes or any buffer, e.g. a mapped file)
+
+		Raises:
+			Exception: Any error that occurred during transfer
+		"""
+		for image_id, data in images.items():
+			logger.debug(f"Queuing image ID {image_id:#x}, size {len(data)} bytes")
 
 		# Setup state for this transfer
-		self.current_image_id = image_id
-		self.current_image_data = data
+		self.images = {image_id: memoryview(data) for image_id, data in images.items()}
+		self.pending_images = set(images)
 		self.running = True
 		self.error = None
 
@@ -330,7 +370,7 @@ class QSahara:
 		if self.error:
 			raise self.error
 
-		logger.debug(f"Successfully transferred image ID {image_id:#x}")
+		logger.debug(f"Successfully transferred image IDs {list(images)}")
 
 	def processing_loop(self):
 		"""
@@ -399,9 +439,7 @@ class QSahara:
 		# Return only the actual packet (trim any extra bytes)
 		packet = data[:length]
 
-		logger.debug(f"  First 24 bytes: {packet[:24].hex(' ')}")
-		if len(packet) > 24:
-			logger.debug(f"  Last 24 bytes: {packet[-24:].hex(' ')}")
+		log_hexdump(packet)
 
 		return packet
 
@@ -450,12 +488,17 @@ class QSahara:
 
 	def handle_read_data(self, packet):
 		"""
-		Handle READ_DATA request from device.
+		Handle 32-bit or 64-bit READ_DATA request from device.
+
+		64-bit requests use 64-bit fields for offset and length to support
+		larger images.
 
 		Args:
-			packet: READ_DATA packet data (20 bytes)
+			packet: READ_DATA (20 bytes) or READ_DATA_64 (32 bytes) packet data
 		"""
-		req = SaharaReadDataReq.read(packet)
+		command = struct.unpack_from("<I", packet)[0]
+		req_class, width = self.READ_DATA_REQS[command]
+		req = req_class.read(packet)
 		image_id = req.image_id
 		offset = req.data_offset
 		length = req.data_length
@@ -464,96 +507,18 @@ class QSahara:
 		# All subsequent READ_DATA must use the same ID until END_IMAGE_TX
 		if self.active_image_id is None:
 			# First READ_DATA for this image - set active image ID
-			self.active_image_id = image_id
-			logger.info("Received first READ DATA (32-bit) message from device")
+			logger.info(f"Received first READ DATA ({width}) message from device")
 			logger.debug(f"Device requesting image ID {image_id:#x}")
 
-			# Validate it matches what we're trying to send
-			if image_id != self.current_image_id:
+			# Validate it is one of the images we're trying to send
+			if image_id not in self.images:
 				raise ValueError(
-					f"Image ID mismatch: device requested {image_id:#x}, "
-					f"but we're trying to send {self.current_image_id:#x}"
+					f"Unknown image ID: device requested {image_id:#x}, "
+					f"but we're trying to send {[hex(i) for i in self.images]}"
 				)
-		else:
-			# Subsequent READ_DATA - must match active image ID
-			if image_id != self.active_image_id:
-				raise ValueError(
-					f"Image ID mismatch: active image is {self.active_image_id:#x}, "
-					f"but device requested {image_id:#x}"
-				)
-
-		logger.debug(f"Device requests data: offset={offset} length={length} bytes")
-
-		# Validate offset and length
-		if offset >= len(self.current_image_data):
-			raise ValueError(
-				f"Invalid offset {offset}, image size {len(self.current_image_data)}"
-			)
-
-		if offset + length > len(self.current_image_data):
-			raise ValueError(
-				f"Invalid read: offset={offset} length={length}, "
-				f"image size={len(self.current_image_data)}"
-			)
-
-		# Extract requested data
-		data = self.current_image_data[offset : offset + length]
-
-		# Send data in chunks to avoid USB buffer limitations in the USB stack
-		# Chunking ensures all data is actually transmitted
-		total_bytes_sent = 0
-		chunk_count = 0
-
-		logger.debug(f"Sending {len(data)} bytes to device")
-		if len(data) > 0:
-			logger.debug(f"  First 24 bytes: {data[:24].hex(' ')}")
-			if len(data) > 24:
-				logger.debug(f"  Last 24 bytes: {data[-24:].hex(' ')}")
-
-		for chunk_data in dnload_iter(data, self.SAHARA_PACKET_MAX_SIZE + 1):
-			chunk_count += 1
-			# Send chunk using helper function (no ZLP yet)
-			bytes_written = self.send_chunk(chunk_data)
-			total_bytes_sent += bytes_written
-
-		logger.debug(
-			f"Successfully sent {total_bytes_sent} bytes in {chunk_count} chunks"
-		)
-
-		# Send Zero-Length Packet (ZLP) if needed - ONCE after ALL chunks
-		# ZLP is required when TOTAL data size is a multiple of USB max packet size
-		# to signal end of transfer.
-		self.send_zlp_if_needed(total_bytes_sent)
 
-	def handle_read_data_64(self, packet):
-		"""
-		Handle 64-bit READ_DATA request from device.
-
-		This is similar to handle_read_data but uses 64-bit fields for
-		image_id, offset, and length to support larger images.
-
-		Args:
-			packet: READ_DATA_64 packet data (32 bytes)
-		"""
-		req = SaharaReadData64Req.read(packet)
-		image_id = req.image_id
-		offset = req.data_offset
-		length = req.data_length
-
-		# Validate image ID. First READ_DATA sets the active image ID
-		# All subsequent READ_DATA must use the same ID until END_IMAGE_TX
-		if self.active_image_id is None:
-			# First READ_DATA for this image - set active image ID
 			self.active_image_id = image_id
-			logger.info("Received first READ DATA (64-bit) message from device")
-			logger.debug(f"Device requesting image ID {image_id:#x}")
-
-			# Validate it matches what we're trying to send
-			if image_id != self.current_image_id:
-				raise ValueError(
-					f"Image ID mismatch: device requested {image_id:#x}, "
-					f"but we're trying to send {self.current_image_id:#x}"
-				)
+			self.current_image_data = self.images[image_id]
 		else:
 			# Subsequent READ_DATA - must match active image ID
 			if image_id != self.active_image_id:
@@ -563,22 +528,22 @@ class QSahara:
 				)
 
 		logger.debug(
-			f"Device requests data (64-bit): offset={offset} length={length} bytes"
+			f"Device requests data ({width}): offset={offset} length={length} bytes"
 		)
 
-		# Validate offset and length (with 64-bit support)
-		if offset >= len(self.current_image_data):
-			raise ValueError(
-				f"Invalid offset {offset}, image size {len(self.current_image_data)}"
-			)
+		# Validate offset and length
+		image_size = len(self.current_image_data)
+		if offset >= image_size:
+			raise ValueError(f"Invalid offset {offset}, image size {image_size}")
 
-		if offset + length > len(self.current_image_data):
+		if offset + length > image_size:
 			raise ValueError(
 				f"Invalid read: offset={offset} length={length}, "
-				f"image size={len(self.current_image_data)}"
+				f"image size={image_size}"
 			)
 
-		# Extract requested data
+		# Extract requested data, current_image_data is a memoryview so
+		# this doesn't copy the image
 		data = self.current_image_data[offset : offset + length]
 
 		# Send data in chunks to avoid Linux USB buffer limitations
@@ -588,15 +553,13 @@ class QSahara:
 		chunk_count = 0
 
 		logger.debug(f"Sending {len(data)} bytes to device")
-		if len(data) > 0:
-			logger.debug(f"  First 24 bytes: {data[:24].hex(' ')}")
-			if len(data) > 24:
-				logger.debug(f"  Last 24 bytes: {data[-24:].hex(' ')}")
+		log_hexdump(data)
 
 		for chunk_data in dnload_iter(data, self.SAHARA_PACKET_MAX_SIZE + 1):
 			chunk_count += 1
-			# Send chunk using helper function (no ZLP yet)
-			bytes_written = self.send_chunk(chunk_data)
+			# Send chunk using helper function (no ZLP yet), as bytes since
+			# pyusb copies memoryviews one element at a time
+			bytes_written = self.send_chunk(bytes(chunk_data))
 			total_bytes_sent += bytes_written
 
 		logger.debug(
@@ -631,12 +594,15 @@ class QSahara:
 
 		# Release the active image This allows the next image transfer
 		# to set a new active_image_id
-		logger.debug(f"Releasing image ID {self.active_image_id:#x}")
+		logger.debug(f"Releasing image ID {image_id:#x}")
 		self.active_image_id = None
+		self.current_image_data = None
 
 		if status != 0:
 			raise RuntimeError(f"Image transfer failed with status {status}")
 
+		self.pending_images.discard(image_id)
+
 		# Device will now process the image
 		logger.info("Sending DONE message to device")
 		self.send_done()
@@ -644,7 +610,7 @@ class QSahara:
 
 	def handle_done_resp(self, packet):
 		"""
-		Handle DONE_RESP from device - transfer complete!
+		Handle DONE_RESP from device - image transfer complete!
 
 		Args:
 			packet: DONE_RESP packet data (12 bytes)
@@ -654,9 +620,13 @@ class QSahara:
 
 		logger.info(f"Received DONE RESPONSE message from device. Status: {status}")
 
-		# Note: Intentional do nothing as we don't need to exit an app,
-		# until all the images are transferred.
-		self.running = False
+		# The device will send HELLO again to request the next image
+		if self.pending_images:
+			logger.debug(
+				f"Waiting for device to request image IDs {[hex(i) for i in self.pending_images]}"
+			)
+		else:
+			self.running = False
 
 	def send_hello_response(self, version, mode):
 		"""
@@ -682,8 +652,7 @@ class QSahara:
 			0,  # reserved fields
 		)
 		logger.debug(f"Sending HELLO_RESP packet ({len(packet)} bytes)")
-		logger.debug(f"  First 24 bytes: {packet[:24].hex(' ')}")
-		logger.debug(f"  Last 24 bytes: {packet[-24:].hex(' ')}")
+		log_hexdump(packet)
 		self.dev.write(self.ep_out, packet)
 
 	def send_done(self):
@@ -696,7 +665,7 @@ class QSahara:
 			8,  # length
 		)
 		logger.debug(f"Sending DONE packet ({len(packet)} bytes)")
-		logger.debug(f"  First 24 bytes: {packet[:24].hex(' ')}")
+		log_hexdump(packet)
 		self.dev.write(self.ep_out, packet)
 
 	def send_reset(self):
@@ -717,7 +686,7 @@ class QSahara:
 				8,  # length
 			)
 			logger.debug(f"Sending RESET packet ({len(packet)} bytes)")
-			logger.debug(f"  First 24 bytes: {packet[:24].hex(' ')}")
+			log_hexdump(packet)
 			self.dev.write(self.ep_out, packet)
 			logger.info("RESET message sent - device should be in clean state")
 		except Exception as e:
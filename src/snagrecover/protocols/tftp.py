@@ -0,0 +1,373 @@
+# This file is part of Snagboot
+# Copyright (C) 2026 Bootlin
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+Read-only TFTP server (RFC 1350), supporting the blksize (RFC 2348),
+timeout and tsize (RFC 2349) and windowsize (RFC 7440) options.
+
+Options are only used if the client requests them, so clients such as the
+AM335x ROM code still get 512-byte lock-step transfers, while U-Boot can
+negotiate larger blocks and windows of blocks sent without waiting for an
+acknowledgement.
+"""
+
+import asyncio
+import logging
+import struct
+import time
+
+logger = logging.getLogger("snagrecover")
+
+OPCODE_RRQ = 1
+OPCODE_WRQ = 2
+OPCODE_DATA = 3
+OPCODE_ACK = 4
+OPCODE_ERROR = 5
+OPCODE_OACK = 6
+
+ERR_NOT_DEFINED = 0
+ERR_FILE_NOT_FOUND = 1
+ERR_ACCESS_VIOLATION = 2
+ERR_ILLEGAL_OPERATION = 4
+ERR_UNKNOWN_TID = 5
+
+DEFAULT_BLKSIZE = 512
+MIN_BLKSIZE = 8
+MAX_BLKSIZE = 65464
+MAX_WINDOWSIZE = 65535
+MAX_TIMEOUT = 255
+
+# largest block size which doesn't cause IP fragmentation on Ethernet
+ETHERNET_BLKSIZE = 1468
+
+
+class TFTPError(Exception):
+	def __init__(self, code: int, msg: str):
+		super().__init__(msg)
+		self.code = code
+
+
+def error_packet(code: int, msg: str) -> bytes:
+	return struct.pack("!HH", OPCODE_ERROR, code) + msg.encode("ascii") + b"\x00"
+
+
+def parse_request(packet: bytes) -> tuple:
+	"""
+	Return (filename, mode, options) from a RRQ or WRQ packet, option names
+	being lowercased.
+	"""
+	fields = packet[2:].split(b"\x00")
+	if len(fields) < 3 or fields[-1] != b"" or len(fields) % 2 == 0:
+		raise TFTPError(ERR_ILLEGAL_OPERATION, "Malformed request")
+
+	try:
+		fields = [field.decode("ascii") for field in fields[:-1]]
+	except UnicodeDecodeError:
+		raise TFTPError(ERR_ILLEGAL_OPERATION, "Malformed request") from None
+
+	options = {}
+	for i in range(2, len(fields), 2):
+		options[fields[i].lower()] = fields[i + 1]
+
+	return (fields[0], fields[1].lower(), options)
+
+
+def parse_int_option(options: dict, name: str, min_value: int, max_value: int):
+	"""
+	Return the value of an integer option, or None if it wasn't requested or
+	is invalid, in which case it is ignored as allowed by RFC 2347.
+	"""
+	try:
+		value = int(options[name])
+	except (KeyError, ValueError):
+		return None
+
+	if value < min_value or value > max_value:
+		return None
+
+	return value
+
+
+class TFTPTransfer(asyncio.DatagramProtocol):
+	"""
+	Transfer of a file to a client. Each transfer has its own UDP port, as
+	required by RFC 1350.
+
+	Blocks are numbered from 1, without wrapping around: only packets use
+	16-bit block numbers, so that files of more than 65535 blocks can be
+	sent to clients supporting block number rollover.
+	"""
+
+	def __init__(self, server, client: tuple, name: str, data, options: dict):
+		self.server = server
+		self.client = client
+		self.name = name
+		self.data = memoryview(data)
+		self.transport = None
+		self.timer = None
+		self.retries = 0
+		self.start_time = time.monotonic()
+		self.done = asyncio.get_running_loop().create_future()
+
+		self.blksize = DEFAULT_BLKSIZE
+		self.windowsize = 1
+		self.timeout = server.timeout
+		self.oack = self.negotiate(options)
+
+		self.block_count = len(self.data) // self.blksize + 1
+		# last block acknowledged by the client and last block sent, the
+		# OACK counts as block 0
+		self.acked = -1 if self.oack else 0
+		self.sent = 0
+
+	def negotiate(self, options: dict) -> dict:
+		oack = {}
+
+		blksize = parse_int_option(options, "blksize", MIN_BLKSIZE, MAX_BLKSIZE)
+		if blksize is not None:
+			self.blksize = min(blksize, self.server.max_blksize)
+			oack["blksize"] = self.blksize
+
+		windowsize = parse_int_option(options, "windowsize", 1, MAX_WINDOWSIZE)
+		if windowsize is not None:
+			self.windowsize = min(windowsize, self.server.max_windowsize)
+			oack["windowsize"] = self.windowsize
+
+		timeout = parse_int_option(options, "timeout", 1, MAX_TIMEOUT)
+		if timeout is not None:
+			self.timeout = timeout
+			oack["timeout"] = timeout
+
+		if "tsize" in options:
+			oack["tsize"] = len(self.data)
+
+		return oack
+
+	def connection_made(self, transport):
+		self.transport = transport
+		if self.oack:
+			logger.debug(f"TFTP options for {self.name}: {self.oack}")
+			self.send_oack()
+		else:
+			self.send_window()
+
+	def send_oack(self):
+		packet = struct.pack("!H", OPCODE_OACK)
+		for name, value in self.oack.items():
+			packet += f"{name}\x00{value}\x00".encode("ascii")
+		self.transport.sendto(packet, self.client)
+		self.arm_timer()
+
+	def send_window(self):
+		end = min(self.acked + self.windowsize, self.block_count)
+		for block in range(self.acked + 1, end + 1):
+			offset = (block - 1) * self.blksize
+			packet = struct.pack("!HH", OPCODE_DATA, block & 0xFFFF)
+			self.transport.sendto(
+				packet + self.data[offset : offset + self.blksize], self.client
+			)
+		self.sent = end
+		self.arm_timer()
+
+	def arm_timer(self):
+		if self.timer is not None:
+			self.timer.cancel()
+		self.timer = asyncio.get_running_loop().call_later(
+			self.timeout, self.on_timeout
+		)
+
+	def on_timeout(self):
+		self.timer = None
+		self.retries += 1
+		if self.retries > self.server.retries:
+			logger.warning(f"TFTP transfer of {self.name} to {self.client} timed out")
+			self.finish(False)
+			return
+
+		logger.debug(f"TFTP timeout, resending from block {self.acked + 1}")
+		if self.acked < 0:
+			self.send_oack()
+		else:
+			self.send_window()
+
+	def datagram_received(self, packet, addr):
+		if addr != self.client:
+			self.transport.sendto(
+				error_packet(ERR_UNKNOWN_TID, "Unknown transfer ID"), addr
+			)
+			return
+
+		if len(packet) < 4:
+			return
+
+		opcode, block = struct.unpack_from("!HH", packet)
+		if opcode == OPCODE_ERROR:
+			msg = packet[4:].rstrip(b"\x00").decode("ascii", errors="replace")
+			logger.warning(f"TFTP client aborted transfer of {self.name}: {msg}")
+			self.finish(False)
+		elif opcode != OPCODE_ACK:
+			self.transport.sendto(
+				error_packet(ERR_ILLEGAL_OPERATION, "Expected ACK"), self.client
+			)
+			self.finish(False)
+		else:
+			self.handle_ack(block)
+
+	def handle_ack(self, block: int):
+		# ACKs can only be for blocks between the last acknowledged one and
+		# the last one sent, anything else is a delayed duplicate
+		delta = (block - self.acked) & 0xFFFF
+		if delta == 0 or delta > self.sent - self.acked:
+			return
+
+		self.acked += delta
+		self.retries = 0
+		if self.acked == self.block_count:
+			self.finish(True)
+			return
+
+		# If the client acknowledged a block before the end of the window,
+		# it lost the next one (RFC 7440), and the window is sent again
+		# starting from there.
+		self.send_window()
+
+	def finish(self, success: bool):
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+		if self.transport is not None:
+			self.transport.close()
+		if not self.done.done():
+			self.done.set_result(success)
+
+	def connection_lost(self, exc):
+		if not self.done.done():
+			self.done.set_result(False)
+
+	def log_done(self):
+		duration = time.monotonic() - self.start_time
+		rate = len(self.data) / duration / 1024 if duration else 0
+		logger.info(
+			f"Sent {self.name} ({len(self.data)} bytes) over TFTP in {duration:.2f}s "
+			f"({rate:.0f} KiB/s, blksize {self.blksize}, windowsize {self.windowsize})"
+		)
+
+
+class TFTPServer(asyncio.DatagramProtocol):
+	"""
+	TFTP server for a set of files, given as a dict mapping the file names
+	which can be requested to the paths of the files. Block and window sizes
+	requested by clients are capped to max_blksize and max_windowsize.
+	on_complete(name, client) is called after each successful transfer.
+	"""
+
+	def __init__(
+		self,
+		files: dict,
+		max_blksize: int = ETHERNET_BLKSIZE,
+		max_windowsize: int = 16,
+		timeout: float = 1,
+		retries: int = 5,
+		on_complete=None,
+	):
+		self.files = files
+		self.max_blksize = max_blksize
+		self.max_windowsize = max_windowsize
+		self.timeout = timeout
+		self.retries = retries
+		self.on_complete = on_complete
+		self.host = None
+		self.transport = None
+		self.transfers = {}
+		self.tasks = set()
+		# set each time a transfer starts or ends
+		self.transfers_changed = asyncio.Event()
+
+	async def start(self, host: str, port: int):
+		self.host = host
+		await asyncio.get_running_loop().create_datagram_endpoint(
+			lambda: self, local_addr=(host, port)
+		)
+
+	def connection_made(self, transport):
+		self.transport = transport
+
+	def datagram_received(self, packet, addr):
+		if len(packet) < 2:
+			return
+
+		opcode = struct.unpack_from("!H", packet)[0]
+		try:
+			if opcode == OPCODE_WRQ:
+				raise TFTPError(ERR_ACCESS_VIOLATION, "Read-only server")
+			elif opcode != OPCODE_RRQ:
+				raise TFTPError(ERR_ILLEGAL_OPERATION, "Expected RRQ")
+
+			name, mode, options = parse_request(packet)
+			if mode != "octet":
+				raise TFTPError(ERR_NOT_DEFINED, f"Unsupported mode {mode}")
+
+			path = self.files.get(name)
+			if path is None:
+				raise TFTPError(ERR_FILE_NOT_FOUND, f"File {name} not found")
+
+			with open(path, "rb") as file:
+				data = file.read()
+		except TFTPError as err:
+			logger.warning(f"TFTP request from {addr} rejected: {err}")
+			self.transport.sendto(error_packet(err.code, str(err)), addr)
+			return
+		except OSError as err:
+			logger.warning(f"TFTP request from {addr} failed: {err}")
+			self.transport.sendto(error_packet(ERR_NOT_DEFINED, str(err)), addr)
+			return
+
+		if addr in self.transfers:
+			# the client resent its request before getting our first reply
+			logger.debug(f"Ignoring duplicate TFTP request from {addr}")
+			return
+
+		logger.info(f"TFTP request for {name} from {addr[0]}")
+		task = asyncio.ensure_future(self.run_transfer(addr, name, data, options))
+		self.tasks.add(task)
+		task.add_done_callback(self.tasks.discard)
+
+	async def run_transfer(self, client: tuple, name: str, data, options: dict):
+		transfer = TFTPTransfer(self, client, name, data, options)
+		self.transfers[client] = transfer
+		self.transfers_changed.set()
+		try:
+			await asyncio.get_running_loop().create_datagram_endpoint(
+				lambda: transfer, local_addr=(self.host, 0)
+			)
+			success = await transfer.done
+		finally:
+			del self.transfers[client]
+			transfer.finish(False)
+			self.transfers_changed.set()
+
+		if success:
+			transfer.log_done()
+			if self.on_complete is not None:
+				self.on_complete(name, client)
+
+	def close(self):
+		if self.transport is not None:
+			self.transport.close()
+		for transfer in list(self.transfers.values()):
+			transfer.finish(False)
@@ -0,0 +1,168 @@
+# This file is part of Snagboot
+# Copyright (C) 2026 Bootlin
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+XMODEM-CRC, XMODEM-1K and YMODEM sender, for receivers which request CRC
+checksums by pinging with 'C', such as the AM335x ROM code and U-Boot SPL.
+
+YMODEM sends the file name and size in a header block before the data and
+ends the batch with an empty header, SPL's loader uses it with 1024-byte
+blocks, which take eight times less round trips than XMODEM's 128-byte
+blocks.
+"""
+
+import binascii
+import logging
+import time
+
+logger = logging.getLogger("snagrecover")
+
+SOH = b"\x01"
+STX = b"\x02"
+EOT = b"\x04"
+ACK = b"\x06"
+NAK = b"\x15"
+CAN = b"\x18"
+CRC = b"C"
+# padding of the last data block
+CPMEOF = 0x1A
+
+SHORT_BLOCK_SIZE = 128
+LONG_BLOCK_SIZE = 1024
+
+
+def build_block(seq: int, payload: bytes, pad: int = CPMEOF) -> bytes:
+	"""
+	Build a block with the given sequence number, using a 128-byte block if
+	the payload fits, and a 1024-byte block otherwise.
+	"""
+	if len(payload) <= SHORT_BLOCK_SIZE:
+		start, size = SOH, SHORT_BLOCK_SIZE
+	else:
+		start, size = STX, LONG_BLOCK_SIZE
+
+	data = bytes(payload) + bytes([pad]) * (size - len(payload))
+	seq &= 0xFF
+	return (
+		start
+		+ bytes([seq, 0xFF - seq])
+		+ data
+		+ binascii.crc_hqx(data, 0).to_bytes(2, "big")
+	)
+
+
+def build_header(name: str, size: int) -> bytes:
+	"""
+	Build a YMODEM header block, or the empty header which ends a batch if
+	name is empty.
+	"""
+	if not name:
+		return build_block(0, b"", pad=0)
+
+	info = name.encode() + b"\x00" + str(size).encode() + b"\x00"
+	return build_block(0, info, pad=0)
+
+
+class ModemSender:
+	"""
+	Sends files over port, which should have a read timeout shorter than
+	timeout. The receiver is expected to have pinged with 'C' before send()
+	is called. callback(sent, size) is called after each acknowledged data
+	block.
+	"""
+
+	def __init__(self, port, timeout: float = 5, retries: int = 10, callback=None):
+		self.port = port
+		self.timeout = timeout
+		self.retries = retries
+		self.callback = callback
+
+	def wait_response(self, expected: list) -> bytes:
+		"""
+		Return the first byte from the receiver which is in expected, or
+		b"" after timeout seconds. Other bytes, e.g. leftover pings or
+		console output, are skipped.
+		"""
+		deadline = time.monotonic() + self.timeout
+		while time.monotonic() < deadline:
+			c = self.port.read(1)
+			if c == CAN:
+				if self.port.read(1) == CAN:
+					raise Exception("Transfer cancelled by receiver")
+				continue
+			if c in expected:
+				return c
+
+		return b""
+
+	def send_block(self, block: bytes, name: str):
+		for _ in range(self.retries):
+			self.port.write(block)
+			response = self.wait_response([ACK, NAK])
+			if response == ACK:
+				return
+			logger.debug(f"{name} not acknowledged, resending")
+
+		raise Exception(f"Too many retries sending {name}")
+
+	def wait_crc_ping(self):
+		if self.wait_response([CRC]) != CRC:
+			raise Exception("Timeout waiting for receiver ping")
+
+	def send_eot(self):
+		"""
+		YMODEM receivers usually NAK the first EOT to make sure it isn't
+		noise, XMODEM receivers ACK it directly.
+		"""
+		for _ in range(self.retries):
+			self.port.write(EOT)
+			if self.wait_response([ACK, NAK]) == ACK:
+				return
+
+		raise Exception("EOT not acknowledged")
+
+	def send(self, file, size: int, block_size: int = LONG_BLOCK_SIZE, name=None):
+		"""
+		Send size bytes read from file, in blocks of block_size bytes. If
+		name is given, the file is sent as a single-file YMODEM batch,
+		otherwise XMODEM is used.
+		"""
+		if name is not None:
+			self.send_block(build_header(name, size), "YMODEM header")
+			self.wait_crc_ping()
+
+		seq = 1
+		sent = 0
+		while sent < size:
+			payload = file.read(min(block_size, size - sent))
+			if not payload:
+				raise Exception(f"Unexpected end of file after {sent} bytes")
+
+			self.send_block(build_block(seq, payload), f"block {seq}")
+			seq += 1
+			sent += len(payload)
+			if self.callback is not None:
+				self.callback(sent, size)
+
+		self.send_eot()
+
+		if name is not None:
+			# end the batch, unless the receiver doesn't wait for it
+			if self.wait_response([CRC]) == CRC:
+				self.port.write(build_header("", 0))
+				self.wait_response([ACK])
@@ -20,6 +20,7 @@
 import serial
 from snagrecover.config import recovery_config
 from snagrecover.firmware.firmware import run_firmware
+from snagrecover.firmware.am335x_fw import am335x_netboot
 import subprocess
 import os
 import sys
@@ -35,6 +36,11 @@ def main():
 			baudrate=recovery_config["args"]["baudrate"],
 		)
 		run_firmware(port, "spl")
+		uboot_baudrate = recovery_config["args"]["uboot_baudrate"]
+		if uboot_baudrate is not None:
+			# SPL was built with a CONFIG_BAUDRATE different from the ROM's
+			port.baudrate = uboot_baudrate
+			port.reset_input_buffer()
 		run_firmware(port, "u-boot")
 		port.close()
 	else:
@@ -50,7 +56,6 @@ def main():
 			logger.error("Did you run sudo am335x_usb_setup.sh?")
 			sys.exit(-1)
 
-		# Install and run SPL
-		run_firmware(None, "spl")
-		# Install and run U-Boot
-		run_firmware(None, "u-boot")
+		# Serve SPL to the ROM code and U-Boot to SPL, boards can be at
+		# different stages at the same time
+		am335x_netboot(["spl", "u-boot"], recovery_config["args"]["am335x_boards"])
@@ -5,11 +5,12 @@ logger = logging.getLogger("snagrecover")
 from snagrecover.firmware.firmware import run_firmware
 from snagrecover.utils import get_usb
 from snagrecover.config import recovery_config
+from snagrecover.protocols import dfu
 import time
 
 
 def send_firmware(dev, firmware):
-	run_firmware(dev, firmware)
+	run_firmware(dfu.DFUSession(dev, stm32=False), firmware)
 	# USB device should re-enumerate at this point
 	usb.util.dispose_resources(dev)
 	# without this delay, USB device will be present but not ready
@@ -26,6 +27,6 @@ def main():
 	send_firmware(dev, "tispl")
 	dev = get_usb(usb_addr)
 	time.sleep(1)
-	run_firmware(dev, "u-boot")
+	run_firmware(dfu.DFUSession(dev, stm32=False), "u-boot")
 
 	time.sleep(2)
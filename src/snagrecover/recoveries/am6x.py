@@ -3,40 +3,45 @@ import logging
 
 logger = logging.getLogger("snagrecover")
 from snagrecover.firmware.firmware import run_firmware
-from snagrecover.utils import get_usb
+from snagrecover.utils import get_usb, wait_for_reenumeration
 from snagrecover.config import recovery_config
 from snagrecover.protocols import dfu
 import time
 
 
-def send_tiboot3(dev):
-	run_firmware(dev, "tiboot3")
+def send_tiboot3(dev, dfu_cmd: dfu.DFUSession):
+	usb_addr = recovery_config["usb_path"]
+	address = dev.address
+	run_firmware(dfu_cmd, "tiboot3")
 	# USB device should re-enumerate at this point
 	usb.util.dispose_resources(dev)
-	# without this delay, USB device will be present but not ready
-	time.sleep(1)
+	# until then, the ROM device is still present but not ready
+	wait_for_reenumeration(usb_addr, address, 1)
 
 	if recovery_config["soc_model"].startswith(("am654", "j721e")):
-		dev = get_usb(recovery_config["usb_path"])
-		run_firmware(dev, "sysfw")
-		time.sleep(1)
+		dev = get_usb(usb_addr)
+		address = dev.address
+		run_firmware(dfu.DFUSession(dev, stm32=False), "sysfw")
+		wait_for_reenumeration(usb_addr, address, 1)
 
 
 def main():
 	usb_addr = recovery_config["usb_path"]
 	dev = get_usb(usb_addr)
 
-	send_tiboot3(dev)
+	send_tiboot3(dev, dfu.DFUSession(dev, stm32=False))
 
 	dev = get_usb(usb_addr)
+	dfu_cmd = dfu.DFUSession(dev, stm32=False)
 
 	# Some versions of U-Boot on some devices require tiboot3 to be run twice
-	if dfu.search_partid(dev, "bootloader") is not None:
-		send_tiboot3(dev)
+	if dfu_cmd.search_partid("bootloader") is not None:
+		send_tiboot3(dev, dfu_cmd)
 		dev = get_usb(usb_addr)
+		dfu_cmd = dfu.DFUSession(dev, stm32=False)
 
-	run_firmware(dev, "tispl")
-	run_firmware(dev, "u-boot")
+	run_firmware(dfu_cmd, "tispl")
+	run_firmware(dfu_cmd, "u-boot")
 
 	time.sleep(2)
 
@@ -46,4 +51,4 @@ def main():
 
 	dev = get_usb(usb_addr, error_on_fail=False)
 	if dev is not None:
-		run_firmware(dev, "u-boot")
+		run_firmware(dfu.DFUSession(dev, stm32=False), "u-boot")
@@ -45,12 +45,13 @@ from time import sleep
 from snagrecover.firmware.firmware import run_firmware
 from snagrecover.utils import get_usb
 from snagrecover.config import recovery_config
+from snagrecover import usb_stats
 
 
 def main():
 	# USB ENUMERATION
 	usb_path = recovery_config["usb_path"]
-	dev = get_usb(usb_path)
+	dev = usb_stats.instrument(get_usb(usb_path), "amlogic")
 
 	protocol_1_socs = [
 		# G12A
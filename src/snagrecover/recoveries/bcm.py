@@ -5,19 +5,20 @@ from time import sleep
 from snagrecover.firmware.firmware import run_firmware
 from snagrecover.utils import get_usb
 from snagrecover.config import recovery_config
+from snagrecover import usb_stats
 
 
 def main():
 	# USB ENUMERATION
 	usb_path = recovery_config["usb_path"]
-	dev = get_usb(usb_path)
+	dev = usb_stats.instrument(get_usb(usb_path), "bcm")
 
 	# Download bootcode
 	run_firmware(dev, "bootfiles", "bootcode")
 
 	logger.info("Waiting for bootcode to start...")
 	sleep(2)
-	dev = get_usb(usb_path)
+	dev = usb_stats.instrument(get_usb(usb_path), "bcm")
 
 	# Serve firmwares to bootcode (will also serve firmwares "boot" and "u-boot")
 	run_firmware(dev, "bootfiles", "bootcode_firmwares")
@@ -48,11 +48,15 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 from snagrecover.protocols.hid import HIDDevice
-import time
 import usb
 from snagrecover.firmware.firmware import run_firmware
 from snagrecover.config import recovery_config
-from snagrecover.utils import access_error, get_usb, prettify_usb_addr
+from snagrecover.utils import (
+	access_error,
+	get_usb,
+	prettify_usb_addr,
+	wait_for_reenumeration,
+)
 from snagrecover.protocols.imx_sdp import SDPCommand
 import logging
 
@@ -170,19 +174,14 @@ def main():
 
 	# WAIT FOR SPL DEVICE
 	logger.info("Waiting for SPL device...")
-	t0 = time.time()
-	while time.time() - t0 < 5:
-		# The SPL device should be found at the same USB path as the ROM device
-		usb_dev = get_usb(rom_path, error_on_fail=False)
-		if usb_dev is not None and usb_dev.address != rom_devnum:
-			logger.info(
-				f"Found USB device at {prettify_usb_addr(rom_path)} for SPL stage!"
-			)
-			break
-
-		time.sleep(1)
-
-	if usb_dev is None:
+	# The SPL device should be found at the same USB path as the ROM device.
+	# The previous polling loop ran for 5 seconds, but each of its get_usb()
+	# calls retried for up to 10 seconds while the device was gone, so 10
+	# seconds is still within its worst case.
+	usb_dev = wait_for_reenumeration(rom_path, rom_devnum, 10)
+	if usb_dev is not None:
+		logger.info(f"Found USB device at {prettify_usb_addr(rom_path)} for SPL stage!")
+	else:
 		access_error("SPL USB HID", f"{prettify_usb_addr(rom_path)}")
 
 	sdp_cmd = SDPCommand(HIDDevice(usb_dev))
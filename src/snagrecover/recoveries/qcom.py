@@ -22,7 +22,7 @@ Orchestrates firmware transfer to Qualcomm devices in EDL mode.
 """
 
 from snagrecover.protocols.qcom_sahara import QSahara
-from snagrecover.firmware.firmware import run_firmware
+from snagrecover.firmware.qcom_fw import qcom_load_images
 from snagrecover.config import recovery_config
 from snagrecover.utils import get_usb
 import logging
@@ -44,15 +44,16 @@ def main():
 	logger.debug(f"Starting Qualcomm recovery for {soc_model}")
 
 	try:
+		# Load all images before the device starts requesting them
+		firmware_list = list(recovery_config["firmware"].keys())
+		images = qcom_load_images()
+
 		usb_dev = get_usb(recovery_config["usb_path"])
 		sahara = QSahara(usb_dev)
 
-		# Transfer each firmware image
-		firmware_list = list(recovery_config["firmware"].keys())
+		# Transfer firmware images, in the order requested by the device
 		logger.info(f"Firmware images to transfer: {firmware_list}")
-
-		for fw_name in firmware_list:
-			run_firmware(sahara, fw_name)
+		sahara.transfer_images(images)
 
 		logger.debug("Qualcomm recovery complete")
 
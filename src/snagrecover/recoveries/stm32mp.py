@@ -24,7 +24,7 @@ from snagrecover.protocols import dfu
 from snagrecover.recoveries import stm32_flashlayout as flashlayout
 from snagrecover.firmware.firmware import run_firmware
 from snagrecover.config import recovery_config
-from snagrecover.utils import get_usb
+from snagrecover.utils import get_usb, wait_for_reenumeration
 import logging
 
 logger = logging.getLogger("snagrecover")
@@ -39,8 +39,8 @@ def main():
 	dev = get_usb(usb_addr)
 
 	# DOWNLOAD TF-A
-	dfu_cmd = dfu.DFU(dev)
-	run_firmware(dev, "tf-a")
+	dfu_cmd = dfu.DFUSession(dev)
+	run_firmware(dfu_cmd, "tf-a")
 	if soc_model in ["stm32mp13", "stm32mp25"]:
 		logger.info("Sending detach command to SPL...")
 		phase_id = dfu_cmd.stm32_get_phase()
@@ -51,7 +51,7 @@ def main():
 	# Snagrecover so we only download a dummy flash layout
 	if soc_model == "stm32mp15":
 		phase_id = dfu_cmd.stm32_get_phase()
-		part0 = dfu.search_partid(dev, "@Partition0", match_prefix=True)
+		part0 = dfu_cmd.search_partid("@Partition0", match_prefix=True)
 		if part0 is None:
 			raise Exception("No DFU altsetting found with iInterface='Partition0*'")
 		if phase_id == part0:
@@ -64,26 +64,28 @@ def main():
 	if soc_model == "stm32mp13":
 		time.sleep(1.5)
 
+	address = dev.address
 	try:
 		dev.reset()
 	except usb.core.USBError:
 		# this should actually fail
 		pass
-	time.sleep(0.5)
+	wait_for_reenumeration(usb_addr, address, 0.5)
 
 	usb.util.dispose_resources(dev)
 	dev = get_usb(usb_addr)
-	dfu_cmd = dfu.DFU(dev)
+	dfu_cmd = dfu.DFUSession(dev)
 
 	if soc_model == "stm32mp25":
-		run_firmware(dev, "fip-ddr")
-		time.sleep(1)
+		address = dev.address
+		run_firmware(dfu_cmd, "fip-ddr")
+		wait_for_reenumeration(usb_addr, address, 1)
 
 	usb.util.dispose_resources(dev)
 	dev = get_usb(usb_addr)
-	dfu_cmd = dfu.DFU(dev)
+	dfu_cmd = dfu.DFUSession(dev)
 
-	run_firmware(dev, "fip")
+	run_firmware(dfu_cmd, "fip")
 
 	# DETACH DFU DEVICE
 	logger.info("Sending detach command to U-Boot...")
@@ -1,9 +1,34 @@
 import usb
+import usb.backend.libusb1
+import os
 import platform
+import re
 import weakref
 import gc
 import importlib
 import sys
+from dataclasses import dataclass
+
+SYSFS_USB_DEVICES = "/sys/bus/usb/devices"
+# root hubs are named usbN and interfaces contain a ':', neither are indexed
+SYSFS_DEVICE_NAME = re.compile(r"^(\d+)-(\d+(?:\.\d+)*)$")
+
+PATH_KEYS = {"bus", "port_numbers"}
+IDS_KEYS = {"idVendor", "idProduct"}
+
+
+@dataclass(frozen=True)
+class RegistryEntry:
+	bus: int
+	port_numbers: tuple
+	address: int
+	idVendor: int
+	idProduct: int
+
+
+def read_sysfs_attr(path: str, attr: str, base: int = 10) -> int:
+	with open(os.path.join(path, attr)) as f:
+		return int(f.read().strip(), base)
 
 
 class SnagbootUSBContext:
@@ -18,9 +43,23 @@ class SnagbootUSBContext:
 	libusb context. By returning only weak references to USB device
 	objects, we can ensure that the underlying libusb context is destroyed
 	and recreated every time an enumeration is performed.
+
+	On Linux, rescans don't enumerate the bus through libusb. Instead, a
+	registry of the devices present in sysfs is updated, indexed by USB path
+	and by USB IDs. Only the entries which are new or whose device number
+	has changed since the last rescan are read again. Queries by path or by
+	IDs are answered from the registry, and libusb device objects are only
+	instantiated for the matching entries.
 	"""
 
 	devices = []
+	# sysfs device name -> RegistryEntry
+	registry = {}
+	by_path = {}
+	by_ids = {}
+	use_registry = platform.system() == "Linux" and os.path.isdir(SYSFS_USB_DEVICES)
+	# True if devices contains all the devices present at the last rescan
+	enumerated = False
 
 	def hard_rescan():
 		# delete what should be the last references to the underlying libusb context
@@ -38,12 +77,19 @@ class SnagbootUSBContext:
 			if "usb.backend.libusb1" in sys.modules:
 				importlib.reload(usb.backend.libusb1)
 
+		__class__.registry = {}
 		__class__.devices = list(usb.core.find(find_all=True))
+		__class__.enumerated = True
 		if platform.system() == "Windows":
 			__class__.check_for_libusb_bug()
 
 	def rescan():
 		__class__.devices.clear()
+		if __class__.use_registry:
+			__class__.refresh_registry()
+			__class__.enumerated = False
+			return
+
 		__class__.devices = list(usb.core.find(find_all=True))
 		if platform.system() == "Windows":
 			__class__.check_for_libusb_bug()
@@ -65,7 +111,87 @@ class SnagbootUSBContext:
 			__class__.hard_rescan()
 			__class__.check_for_libusb_bug(retry=0)
 
+	def refresh_registry():
+		registry = {}
+		for name in os.listdir(SYSFS_USB_DEVICES):
+			match = SYSFS_DEVICE_NAME.match(name)
+			if match is None:
+				continue
+
+			path = os.path.join(SYSFS_USB_DEVICES, name)
+			try:
+				address = read_sysfs_attr(path, "devnum")
+				entry = __class__.registry.get(name)
+				if entry is None or entry.address != address:
+					entry = RegistryEntry(
+						bus=int(match.group(1)),
+						port_numbers=tuple(int(x) for x in match.group(2).split(".")),
+						address=address,
+						idVendor=read_sysfs_attr(path, "idVendor", 16),
+						idProduct=read_sysfs_attr(path, "idProduct", 16),
+					)
+			except (OSError, ValueError):
+				# the device was disconnected while being read
+				continue
+
+			registry[name] = entry
+
+		__class__.registry = registry
+		__class__.by_path = {}
+		__class__.by_ids = {}
+		for entry in registry.values():
+			__class__.by_path[(entry.bus, entry.port_numbers)] = entry
+			__class__.by_ids.setdefault((entry.idVendor, entry.idProduct), []).append(
+				entry
+			)
+
+	def lookup(args: dict):
+		"""
+		Return the registry entries which can match a query, or None if the
+		query isn't indexed.
+		"""
+		keys = set(args)
+		if PATH_KEYS <= keys:
+			entry = __class__.by_path.get((args["bus"], tuple(args["port_numbers"])))
+			return [] if entry is None else [entry]
+		elif IDS_KEYS <= keys:
+			return __class__.by_ids.get((args["idVendor"], args["idProduct"]), [])
+
+		return None
+
+	def instantiate(entries: list):
+		"""
+		Create libusb device objects for the registry entries which don't
+		have one yet since the last rescan.
+		"""
+		addresses = {(entry.bus, entry.address) for entry in entries}
+		addresses -= {(dev.bus, dev.address) for dev in __class__.devices}
+		if not addresses:
+			return
+
+		backend = usb.backend.libusb1.get_backend()
+		if backend is None:
+			__class__.devices += usb.core.find(
+				find_all=True,
+				custom_match=lambda dev: (dev.bus, dev.address) in addresses,
+			)
+			return
+
+		for handle in backend.enumerate_devices():
+			desc = backend.get_device_descriptor(handle)
+			if (desc.bus, desc.address) in addresses:
+				__class__.devices.append(usb.core.Device(handle, backend))
+
 	def find(**args):
+		if __class__.use_registry and not __class__.enumerated:
+			entries = __class__.lookup(args)
+			if entries is None:
+				# not indexed, fall back to a full enumeration
+				__class__.devices = list(usb.core.find(find_all=True))
+				__class__.enumerated = True
+			else:
+				__class__.instantiate(entries)
+
 		for dev in __class__.devices:
 			tests = (
 				hasattr(dev, key) and val == getattr(dev, key)
@@ -0,0 +1,306 @@
+# This file is part of Snagboot
+# Copyright (C) 2026 Bootlin
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+"""
+Opt-in instrumentation of USB transfers, to find out whether a slow
+recovery or flashing run is limited by the USB link, by the board or by
+the host.
+
+Protocol handlers wrap their device with instrument(). When statistics are
+disabled, which is the default, the device is returned as is. Otherwise,
+each write(), read() and ctrl_transfer() is timed and accounted for under
+(protocol, endpoint, command), the command being set by the protocol
+handler with label(). Transfers which fail, e.g. on a timeout or a STALL
+handshake, are accounted for as stall time.
+
+Statistics are enabled with the --usb-stats option of snagrecover and
+snagflash, and a summary is logged at the end of the run.
+
+Transfers labelled RESPONSE are those where the host waits for the device
+to report the completion of a command, such as Fastboot OKAYs or DFU
+status requests.
+"""
+
+import contextlib
+import logging
+import time
+from dataclasses import dataclass, field
+
+import usb
+
+logger = logging.getLogger("snagrecover")
+
+RESPONSE = "response"
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.0001, 0.001, 0.01, 0.1, 1]
+
+
+def format_duration(seconds: float) -> str:
+	if seconds < 0.001:
+		return f"{seconds * 1e6:.0f}us"
+	elif seconds < 1:
+		return f"{seconds * 1e3:.1f}ms"
+	return f"{seconds:.2f}s"
+
+
+def percentile(values: list, p: float) -> float:
+	"""
+	Nearest-rank percentile of a sorted list.
+	"""
+	rank = max(int(len(values) * p / 100 + 0.5), 1)
+	return values[min(rank, len(values)) - 1]
+
+
+@dataclass
+class TransferStats:
+	transfers: int = 0
+	bytes: int = 0
+	# total time spent in transfers
+	busy: float = 0
+	# time spent in transfers which failed
+	stalled: float = 0
+	latencies: list = field(default_factory=list)
+
+	def throughput(self) -> float:
+		return self.bytes / self.busy if self.busy else 0
+
+	def histogram(self) -> list:
+		counts = [0] * (len(LATENCY_BUCKETS) + 1)
+		for latency in self.latencies:
+			i = 0
+			while i < len(LATENCY_BUCKETS) and latency >= LATENCY_BUCKETS[i]:
+				i += 1
+			counts[i] += 1
+		return counts
+
+	def __str__(self):
+		latencies = sorted(self.latencies)
+		return (
+			f"{self.transfers} transfers, {self.bytes} bytes in "
+			f"{format_duration(self.busy)} ({self.throughput() / 1e6:.2f} MB/s), "
+			f"latency p50 {format_duration(percentile(latencies, 50))} "
+			f"p99 {format_duration(percentile(latencies, 99))}, "
+			f"stalled {format_duration(self.stalled)}"
+		)
+
+
+class USBStats:
+	def __init__(self):
+		self.start = time.monotonic()
+		# (protocol, endpoint, command) -> TransferStats
+		self.transfers = {}
+
+	def record(
+		self, key: tuple, nbytes: int, latency: float, stalled: bool = False
+	) -> None:
+		stats = self.transfers.get(key)
+		if stats is None:
+			stats = TransferStats()
+			self.transfers[key] = stats
+
+		stats.transfers += 1
+		stats.bytes += nbytes
+		stats.busy += latency
+		stats.latencies.append(latency)
+		if stalled:
+			stats.stalled += latency
+
+	def response_wait(self) -> float:
+		return sum(
+			stats.busy
+			for (_, _, command), stats in self.transfers.items()
+			if command == RESPONSE
+		)
+
+	def summary(self) -> list:
+		lines = [
+			f"USB transfer statistics over {format_duration(time.monotonic() - self.start)}:"
+		]
+		buckets = [f"<{format_duration(b)}" for b in LATENCY_BUCKETS]
+		buckets.append(f">={format_duration(LATENCY_BUCKETS[-1])}")
+		for (protocol, endpoint, command), stats in sorted(self.transfers.items()):
+			lines.append(f"{protocol} {endpoint} {command}: {stats}")
+			histogram = " ".join(
+				f"{bucket}:{count}"
+				for bucket, count in zip(buckets, stats.histogram(), strict=True)
+				if count
+			)
+			lines.append(f"  latency histogram: {histogram}")
+
+		total = TransferStats()
+		for stats in self.transfers.values():
+			total.transfers += stats.transfers
+			total.bytes += stats.bytes
+			total.busy += stats.busy
+			total.stalled += stats.stalled
+			total.latencies += stats.latencies
+		if total.transfers:
+			lines.append(f"total: {total}")
+		lines.append(
+			f"time spent waiting for device responses: {format_duration(self.response_wait())}"
+		)
+		return lines
+
+
+stats = None
+
+
+def enable() -> USBStats:
+	global stats
+	if stats is None:
+		stats = USBStats()
+	return stats
+
+
+def log_summary() -> None:
+	if stats is None:
+		return
+
+	for line in stats.summary():
+		logger.info(line)
+
+
+def endpoint_name(endpoint) -> str:
+	address = getattr(endpoint, "bEndpointAddress", endpoint)
+	if isinstance(address, int):
+		direction = "IN" if address & usb.util.ENDPOINT_IN else "OUT"
+		return f"ep 0x{address:02x} {direction}"
+	return str(address)
+
+
+class InstrumentedDevice:
+	"""
+	Wrapper around a usb.core.Device which accounts for its transfers.
+	Other attributes are those of the wrapped device.
+	"""
+
+	def __init__(self, dev, protocol: str, stats: USBStats):
+		self.wrapped = dev
+		self.protocol = protocol
+		self.stats = stats
+		self.command = None
+
+	def __getattr__(self, name):
+		return getattr(self.wrapped, name)
+
+	def __iter__(self):
+		return iter(self.wrapped)
+
+	@contextlib.contextmanager
+	def label(self, command: str):
+		prev = self.command
+		self.command = command
+		try:
+			yield
+		finally:
+			self.command = prev
+
+	def timed(self, endpoint: str, command: str, transfer, *args, **kwargs):
+		key = (self.protocol, endpoint, self.command or command)
+		t0 = time.monotonic()
+		try:
+			ret = transfer(*args, **kwargs)
+		except Exception:
+			self.stats.record(key, 0, time.monotonic() - t0, stalled=True)
+			raise
+
+		self.stats.record(
+			key, ret if isinstance(ret, int) else len(ret), time.monotonic() - t0
+		)
+		return ret
+
+	def write(self, endpoint, data, timeout=None):
+		return self.timed(
+			endpoint_name(endpoint), "bulk", self.wrapped.write, endpoint, data, timeout
+		)
+
+	def read(self, endpoint, size_or_buffer, timeout=None):
+		return self.timed(
+			endpoint_name(endpoint),
+			"bulk",
+			self.wrapped.read,
+			endpoint,
+			size_or_buffer,
+			timeout,
+		)
+
+	def ctrl_transfer(
+		self,
+		bmRequestType,
+		bRequest,
+		wValue=0,
+		wIndex=0,
+		data_or_wLength=None,
+		timeout=None,
+	):
+		return self.timed(
+			"ep0",
+			f"request 0x{bmRequestType:02x}/0x{bRequest:02x}",
+			self.wrapped.ctrl_transfer,
+			bmRequestType,
+			bRequest,
+			wValue,
+			wIndex,
+			data_or_wLength,
+			timeout,
+		)
+
+
+class InstrumentedReportDevice(InstrumentedDevice):
+	"""
+	Wrapper around HIDDevice objects and similar adapters, whose transfers
+	don't take an endpoint.
+	"""
+
+	def write(self, data):
+		return self.timed("OUT", "report", self.wrapped.write, data)
+
+	def read(self, length, *args, **kwargs):
+		return self.timed("IN", "report", self.wrapped.read, length, *args, **kwargs)
+
+	def write_reports(self, data, report_size):
+		return self.timed(
+			"OUT", "report", self.wrapped.write_reports, data, report_size
+		)
+
+
+def instrument(dev, protocol: str):
+	"""
+	Return a wrapper of dev accounting for its transfers if statistics are
+	enabled, dev itself otherwise.
+	"""
+	if stats is None or isinstance(dev, InstrumentedDevice):
+		return dev
+
+	if isinstance(dev, usb.core.Device):
+		return InstrumentedDevice(dev, protocol, stats)
+	return InstrumentedReportDevice(dev, protocol, stats)
+
+
+def label(dev, command: str):
+	"""
+	Context manager accounting the transfers of dev to command.
+	"""
+	if isinstance(dev, InstrumentedDevice):
+		return dev.label(command)
+	return contextlib.nullcontext()
+
+
+def unwrap(dev):
+	return dev.wrapped if isinstance(dev, InstrumentedDevice) else dev
@@ -12,6 +12,7 @@ import errno
 logger = logging.getLogger("snagrecover")
 
 from snagrecover.usb import SnagbootUSBContext
+from snagrecover.hotplug import USBEventMonitor, usb_path_match, usb_ids_match
 
 import yaml
 import importlib.resources
@@ -261,14 +262,15 @@ def permissions_check(dev: usb.core.Device) -> bool:
 def wait_for_usb_ids(vid: int, pid: int, timeout_s=10) -> bool:
 	logger.info(f"Waiting for USB {prettify_usb_addr((vid, pid))}")
 
-	start_s = time.monotonic()
-	while time.monotonic() - start_s < timeout_s:
-		SnagbootUSBContext.rescan()
+	deadline = time.monotonic() + timeout_s
+	with USBEventMonitor() as monitor:
+		while (remaining := deadline - time.monotonic()) > 0:
+			SnagbootUSBContext.rescan()
 
-		if list(SnagbootUSBContext.find(idVendor=vid, idProduct=pid)) != []:
-			return True
+			if list(SnagbootUSBContext.find(idVendor=vid, idProduct=pid)) != []:
+				return True
 
-		time.sleep(USB_INTERVAL)
+			monitor.wait(min(USB_INTERVAL, remaining), usb_ids_match(vid, pid))
 
 	logger.info("Timeout")
 
@@ -279,37 +281,42 @@ def get_usb(
 	usb_path, error_on_fail=True, retries=USB_RETRIES, ready_check=active_cfg_check
 ) -> usb.core.Device:
 	pretty_addr = prettify_usb_addr(usb_path)
-	SnagbootUSBContext.rescan()
 
 	dev = None
 
 	log_access_error = True
-	for i in range(retries + 1):
-		if i > 0:
-			logger.info(f"USB retry {i}/{retries}")
-
-		SnagbootUSBContext.rescan()
-		dev_list = list(
-			SnagbootUSBContext.find(bus=usb_path[0], port_numbers=usb_path[1])
-		)
+	# each try used to be followed by a USB_INTERVAL sleep, the device is
+	# now checked again as soon as it is added
+	deadline = time.monotonic() + (retries + 1) * USB_INTERVAL
+	with USBEventMonitor() as monitor:
+		while True:
+			SnagbootUSBContext.rescan()
+			dev_list = list(
+				SnagbootUSBContext.find(bus=usb_path[0], port_numbers=usb_path[1])
+			)
 
-		nb_devs = len(dev_list)
+			nb_devs = len(dev_list)
 
-		if nb_devs == 1:
-			dev = dev_list[0]
+			if nb_devs == 1:
+				dev = dev_list[0]
 
-			if ready_check(dev):
-				return dev
+				if ready_check(dev):
+					return dev
 
-		elif nb_devs > 1:
-			logger.info(
-				f"Found too many ({nb_devs}) possible results matching {pretty_addr}!"
-			)
-			logger.warning(
-				f"Too many results for address {pretty_addr}! {str(dev_list)}"
-			)
+			elif nb_devs > 1:
+				logger.info(
+					f"Found too many ({nb_devs}) possible results matching {pretty_addr}!"
+				)
+				logger.warning(
+					f"Too many results for address {pretty_addr}! {str(dev_list)}"
+				)
 
-		time.sleep(USB_INTERVAL)
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				break
+			monitor.wait(min(USB_INTERVAL, remaining), usb_path_match(usb_path))
+			remaining = max(deadline - time.monotonic(), 0)
+			logger.info(f"USB retry, {remaining:.1f}s left")
 
 	if dev is not None and permissions_check(dev):
 		logger.error(
@@ -339,6 +346,34 @@ def get_usb(
 	return None
 
 
+def wait_for_reenumeration(
+	usb_path, old_address: int, timeout_s: float
+) -> usb.core.Device:
+	"""
+	Wait for the device at usb_path to show up with another address than
+	old_address, i.e. to re-enumerate, and return it. Return None if this
+	doesn't happen within timeout_s seconds.
+	"""
+	deadline = time.monotonic() + timeout_s
+	with USBEventMonitor() as monitor:
+		while True:
+			SnagbootUSBContext.rescan()
+			dev_list = list(
+				SnagbootUSBContext.find(bus=usb_path[0], port_numbers=usb_path[1])
+			)
+			if (
+				len(dev_list) == 1
+				and dev_list[0].address != old_address
+				and active_cfg_check(dev_list[0])
+			):
+				return dev_list[0]
+
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				return None
+			monitor.wait(min(USB_INTERVAL, remaining), usb_path_match(usb_path))
+
+
 def reset_usb(dev: usb.core.Device) -> None:
 	try:
 		dev.reset()
@@ -426,7 +461,8 @@ class BinFileHeader:
 
 	@classmethod
 	def read(cls, data, offset=0):
-		obj = cls(*struct.unpack(cls.fmt, data[offset : offset + cls.class_size]))
+		# unpack_from() avoids copying data when it is a large buffer or mmap
+		obj = cls(*struct.unpack_from(cls.fmt, data, offset))
 		obj.offset = offset
 
 		return obj
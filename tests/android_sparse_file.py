@@ -0,0 +1,326 @@
+import os
+import unittest
+import tempfile
+import random
+
+import zlib
+
+from snagflash.android_sparse_file.sparse import (
+	AndroidSparseFile,
+	SparseFileFormatError,
+	CHUNK_TYPE_RAW,
+	CHUNK_TYPE_FILL,
+	CHUNK_TYPE_DONTCARE,
+	CHUNK_TYPE_CRC32,
+)
+from snagflash.android_sparse_file.convert import img2simg, is_fill, RawSparseStream
+from snagflash.android_sparse_file.expand import SparseExpander
+from snagflash.android_sparse_file.utils import split_streaming
+from snagflash.android_sparse_file.pack import plan_split, split_packed
+from snagflash.bmaptools.BmapCopy import BmapCopy
+
+BLOCK_SIZE = 4096
+
+
+def expand_sparse(path) -> bytes:
+	sparse_file = AndroidSparseFile(True)
+	sparse_file.open(path)
+	block_size = sparse_file.file_header.block_size
+	raw = bytearray()
+	while True:
+		header, data = sparse_file.read_chunk()
+		if header is None:
+			break
+		if header.type == CHUNK_TYPE_RAW:
+			raw += data
+		elif header.type == CHUNK_TYPE_FILL:
+			raw += data * (header.size * block_size // 4)
+		elif header.type == CHUNK_TYPE_DONTCARE:
+			raw += b"\x00" * (header.size * block_size)
+	sparse_file.close()
+	return bytes(raw)
+
+
+def build_raw_image() -> bytes:
+	return (
+		random.randbytes(3 * BLOCK_SIZE)
+		+ b"\x00" * (600 * BLOCK_SIZE)
+		+ b"\xde\xad\xbe\xef" * (5 * BLOCK_SIZE // 4)
+		+ random.randbytes(300 * BLOCK_SIZE)
+		+ random.randbytes(100)
+	)
+
+
+def write_sparse_image(path, raw, crc=None):
+	# RAW, DONTCARE, FILL, RAW, optional CRC32
+	sparse_file = AndroidSparseFile(False)
+	sparse_file.open(path, BLOCK_SIZE)
+	sparse_file.write_chunk(CHUNK_TYPE_RAW, raw[: 3 * BLOCK_SIZE], 3)
+	sparse_file.write_chunk(CHUNK_TYPE_DONTCARE, [], 600)
+	sparse_file.write_chunk(CHUNK_TYPE_FILL, b"\xde\xad\xbe\xef", 5)
+	sparse_file.write_chunk(CHUNK_TYPE_RAW, raw[608 * BLOCK_SIZE :], 301)
+	if crc is not None:
+		sparse_file.write_chunk(CHUNK_TYPE_CRC32, crc.to_bytes(4, "little"), 0)
+	sparse_file.close()
+
+
+class TestAndroidSparseFile(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.sparse_path = os.path.join(self.tmpdir.name, "sparse.img")
+		self.raw = build_raw_image()
+		self.raw += b"\x00" * (-len(self.raw) % BLOCK_SIZE)
+		write_sparse_image(self.sparse_path, self.raw)
+
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def read_chunks(self, use_mmap):
+		sparse_file = AndroidSparseFile(True, use_mmap=use_mmap)
+		sparse_file.open(self.sparse_path)
+		chunks = []
+		while True:
+			header, data = sparse_file.read_chunk()
+			if header is None:
+				break
+			chunks.append((header.type, header.size, data))
+		return sparse_file, chunks
+
+	def test_mmap_read_chunk(self):
+		file_sparse, file_chunks = self.read_chunks(False)
+		mmap_sparse, mmap_chunks = self.read_chunks(True)
+
+		self.assertIsInstance(mmap_chunks[0][2], memoryview)
+		self.assertEqual(
+			[(t, n, bytes(d) if d else d) for t, n, d in mmap_chunks], file_chunks
+		)
+
+		del mmap_chunks
+		file_sparse.close()
+		mmap_sparse.close()
+
+	def test_mmap_too_small(self):
+		for size in [0, 10]:
+			with self.subTest(size=size):
+				with open(self.sparse_path, "wb") as f:
+					f.write(b"\x00" * size)
+				sparse_file = AndroidSparseFile(True, use_mmap=True)
+				with self.assertRaises(SparseFileFormatError):
+					sparse_file.open(self.sparse_path)
+				self.assertTrue(sparse_file.fd.closed)
+
+	def test_index(self):
+		for use_mmap in [False, True]:
+			with self.subTest(use_mmap=use_mmap):
+				sparse_file = AndroidSparseFile(True, use_mmap=use_mmap)
+				sparse_file.open(self.sparse_path)
+				index = sparse_file.build_index()
+				self.assertEqual([entry[0] for entry in index], [0, 3, 603, 608])
+
+				block, header, offset = index[sparse_file.find_chunk(700)]
+				self.assertEqual(header.type, CHUNK_TYPE_RAW)
+				data = sparse_file.get_data(offset + (700 - block) * BLOCK_SIZE, 16)
+				self.assertEqual(
+					bytes(data), self.raw[700 * BLOCK_SIZE : 700 * BLOCK_SIZE + 16]
+				)
+
+				# Sequential reads are not affected by the index
+				header, _ = sparse_file.read_chunk()
+				self.assertEqual((header.type, header.size), (CHUNK_TYPE_RAW, 3))
+				sparse_file.close()
+
+
+class TestImg2Simg(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.raw_path = os.path.join(self.tmpdir.name, "raw.img")
+		self.sparse_path = os.path.join(self.tmpdir.name, "sparse.img")
+		self.raw = build_raw_image()
+		with open(self.raw_path, "wb") as f:
+			f.write(self.raw)
+
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def padded_raw(self) -> bytes:
+		return self.raw + b"\x00" * (-len(self.raw) % BLOCK_SIZE)
+
+	def test_roundtrip(self):
+		chunks = img2simg(self.raw_path, self.sparse_path)
+
+		# RAW, FILL 0, FILL 0xdeadbeef, then RAW split at 256 blocks
+		self.assertEqual(chunks, 5)
+		self.assertEqual(expand_sparse(self.sparse_path), self.padded_raw())
+
+	def test_is_fill(self):
+		block = b"\xde\xad\xbe\xef" * (BLOCK_SIZE // 4)
+		self.assertTrue(is_fill(block, 0, BLOCK_SIZE))
+		self.assertTrue(is_fill(b"\x00" + block, 1, BLOCK_SIZE + 1))
+		self.assertFalse(is_fill(block[:-1] + b"\x00", 0, BLOCK_SIZE))
+		self.assertFalse(is_fill(b"\x00" * 4 + block[4:], 0, BLOCK_SIZE))
+
+	def test_bmap_dontcare(self):
+		bmap_path = self.raw_path + ".bmap"
+		blocks = len(self.padded_raw()) // BLOCK_SIZE
+		with open(bmap_path, "w") as f:
+			f.write(
+				f"""<?xml version="1.0" ?>
+<bmap version="1.2">
+	<ImageSize> {len(self.raw)} </ImageSize>
+	<BlockSize> {BLOCK_SIZE} </BlockSize>
+	<BlocksCount> {blocks} </BlocksCount>
+	<MappedBlocksCount> {blocks - 600} </MappedBlocksCount>
+	<BlockMap>
+		<Range> 0-2 </Range>
+		<Range> 603-{blocks - 1} </Range>
+	</BlockMap>
+</bmap>
+"""
+			)
+
+		img2simg(self.raw_path, self.sparse_path, bmap=bmap_path)
+
+		sparse_file = AndroidSparseFile(True)
+		sparse_file.open(self.sparse_path)
+		types = []
+		while True:
+			header, _ = sparse_file.read_chunk()
+			if header is None:
+				break
+			types.append(header.type)
+		sparse_file.close()
+
+		self.assertEqual(types[1], CHUNK_TYPE_DONTCARE)
+		self.assertEqual(expand_sparse(self.sparse_path), self.padded_raw())
+
+	def test_stream_split(self):
+		dest = os.path.join(self.tmpdir.name, "split.img")
+		raw = bytearray(len(self.padded_raw()))
+		for split_file in split_streaming(
+			RawSparseStream(self.raw_path), dest, 0x40000
+		):
+			split_raw = expand_sparse(split_file)
+			self.assertEqual(len(split_raw), len(raw))
+			# DONTCARE regions expand to zeroes, so OR-ing splits rebuilds the image
+			raw = bytearray(a | b for a, b in zip(raw, split_raw, strict=True))
+
+		self.assertEqual(bytes(raw), self.padded_raw())
+
+
+class TestSparseExpander(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.sparse_path = os.path.join(self.tmpdir.name, "sparse.img")
+		self.raw = build_raw_image()
+		self.raw += b"\x00" * (-len(self.raw) % BLOCK_SIZE)
+
+		write_sparse_image(self.sparse_path, self.raw)
+
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def test_read(self):
+		with SparseExpander(self.sparse_path) as expander:
+			self.assertEqual(expander.size, len(self.raw))
+			self.assertEqual(expander.read(), self.raw)
+
+	def test_seek(self):
+		with SparseExpander(self.sparse_path) as expander:
+			for _ in range(100):
+				offset = random.randint(0, len(self.raw))
+				length = random.randint(0, 3 * BLOCK_SIZE)
+				expander.seek(offset)
+				self.assertEqual(
+					expander.read(length),
+					self.raw[offset : offset + length],
+					msg=f"Incorrect read at offset 0x{offset:x}",
+				)
+
+	def test_bmap_copy(self):
+		bmap_path = os.path.join(self.tmpdir.name, "sparse.bmap")
+		dest_path = os.path.join(self.tmpdir.name, "dest.img")
+
+		with SparseExpander(self.sparse_path) as expander:
+			self.assertEqual(expander.mapped_ranges(), [(0, 2), (603, 908)])
+
+			with open(bmap_path, "w") as bmap_file:
+				expander.write_bmap(bmap_file)
+
+			with open(bmap_path, "rb") as bmap_file, open(dest_path, "wb+") as dest:
+				BmapCopy(expander, dest, bmap_file, expander.size).copy(False, True)
+
+		with open(dest_path, "rb") as dest:
+			self.assertEqual(dest.read(), self.raw)
+
+
+class TestSplitCrc32(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.sparse_path = os.path.join(self.tmpdir.name, "sparse.img")
+		self.dest = os.path.join(self.tmpdir.name, "split.img")
+		self.raw = build_raw_image()
+		self.raw += b"\x00" * (-len(self.raw) % BLOCK_SIZE)
+
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def test_valid_crc(self):
+		write_sparse_image(self.sparse_path, self.raw, zlib.crc32(self.raw))
+		splits = list(split_streaming(self.sparse_path, self.dest, 0x40000))
+		self.assertGreater(len(splits), 1)
+
+	def test_invalid_crc(self):
+		write_sparse_image(self.sparse_path, self.raw, zlib.crc32(self.raw) ^ 1)
+		with self.assertRaises(SparseFileFormatError):
+			for _ in split_streaming(self.sparse_path, self.dest, 0x40000):
+				pass
+
+		# validation can be disabled
+		list(split_streaming(self.sparse_path, self.dest, 0x40000, False))
+
+	def test_packed_invalid_crc(self):
+		write_sparse_image(self.sparse_path, self.raw, zlib.crc32(self.raw) ^ 1)
+		splits = split_packed(self.sparse_path, self.dest, 0x40000)
+		# rejected before the first fragment is written
+		with self.assertRaises(SparseFileFormatError):
+			next(splits)
+		self.assertFalse(os.path.exists(self.dest))
+
+		list(split_packed(self.sparse_path, self.dest, 0x40000, validate_crc=False))
+
+
+class TestFragmentPacker(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.sparse_path = os.path.join(self.tmpdir.name, "sparse.img")
+		self.dest = os.path.join(self.tmpdir.name, "split.img")
+		self.raw = build_raw_image()
+		self.raw += b"\x00" * (-len(self.raw) % BLOCK_SIZE)
+		write_sparse_image(self.sparse_path, self.raw, zlib.crc32(self.raw))
+
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def test_split_packed(self):
+		for bufsize in [0x6000, 0x40000, 0x80000 + 100, 0x100000]:
+			with self.subTest(bufsize=bufsize):
+				report = plan_split(self.sparse_path, bufsize)
+				greedy = sum(
+					1 for _ in split_streaming(self.sparse_path, self.dest, bufsize)
+				)
+				self.assertLessEqual(report.fragments, greedy)
+
+				raw = 0
+				fragments = 0
+				wire_bytes = 0
+				for split_file in split_packed(self.sparse_path, self.dest, bufsize):
+					size = os.path.getsize(split_file)
+					self.assertLessEqual(size, bufsize)
+					wire_bytes += size
+					fragments += 1
+					# DONTCARE regions expand to zeroes
+					raw |= int.from_bytes(expand_sparse(split_file), "little")
+
+				self.assertEqual(fragments, report.fragments)
+				self.assertEqual(wire_bytes, report.wire_bytes)
+				self.assertEqual(raw.to_bytes(len(self.raw), "little"), self.raw)
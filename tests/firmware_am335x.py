@@ -0,0 +1,147 @@
+import socket
+import unittest
+from unittest.mock import MagicMock, patch
+
+from snagrecover.config import recovery_config
+from snagrecover.firmware import am335x_fw
+from snagrecover.firmware.am335x_fw import AM335xNetboot
+from snagrecover.protocols import bootp
+
+
+def bootp_request(mac: bytes, vendor_class: bytes = None) -> bytes:
+	packet = bytearray(300)
+	packet[0] = 1
+	packet[28:34] = mac
+	vend = bootp.DHCP_MAGIC_COOKIE + b"\x00"
+	if vendor_class is not None:
+		vend += bytes([bootp.BootpRequest.VENDOR_CLASS_TAG, len(vendor_class)])
+		vend += vendor_class
+	vend += bytes([bootp.BootpRequest.STOP_TAG])
+	packet[236 : 236 + len(vend)] = vend
+	return bytes(packet)
+
+
+ROM_MAC = bytes([0x11] * 6)
+SPL_MAC = bytes([0x22] * 6)
+
+
+class TestBootp(unittest.TestCase):
+	def test_vendor_class(self):
+		req = bootp.BootpRequest(bootp_request(ROM_MAC, b"AM335x ROM"))
+		self.assertEqual(req.chaddr, "11:11:11:11:11:11")
+		self.assertEqual(req.vendor_class, "AM335x ROM")
+
+		req = bootp.BootpRequest(bootp_request(ROM_MAC))
+		self.assertEqual(req.vendor_class, "")
+
+	def test_reply_on_request_interface(self):
+		server = bootp.BootpServer(
+			lambda req, local_ip: ("192.168.3.101", local_ip, "spl")
+		)
+		server.sock = MagicMock()
+		pktinfo = (7, bytes([192, 168, 3, 100]), bytes(4))
+		server.handle(bootp_request(ROM_MAC, b"AM335x ROM"), ("0.0.0.0", 68), pktinfo)
+
+		[reply], [(level, cmsg_type, cmsg)], dest = server.sock.sendmsg.call_args.args
+		self.assertEqual(dest, ("255.255.255.255", 68))
+		self.assertEqual((level, cmsg_type), (socket.IPPROTO_IP, bootp.IP_PKTINFO))
+		self.assertEqual(bootp.IN_PKTINFO.unpack(cmsg)[0], 7)
+		self.assertEqual(reply[0], 2)
+		self.assertEqual(bootp.parse_ipv4(reply[16:20]), "192.168.3.101")
+		self.assertEqual(bootp.parse_ipv4(reply[20:24]), "192.168.3.100")
+		self.assertEqual(reply[108:112], b"spl\x00")
+
+	def test_ignored_request(self):
+		server = bootp.BootpServer(lambda req, local_ip: None)
+		server.sock = MagicMock()
+		server.handle(bootp_request(ROM_MAC), ("0.0.0.0", 68), None)
+		server.handle(b"\x07" * 300, ("0.0.0.0", 68), None)
+
+		server.sock.sendto.assert_not_called()
+		server.sock.sendmsg.assert_not_called()
+
+
+class TestAM335xNetboot(unittest.TestCase):
+	def setUp(self):
+		firmware = {"spl": {"path": "spl.bin"}, "u-boot": {"path": "u-boot.img"}}
+		config = patch.dict(recovery_config, {"firmware": firmware})
+		config.start()
+		self.addCleanup(config.stop)
+		self.netboot = AM335xNetboot(["spl", "u-boot"])
+
+	def lease(self, mac: bytes, vendor_class: bytes, local_ip: str) -> tuple:
+		req = bootp.BootpRequest(bootp_request(mac, vendor_class))
+		return self.netboot.lease(req, local_ip)
+
+	def test_stages(self):
+		self.assertEqual(
+			self.lease(ROM_MAC, b"AM335x ROM", "192.168.0.100"),
+			("192.168.0.101", "192.168.0.100", "spl"),
+		)
+		# another board, on another interface
+		self.assertEqual(
+			self.lease(SPL_MAC, b"AM335x U-Boot SPL", "192.168.1.100"),
+			("192.168.1.101", "192.168.1.100", "u-boot"),
+		)
+		# retried requests get the same lease
+		self.assertEqual(
+			self.lease(ROM_MAC, b"AM335x ROM", "192.168.0.100")[0], "192.168.0.101"
+		)
+
+		self.netboot.transfer_done("spl", ("192.168.0.101", 1234))
+		self.assertEqual(self.netboot.recovered, set())
+		self.netboot.transfer_done("u-boot", ("192.168.1.101", 1234))
+		self.assertEqual(self.netboot.recovered, {"22:22:22:22:22:22"})
+
+		# the address of a board is released once its transfer is done
+		self.assertEqual(
+			self.lease(SPL_MAC, b"AM335x U-Boot SPL", "192.168.0.100")[0],
+			"192.168.0.101",
+		)
+
+	def test_same_subnet(self):
+		self.lease(ROM_MAC, b"AM335x ROM", "192.168.0.100")
+		self.assertEqual(
+			self.lease(SPL_MAC, b"AM335x ROM", "192.168.0.100")[0], "192.168.0.102"
+		)
+
+	def test_unknown_vendor_class(self):
+		self.assertEqual(self.lease(ROM_MAC, None, "192.168.0.100")[2], "spl")
+		self.netboot.transfer_done("spl", ("192.168.0.101", 1234))
+		self.assertEqual(self.lease(ROM_MAC, b"custom", "192.168.0.100")[2], "u-boot")
+
+	def test_unknown_interface(self):
+		self.assertEqual(
+			self.lease(ROM_MAC, b"AM335x ROM", None),
+			("192.168.0.101", "192.168.0.100", "spl"),
+		)
+
+	def test_start_timeout(self):
+		self.lease(ROM_MAC, b"AM335x ROM", "192.168.0.100")
+		self.lease(SPL_MAC, b"AM335x U-Boot SPL", "192.168.0.100")
+		self.assertGreater(self.netboot.check_leases(2), 0)
+		with patch.dict(am335x_fw.server_config, {"tftp_start_timeout": 0}):
+			# a board is busy, the other one gave up
+			self.netboot.tftp.transfers[("192.168.0.101", 1234)] = MagicMock()
+			self.assertIsNone(self.netboot.check_leases(2))
+			self.assertEqual(self.netboot.failed, {"22:22:22:22:22:22"})
+			self.assertIn("11:11:11:11:11:11", self.netboot.leases)
+
+			self.netboot.tftp.transfers.clear()
+			with self.assertRaisesRegex(Exception, "TFTP request"):
+				self.netboot.check_leases(1)
+
+	def test_start_timeout_retry(self):
+		self.lease(ROM_MAC, b"AM335x ROM", "192.168.0.100")
+		with patch.dict(am335x_fw.server_config, {"tftp_start_timeout": 0}):
+			self.netboot.check_leases(2)
+		self.assertEqual(self.netboot.failed, {"11:11:11:11:11:11"})
+
+		# the board retries and gets served this time
+		self.lease(ROM_MAC, b"AM335x ROM", "192.168.0.100")
+		self.assertEqual(self.netboot.failed, set())
+		self.netboot.transfer_done("spl", ("192.168.0.101", 1234))
+		self.lease(ROM_MAC, b"AM335x U-Boot SPL", "192.168.0.100")
+		self.netboot.transfer_done("u-boot", ("192.168.0.101", 1234))
+		self.assertEqual(self.netboot.recovered, {"11:11:11:11:11:11"})
+		self.assertEqual(self.netboot.failed, set())
@@ -0,0 +1,184 @@
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from snagrecover.firmware.bcm import (
+	BootFiles,
+	get_bootfiles,
+	get_fileblob_from_bootfiles,
+	get_patched_boot_fw,
+)
+from snagrecover.protocols.bcm import send_blob
+
+
+def make_tar(mode: str) -> bytes:
+	tar_blob = io.BytesIO()
+	with tarfile.open(fileobj=tar_blob, mode=mode) as tar_file:
+
+		def add(name: str, data: bytes = b"", **attrs):
+			info = tarfile.TarInfo(name)
+			info.size = len(data)
+			for attr, value in attrs.items():
+				setattr(info, attr, value)
+			tar_file.addfile(info, io.BytesIO(data))
+
+		add("./bootcode4.bin", b"bootcode v1")
+		add("2712", type=tarfile.DIRTYPE)
+		add("2712/bootcode5.bin", b"bootcode5" * 100)
+		add("2712/start4.elf", type=tarfile.SYMTYPE, linkname="../start.elf")
+		add("start.elf", b"start")
+		# updated file, appended to the archive
+		add("bootcode4.bin", b"bootcode v2")
+
+	return tar_blob.getvalue()
+
+
+def fake_modify_boot_fw(boot_path: str, uboot_blob: bytes) -> None:
+	with open(boot_path, "ab") as boot_file:
+		boot_file.write(uboot_blob)
+
+
+@patch("snagrecover.firmware.bcm.modify_boot_fw", side_effect=fake_modify_boot_fw)
+class TestPatchedBootCache(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.cache_dir = os.path.join(self.tmpdir.name, "cache")
+		self.boot_path = os.path.join(self.tmpdir.name, "boot.img")
+		with open(self.boot_path, "wb") as boot_file:
+			boot_file.write(b"boot")
+
+		env = patch.dict(os.environ, {"SNAGBOOT_CACHE_DIR": self.cache_dir})
+		env.start()
+		self.addCleanup(env.stop)
+
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def patched(self, uboot_blob: bytes) -> tuple:
+		with tempfile.TemporaryDirectory() as tempdir:
+			path = get_patched_boot_fw(self.boot_path, uboot_blob, tempdir)
+			with open(path, "rb") as patched_file:
+				return (path, patched_file.read())
+
+	def test_cache_hit(self, modify_boot_fw):
+		path, data = self.patched(b"u-boot")
+		self.assertEqual(data, b"bootu-boot")
+		self.assertEqual(os.path.dirname(path), os.path.join(self.cache_dir, "bcm"))
+		self.assertEqual(modify_boot_fw.call_count, 1)
+
+		self.assertEqual(self.patched(b"u-boot"), (path, data))
+		self.assertEqual(modify_boot_fw.call_count, 1)
+		# no temporary file left in the cache
+		self.assertEqual(os.listdir(os.path.dirname(path)), [os.path.basename(path)])
+
+	def test_cache_key(self, modify_boot_fw):
+		path, _ = self.patched(b"u-boot")
+
+		other_path, data = self.patched(b"u-boot v2")
+		self.assertNotEqual(other_path, path)
+		self.assertEqual(data, b"bootu-boot v2")
+
+		with open(self.boot_path, "wb") as boot_file:
+			boot_file.write(b"boot v2")
+		other_path, data = self.patched(b"u-boot")
+		self.assertNotEqual(other_path, path)
+		self.assertEqual(data, b"boot v2u-boot")
+
+		with patch("snagrecover.firmware.bcm.SNAGRECOVER_CONFIG_SECTION", "[all]\n"):
+			self.assertNotEqual(self.patched(b"u-boot")[0], other_path)
+
+		with patch("snagrecover.firmware.bcm.BOOT_FW_PATCH_VERSION", 0):
+			self.assertNotEqual(self.patched(b"u-boot")[0], other_path)
+
+		self.assertEqual(modify_boot_fw.call_count, 5)
+
+	def test_prune(self, modify_boot_fw):
+		with patch("snagrecover.firmware.bcm.BOOT_FW_CACHE_ENTRIES", 2):
+			first, _ = self.patched(b"u-boot 1")
+			second, _ = self.patched(b"u-boot 2")
+			os.utime(first, (0, 0))
+			os.utime(second, (0, 1))
+			# a cache hit marks the entry as recently used
+			self.patched(b"u-boot 1")
+			third, _ = self.patched(b"u-boot 3")
+
+		self.assertEqual(
+			sorted(os.listdir(os.path.join(self.cache_dir, "bcm"))),
+			sorted([os.path.basename(first), os.path.basename(third)]),
+		)
+
+	def test_failed_patch(self, modify_boot_fw):
+		modify_boot_fw.side_effect = ValueError("no FAT partition")
+		with self.assertRaises(ValueError):
+			self.patched(b"u-boot")
+
+		self.assertEqual(os.listdir(os.path.join(self.cache_dir, "bcm")), [])
+
+	def test_no_cache(self, modify_boot_fw):
+		# the cache directory can't be created below a regular file
+		os.environ["SNAGBOOT_CACHE_DIR"] = self.boot_path
+		with tempfile.TemporaryDirectory() as tempdir:
+			path = get_patched_boot_fw(self.boot_path, b"u-boot", tempdir)
+			self.assertEqual(os.path.dirname(path), tempdir)
+			with open(path, "rb") as patched_file:
+				self.assertEqual(patched_file.read(), b"bootu-boot")
+
+
+class TestBootFiles(unittest.TestCase):
+	def test_extract(self):
+		for mode in ["w", "w:gz", "w:bz2", "w:xz"]:
+			with self.subTest(mode=mode):
+				bootfiles = BootFiles(make_tar(mode))
+
+				self.assertEqual(
+					bootfiles.extract_file("bootcode4.bin"), b"bootcode v2"
+				)
+				self.assertEqual(
+					bootfiles.extract_file("./2712/bootcode5.bin"), b"bootcode5" * 100
+				)
+				self.assertEqual(bootfiles.extract_file("2712/start4.elf"), b"start")
+				self.assertTrue(bootfiles.member_exist("2712/../start.elf"))
+				self.assertFalse(bootfiles.member_exist("2711/start4.elf"))
+				with self.assertRaises(KeyError):
+					bootfiles.extract_file("start4.elf")
+				with self.assertRaises(ValueError):
+					bootfiles.extract_file("2712")
+
+	def test_zero_copy(self):
+		tar_blob = make_tar("w")
+		bootfiles = BootFiles(tar_blob)
+		blob = bootfiles.extract_file("2712/bootcode5.bin")
+		self.assertIsInstance(blob, memoryview)
+		self.assertIs(blob.obj, tar_blob)
+
+	def test_get_fileblob(self):
+		tar_blob = make_tar("w:gz")
+		bootfiles = get_bootfiles(tar_blob)
+		# the archive is loaded again for each stage of the recovery
+		self.assertIs(get_bootfiles(bytes(bytearray(tar_blob))), bootfiles)
+
+		blob = get_fileblob_from_bootfiles(
+			bootfiles, "bootcode5.bin", ["2712/bootcode5.bin", "bootcode5.bin"]
+		)
+		self.assertEqual(blob, b"bootcode5" * 100)
+		with self.assertRaises(FileNotFoundError):
+			get_fileblob_from_bootfiles(
+				bootfiles, "bootcode.bin", ["2712/bootcode.bin", "bootcode.bin"]
+			)
+
+
+class TestSendBlob(unittest.TestCase):
+	def test_bytes_chunks(self):
+		dev = MagicMock()
+		dev.write.side_effect = lambda ep, chunk: len(chunk)
+		blob = bytes(range(256)) * 100
+		send_blob(dev, memoryview(blob))
+
+		chunks = [call.args[1] for call in dev.write.call_args_list]
+		# pyusb copies memoryviews one element at a time
+		self.assertTrue(all(type(chunk) is bytes for chunk in chunks))
+		self.assertEqual([len(chunk) for chunk in chunks], [16384, 9216])
+		self.assertEqual(b"".join(chunks), blob)
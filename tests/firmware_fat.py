@@ -0,0 +1,167 @@
+import os
+import struct
+import tempfile
+import unittest
+
+from snagrecover.firmware.fat import FAT
+
+SECTOR_SIZE = 512
+PART_OFFSET = 0x1000
+
+
+def lfn_dirent(name: str) -> bytes:
+	chars = name.encode("utf-16-le") + b"\x00\x00"
+	chars += b"\xff" * (26 - len(chars))
+	return struct.pack(
+		"<B10sBBB12sH4s", 0x41, chars[0:10], 0x0F, 0, 0, chars[10:22], 0, chars[22:26]
+	)
+
+
+def short_dirent(name: bytes, attr: int, cluster: int, size: int) -> bytes:
+	return struct.pack(
+		"<11sBcBHHHHHHHL", name, attr, b"\x00", 0, 0, 0, 0, 0, 0, 0, cluster, size
+	)
+
+
+def make_fat_image(path: str, clusters: int, fat_type: int, files: dict):
+	"""
+	Create a FAT12/16 filesystem at PART_OFFSET in path, files maps root
+	directory entries to (first cluster, data), data being stored in
+	contiguous clusters.
+	"""
+	root_ent_cnt = 64
+	entry_bits = 12 if fat_type == 12 else 16
+	fat_sz = -(-((clusters + 2) * entry_bits // 8 + 1) // SECTOR_SIZE)
+	root_sectors = root_ent_cnt * 32 // SECTOR_SIZE
+	tot_sec = 1 + 2 * fat_sz + root_sectors + clusters
+
+	image = bytearray(PART_OFFSET + tot_sec * SECTOR_SIZE)
+	bpb = struct.pack(
+		"<3s8sHBHBHHcHHHLL",
+		b"\xeb\x3c\x90",
+		b"mkfs.fat",
+		SECTOR_SIZE,
+		1,
+		1,
+		2,
+		root_ent_cnt,
+		tot_sec,
+		b"\xf8",
+		fat_sz,
+		32,
+		2,
+		0,
+		0,
+	)
+	image[PART_OFFSET : PART_OFFSET + len(bpb)] = bpb
+
+	fat = [0xFF8, 0xFFF] + [0] * clusters
+	root = short_dirent(b"BOOT       ", 0x08, 0, 0)
+	data_start = PART_OFFSET + (1 + 2 * fat_sz + root_sectors) * SECTOR_SIZE
+	for name, (cluster, data) in files.items():
+		count = -(-len(data) // SECTOR_SIZE)
+		for n in range(cluster, cluster + count):
+			fat[n] = n + 1
+		fat[cluster + count - 1] = 0xFFF
+		offset = data_start + (cluster - 2) * SECTOR_SIZE
+		image[offset : offset + len(data)] = data
+
+		if isinstance(name, str):
+			short_name = (name.split(".")[0].upper()[:6] + "~1").ljust(8) + "TXT"
+			root += lfn_dirent(name)
+			name = short_name.encode("ascii")
+		root += short_dirent(name, 0x20, cluster, len(data))
+
+	if fat_type == 12:
+		fat_bytes = bytearray()
+		for i in range(0, len(fat), 2):
+			pair = fat[i] | (fat[i + 1] << 12 if i + 1 < len(fat) else 0)
+			fat_bytes += pair.to_bytes(3, "little")
+	else:
+		fat_bytes = b"".join(
+			(entry | (0xF000 if entry >= 0xFF8 else 0)).to_bytes(2, "little")
+			for entry in fat
+		)
+
+	for copy in range(2):
+		offset = PART_OFFSET + (1 + copy * fat_sz) * SECTOR_SIZE
+		image[offset : offset + len(fat_bytes)] = fat_bytes
+	root_offset = PART_OFFSET + (1 + 2 * fat_sz) * SECTOR_SIZE
+	image[root_offset : root_offset + len(root)] = root
+
+	with open(path, "wb") as f:
+		f.write(image)
+
+	return (fat_sz, root_offset)
+
+
+class TestFAT(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.tmpdir.name, "boot.img")
+		self.config = b"[all]\nenable_uart=1\n"
+		self.kernel = os.urandom(3 * SECTOR_SIZE - 100)
+
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def make_image(self, clusters, fat_type):
+		return make_fat_image(
+			self.path,
+			clusters,
+			fat_type,
+			{"config.txt": (2, self.config), b"KERNEL8 IMG": (3, self.kernel)},
+		)
+
+	def check_fat_copies(self, fat_sz):
+		with open(self.path, "rb") as f:
+			f.seek(PART_OFFSET + SECTOR_SIZE)
+			fat1 = f.read(fat_sz * SECTOR_SIZE)
+			fat2 = f.read(fat_sz * SECTOR_SIZE)
+		self.assertEqual(fat1, fat2)
+
+	def test_patch(self):
+		for clusters, fat_type in [(200, 12), (4200, 16)]:
+			with self.subTest(fat_type=fat_type):
+				fat_sz, _ = self.make_image(clusters, fat_type)
+				uboot = os.urandom(10 * SECTOR_SIZE + 1)
+
+				with FAT(self.path, PART_OFFSET) as fs:
+					self.assertEqual(fs.fat_type, fat_type)
+					self.assertEqual(
+						sorted(fs.list_files()), ["KERNEL8.IMG", "config.txt"]
+					)
+					self.assertEqual(fs.get_file_size("kernel8.img"), len(self.kernel))
+					self.assertEqual(fs.read_file("KERNEL8.IMG"), self.kernel)
+
+					fs.delete_file("KERNEL8.IMG")
+					fs.create_file("u-boot.bin", uboot)
+					config = fs.read_file("CONFIG.TXT") + b"kernel=u-boot.bin\n"
+					fs.delete_file("CONFIG.TXT")
+					fs.create_file("CONFIG.TXT", config)
+
+				self.check_fat_copies(fat_sz)
+				with FAT(self.path, PART_OFFSET) as fs:
+					self.assertEqual(
+						sorted(fs.list_files()), ["CONFIG.TXT", "u-boot.bin"]
+					)
+					self.assertEqual(fs.read_file("u-boot.bin"), uboot)
+					self.assertEqual(fs.read_file("config.txt"), config)
+					# clusters freed by the kernel, then by config.txt, are reused
+					clusters = fs.get_clusters(fs.find_file_entry("u-boot.bin").dirent)
+					self.assertEqual(clusters[:4], [3, 4, 5, 6])
+					clusters = fs.get_clusters(fs.find_file_entry("config.txt").dirent)
+					self.assertEqual(clusters, [2])
+
+	def test_no_flush_on_error(self):
+		fat_sz, root_offset = self.make_image(200, 12)
+		with open(self.path, "rb") as f:
+			image = f.read()
+
+		with self.assertRaises(ValueError):
+			with FAT(self.path, PART_OFFSET) as fs:
+				fs.delete_file("KERNEL8.IMG")
+				fs.create_file("big.bin", bytes(201 * SECTOR_SIZE))
+
+		with open(self.path, "rb") as f:
+			self.assertEqual(f.read(), image)
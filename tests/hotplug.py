@@ -0,0 +1,66 @@
+import socket
+import struct
+import unittest
+
+from snagrecover.hotplug import (
+	USBEventMonitor,
+	parse_uevent,
+	usb_path_match,
+	usb_ids_match,
+	UDEV_HEADER,
+	UDEV_MONITOR_MAGIC,
+)
+
+PROPS = [
+	b"ACTION=add",
+	b"DEVPATH=/devices/pci0000:00/0000:00:14.0/usb1/1-2/1-2.4",
+	b"SUBSYSTEM=usb",
+	b"DEVTYPE=usb_device",
+	b"PRODUCT=483/df11/200",
+]
+
+
+def kernel_uevent(props=PROPS) -> bytes:
+	return b"add@/devices/pci0000:00/0000:00:14.0/usb1/1-2/1-2.4\x00" + b"\x00".join(
+		props
+	)
+
+
+def udev_uevent(props=PROPS) -> bytes:
+	payload = b"\x00".join(props) + b"\x00"
+	header = UDEV_HEADER.pack(
+		b"libudev\x00",
+		socket.htonl(UDEV_MONITOR_MAGIC),
+		UDEV_HEADER.size + 16,
+		UDEV_HEADER.size + 16,
+		len(payload),
+	)
+	# filter hashes and tag bloom
+	return header + struct.pack("=IIII", 0, 0, 0, 0) + payload
+
+
+class TestHotplug(unittest.TestCase):
+	def test_parse(self):
+		for msg in [kernel_uevent(), udev_uevent()]:
+			props = parse_uevent(msg)
+			self.assertEqual(props["ACTION"], "add")
+			self.assertTrue(usb_path_match((1, (2, 4)))(props))
+			self.assertFalse(usb_path_match((1, (2,)))(props))
+			self.assertTrue(usb_ids_match(0x483, 0xDF11)(props))
+			self.assertFalse(usb_ids_match(0x483, 0xDF12)(props))
+
+	def test_wait(self):
+		monitor = USBEventMonitor()
+		monitor.close()
+		(monitor.sock, peer) = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+		# interface events are ignored
+		peer.send(kernel_uevent(PROPS[:3] + [b"DEVTYPE=usb_interface"]))
+		peer.send(udev_uevent())
+		self.assertTrue(monitor.wait(1, usb_path_match((1, (2, 4)))))
+
+		peer.send(udev_uevent())
+		self.assertFalse(monitor.wait(0.1, usb_path_match((1, (3,)))))
+
+		monitor.close()
+		peer.close()
@@ -0,0 +1,102 @@
+import random
+import unittest
+from types import SimpleNamespace
+from struct import unpack
+
+from snagrecover.protocols.amlogic import (
+	write_large_memory,
+	write_AMLC_sub_blocks,
+	compute_AMLS_checksum,
+	AMLSChecksums,
+	REQ_WR_LARGE_MEM,
+	REQ_WRITE_AMLC,
+	EP_OUT,
+)
+
+
+class AmlogicDeviceMock:
+	def __init__(self, max_packet_size=512):
+		ep = SimpleNamespace(bEndpointAddress=EP_OUT, wMaxPacketSize=max_packet_size)
+		self.cfgs = [[[ep]]]
+		self.requests = []
+		self.writes = []
+		self.data = bytearray()
+
+	def __iter__(self):
+		return iter(self.cfgs)
+
+	def ctrl_transfer(self, bmRequestType, bRequest, wValue, wIndex, data_or_wLength):
+		self.requests.append((bRequest, wValue, wIndex, data_or_wLength))
+
+	def write(self, ep, data, timeout):
+		# pyusb copies other buffers one element at a time
+		assert isinstance(data, bytes)
+		self.writes.append(len(data))
+		self.data += bytes(data)
+		return len(data)
+
+	def read(self, ep, length, timeout):
+		return b"OKAY" + bytes(12)
+
+
+class TestAmlogic(unittest.TestCase):
+	def test_write_large_memory(self):
+		dev = AmlogicDeviceMock()
+		blob = bytes(range(256)) * 300
+		write_large_memory(dev, 0x200C000, blob, 16384, append_zeros=True)
+
+		self.assertEqual(dev.data[: len(blob)], blob)
+		self.assertEqual(len(dev.data) % 16384, 0)
+		# one bulk transfer per REQ_WR_LARGE_MEM request
+		self.assertEqual(len(dev.writes), len(dev.requests))
+		self.assertEqual(dev.writes, [65535, len(dev.data) - 65535])
+		(bRequest, block_length, block_count, control_data) = dev.requests[0]
+		self.assertEqual(
+			(bRequest, block_length, block_count), (REQ_WR_LARGE_MEM, 16384, 4)
+		)
+		self.assertEqual(unpack("<IIII", control_data)[:2], (0x200C000, 65535))
+
+	def test_write_large_memory_short_blocks(self):
+		# blocks smaller than a packet are each terminated by a short packet
+		dev = AmlogicDeviceMock()
+		blob = bytes(range(256)) * 2
+		write_large_memory(dev, 0xD9000000, blob, 64)
+
+		self.assertEqual(bytes(dev.data), blob)
+		self.assertEqual(dev.writes, [64] * 8)
+
+	def test_write_AMLC_sub_blocks(self):
+		dev = AmlogicDeviceMock()
+		blob = bytes(range(256)) * 200
+		write_AMLC_sub_blocks(dev, 0x200, blob)
+
+		self.assertEqual(bytes(dev.data), blob)
+		self.assertEqual(dev.writes, [len(blob)])
+		self.assertEqual(dev.requests[0][:3], (REQ_WRITE_AMLC, 1, len(blob) - 1))
+
+	def test_AMLS_checksum(self):
+		def reference(data):
+			checksum = 0
+			for i in range(0, len(data), 4):
+				checksum += int.from_bytes(data[i : i + 4], "little")
+			return checksum & 0xFFFFFFFF
+
+		blob = random.randbytes(0x3000 + 7)
+		for length in [0, 3, 4, 511, 512, 0x2000, len(blob)]:
+			self.assertEqual(
+				compute_AMLS_checksum(blob[:length]), reference(blob[:length])
+			)
+
+		checksums = AMLSChecksums(blob)
+		for offset, length in [
+			(0, 0x200),
+			(0x200, 0x1000),
+			(0x2000, len(blob) - 0x2000),
+			(0x210, 0x100),
+			(0x400, 0x1F3),
+		]:
+			data = memoryview(blob)[offset : offset + length]
+			self.assertEqual(
+				checksums.checksum(data, offset),
+				reference(blob[offset : offset + length]),
+			)
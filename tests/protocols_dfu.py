@@ -0,0 +1,205 @@
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from snagrecover.protocols.dfu import DFU, DFUSession
+from snagflash.dfu import dfu_verify
+
+TRANSFER_SIZE = 1024
+
+DFU_IDLE = DFU.state_codes["dfuIDLE"]
+DFU_DNBUSY = DFU.state_codes["dfuDNBUSY"]
+DFU_DNLOAD_IDLE = DFU.state_codes["dfuDNLOAD-IDLE"]
+DFU_UPLOAD_IDLE = DFU.state_codes["dfuUPLOAD-IDLE"]
+
+
+class DFUDeviceMock:
+	"""
+	Minimal DFU device state machine: each download goes through dfuDNBUSY
+	with the given poll timeout before reaching dfuDNLOAD-IDLE.
+	"""
+
+	def __init__(self, poll_timeout=0):
+		self.poll_timeout = poll_timeout
+		self.state = DFU_IDLE
+		self.data = bytearray()
+		self.upload_pos = 0
+		self.requests = []
+
+	def ctrl_transfer(self, bmRequestType, bRequest, wValue, wIndex, data_or_wLength):
+		self.requests.append(bRequest)
+		if bRequest == 3:  # DFU_GETSTATUS
+			if self.state == DFU_DNBUSY:
+				timeout = self.poll_timeout
+				self.state = DFU_DNLOAD_IDLE
+				state = DFU_DNBUSY
+			else:
+				timeout = 0
+				state = self.state
+			return bytes([0]) + timeout.to_bytes(3, "little") + bytes([state, 0])
+		elif bRequest == 1:  # DFU_DNLOAD
+			if not data_or_wLength:
+				self.state = DFU_IDLE
+				return 0
+			self.data += bytes(data_or_wLength)
+			self.state = DFU_DNBUSY
+			return len(data_or_wLength)
+		elif bRequest == 2:  # DFU_UPLOAD
+			block = self.data[self.upload_pos : self.upload_pos + data_or_wLength]
+			self.upload_pos += len(block)
+			if len(block) < data_or_wLength:
+				self.upload_pos = 0
+			self.state = DFU_UPLOAD_IDLE if len(block) == data_or_wLength else DFU_IDLE
+			return bytes(block)
+		elif bRequest == 6:  # DFU_ABORT
+			self.state = DFU_IDLE
+			self.upload_pos = 0
+
+
+class TestDFU(unittest.TestCase):
+	def _get_usb_device_mock(self, dfu_dev) -> MagicMock:
+		intf = MagicMock()
+		intf.extra_descriptors = [
+			9,
+			DFU.DESC_TYPE_DFU,
+			0x0B,
+			0xFF,
+			0x00,
+			TRANSFER_SIZE & 0xFF,
+			TRANSFER_SIZE >> 8,
+			0x10,
+			0x01,
+		]
+		cfg = MagicMock()
+		cfg.interfaces.return_value = [intf]
+
+		dev = MagicMock()
+		dev.bMaxPacketSize0 = 64
+		dev.get_active_configuration.return_value = cfg
+		dev.ctrl_transfer.side_effect = dfu_dev.ctrl_transfer
+		return dev
+
+	def setUp(self):
+		self.dfu_dev = DFUDeviceMock(poll_timeout=50)
+		self.dfu = DFU(self._get_usb_device_mock(self.dfu_dev), stm32=False)
+
+	@patch("snagrecover.protocols.dfu.time.sleep")
+	def test_first_status_does_not_sleep(self, sleep):
+		self.dfu.get_status()
+		sleep.assert_not_called()
+
+	@patch("snagrecover.protocols.dfu.time.sleep")
+	def test_sleep_remaining_poll_timeout(self, sleep):
+		self.dfu.status_timeout = 50
+		with patch("snagrecover.protocols.dfu.time.monotonic") as monotonic:
+			self.dfu.last_status_time = 10.0
+			monotonic.return_value = 10.02
+			self.dfu.wait_poll_timeout()
+
+		sleep.assert_called_once()
+		self.assertAlmostEqual(sleep.call_args.args[0], 0.03)
+
+	@patch("snagrecover.protocols.dfu.time.sleep")
+	def test_download_and_run(self, sleep):
+		blob = bytes(range(256)) * 20
+		self.dfu.download_and_run(blob, 0, 0, len(blob))
+
+		self.assertEqual(bytes(self.dfu_dev.data), blob)
+		stats = self.dfu.stats
+		self.assertEqual(stats.blocks, 5)
+		self.assertEqual(stats.bytes, len(blob))
+		# one status before the download, two per block, one after manifest
+		self.assertEqual(stats.status_requests, 1 + 2 * 5 + 1)
+		# only dfuDNBUSY reports a poll timeout
+		self.assertEqual(sleep.call_count, 5)
+		for call in sleep.call_args_list:
+			self.assertLessEqual(call.args[0], 0.05)
+
+	@patch("snagrecover.protocols.dfu.time.sleep")
+	def test_download_from_file(self, sleep):
+		blob = bytes(range(256)) * 21
+		with tempfile.TemporaryFile() as file:
+			file.write(blob)
+			self.dfu.download_and_run(file, 0, 100, len(blob) - 100)
+
+		self.assertEqual(bytes(self.dfu_dev.data), blob[100:])
+		self.assertEqual(self.dfu.stats.blocks, 6)
+
+	@patch("snagrecover.protocols.dfu.time.sleep")
+	def test_download_from_iterator(self, sleep):
+		blob = bytes(range(256)) * 21
+		pieces = (blob[i : i + 700] for i in range(0, len(blob), 700))
+		blocks = [
+			bytes(block) for block in self.dfu.dnload_blocks(pieces, 0, len(blob))
+		]
+
+		self.assertEqual([len(block) for block in blocks], [1024] * 5 + [256])
+		self.assertEqual(b"".join(blocks), blob)
+
+	def test_upload(self):
+		self.dfu_dev.data = bytearray(bytes(range(256)) * 10)
+
+		# stopped before the end of the data
+		data = b"".join(bytes(block) for block in self.dfu.upload(0, 1500))
+		self.assertEqual(data, self.dfu_dev.data[:1500])
+		self.assertEqual(self.dfu_dev.requests[-1], 6)
+		self.assertEqual(self.dfu_dev.state, DFU_IDLE)
+
+		# short frame at the end of the data
+		data = b"".join(bytes(block) for block in self.dfu.upload(0, 4096))
+		self.assertEqual(data, self.dfu_dev.data)
+		self.assertEqual(self.dfu_dev.state, DFU_IDLE)
+
+	@patch("snagrecover.protocols.dfu.time.sleep")
+	def test_verify(self, sleep):
+		blob = bytes(range(256)) * 10
+		with tempfile.NamedTemporaryFile() as file:
+			file.write(blob)
+			file.flush()
+
+			self.dfu_dev.data = bytearray(blob)
+			dfu_verify(self.dfu, 0, file.name)
+
+			self.dfu_dev.data[2000] ^= 1
+			with self.assertRaises(ValueError):
+				dfu_verify(self.dfu, 0, file.name)
+			# partial verifications only read back the start of the file
+			with patch("snagflash.dfu.PARTIAL_VERIFY_SIZE", 2000):
+				dfu_verify(self.dfu, 0, file.name, partial=True)
+
+			self.dfu_dev.data = self.dfu_dev.data[:1000]
+			with self.assertRaises(ValueError):
+				dfu_verify(self.dfu, 0, file.name)
+
+	@patch("snagrecover.protocols.dfu.time.sleep")
+	def test_session_queue(self, sleep):
+		session = DFUSession(self._get_usb_device_mock(self.dfu_dev), stm32=False)
+		blobs = [bytes(range(256)) * 8, bytes(range(255, -1, -1)) * 4]
+		for blob in blobs:
+			session.queue_download(blob, 0)
+		session.download_queued()
+
+		self.assertEqual(bytes(self.dfu_dev.data), b"".join(blobs))
+		self.assertEqual(session.queue, [])
+		# the device is known to be idle after the first download
+		self.assertEqual(self.dfu_dev.requests.count(3), 1 + (2 * 2 + 1) + (2 * 1 + 1))
+
+	@patch("snagrecover.protocols.dfu.usb.util.get_string")
+	def test_session_search_partid(self, get_string):
+		dev = self._get_usb_device_mock(self.dfu_dev)
+		intfs = []
+		for altsetting in range(3):
+			intf = MagicMock()
+			intf.iInterface = altsetting + 1
+			intf.bAlternateSetting = altsetting
+			intf.extra_descriptors = []
+			intfs.append(intf)
+		dev.get_active_configuration.return_value.interfaces.return_value = intfs
+		names = {1: "bootloader", 2: "tispl.bin", 3: "u-boot.img"}
+		get_string.side_effect = lambda dev, index: names[index]
+
+		session = DFUSession(dev, stm32=False)
+		self.assertEqual(session.search_partid("u-boot.img"), 2)
+		self.assertEqual(session.search_partid("tispl", match_prefix=True), 1)
+		self.assertIsNone(session.search_partid("tispl"))
+		self.assertEqual(get_string.call_count, 3)
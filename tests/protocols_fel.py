@@ -0,0 +1,96 @@
+import unittest
+from unittest.mock import MagicMock
+
+from snagrecover.protocols.fel import FEL
+
+MEMORY_SIZE = 0x400000
+
+
+class FELDeviceMock:
+	"""
+	FEL device with a flat memory.
+	"""
+
+	def __init__(self):
+		self.memory = bytearray(MEMORY_SIZE)
+		self.expect_awus = False
+		self.stage = "request"
+		self.messages = []
+
+	def write(self, ep, data, timeout=None):
+		data = bytes(data)
+		if data[:4] == b"AWUC" and len(data) == 32:
+			return len(data)
+
+		if self.stage == "request":
+			code = int.from_bytes(data[0:2], "little")
+			self.addr = int.from_bytes(data[4:8], "little")
+			self.length = int.from_bytes(data[8:12], "little")
+			self.messages.append(code)
+			if code == FEL.standard_request_codes["FEL_RUN"]:
+				self.stage = "status"
+			else:
+				self.stage = "data"
+			self.expect_awus = True
+		elif self.stage == "data":
+			# data phases can be split in several bulk transfers
+			self.memory[self.addr : self.addr + len(data)] = data
+			self.addr += len(data)
+			self.length -= len(data)
+			if self.length == 0:
+				self.stage = "status"
+				self.expect_awus = True
+		return len(data)
+
+	def read(self, ep, length, timeout=None):
+		if self.expect_awus:
+			self.expect_awus = False
+			return b"AWUS" + bytes(9)
+
+		self.expect_awus = True
+		if self.stage == "data":
+			self.stage = "status"
+			return bytes(self.memory[self.addr : self.addr + length])
+
+		self.stage = "request"
+		return b"\xff\xff" + bytes(6)
+
+
+class TestFEL(unittest.TestCase):
+	@staticmethod
+	def _get_usb_device_mock(fel_dev) -> MagicMock:
+		ep_in = MagicMock()
+		ep_in.bmAttributes = 0x02
+		ep_in.bEndpointAddress = 0x81
+		ep_out = MagicMock()
+		ep_out.bmAttributes = 0x02
+		ep_out.bEndpointAddress = 0x01
+		intf = MagicMock()
+		intf.endpoints.return_value = [ep_in, ep_out]
+		cfg = MagicMock()
+		cfg.interfaces.return_value = [intf]
+
+		dev = MagicMock()
+		dev.get_active_configuration.return_value = cfg
+		dev.write.side_effect = fel_dev.write
+		dev.read.side_effect = fel_dev.read
+		return dev
+
+	def setUp(self):
+		self.fel_dev = FELDeviceMock()
+		self.fel = FEL(self._get_usb_device_mock(self.fel_dev), 1000)
+
+	def test_write_blob(self):
+		blob = bytes(range(256)) * 0x1200
+		self.fel.max_msg_len = 0x400000
+		self.assertTrue(self.fel.write_blob(blob, 0x100000, 0x100, len(blob) - 0x100))
+
+		self.assertEqual(
+			self.fel_dev.memory[0x100000 : 0x100000 + len(blob) - 0x100], blob[0x100:]
+		)
+		# a single message, with its data phase split in bulk transfers
+		self.assertEqual(
+			self.fel_dev.messages, [FEL.standard_request_codes["FEL_DOWNLOAD"]]
+		)
+		# request and status headers, request, three bulk transfers of data
+		self.assertEqual(self.fel.dev.write.call_count, 3 + 1 + 3)
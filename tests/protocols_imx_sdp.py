@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from snagrecover.protocols.hid import HIDDevice
+from snagrecover.protocols.imx_sdp import SDPCommand, build_report2_frames
+
+
+def get_hidraw_device(path) -> HIDDevice:
+	dev = HIDDevice.__new__(HIDDevice)
+	dev.pretty_addr = "1-1"
+	dev.hidraw = open(path, "wb+", buffering=0)
+	dev.write = dev.hidraw_write
+	dev.read = MagicMock()
+	return dev
+
+
+class TestSDP(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.hidraw_path = os.path.join(self.tmpdir.name, "hidraw")
+		self.blob = os.urandom(3000)
+
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def test_report2_frames(self):
+		frames = build_report2_frames(self.blob, 1024, pad=True)
+		self.assertEqual(len(frames), 3 * 1025)
+		self.assertEqual(frames[1025 : 2 * 1025], b"\x02" + self.blob[1024:2048])
+		self.assertEqual(frames[2 * 1025 + 1 :], self.blob[2048:] + bytes(72))
+
+		frames = build_report2_frames(self.blob, 1020, pad=False)
+		self.assertEqual(len(frames), len(self.blob) + 3)
+		self.assertEqual(frames[2 * 1021 :], b"\x02" + self.blob[2040:])
+
+	def test_write_blob_hidraw(self):
+		dev = get_hidraw_device(self.hidraw_path)
+		dev.read.side_effect = [SDPCommand.hab_codes["HAB_OPEN"], b"\x88\x88\x88\x88"]
+		sdp_cmd = SDPCommand(dev)
+
+		with patch("snagrecover.protocols.hid.os.writev", wraps=os.writev) as writev:
+			self.assertTrue(sdp_cmd.write_blob(self.blob, 0x1000, 0, len(self.blob)))
+		writev.assert_called_once()
+		dev.close()
+
+		with open(self.hidraw_path, "rb") as file:
+			written = file.read()
+		# report 1 command, then report 2 frames
+		self.assertEqual(written[0], 1)
+		self.assertEqual(written[17:], build_report2_frames(self.blob, 1024, pad=True))
+
+	def test_write_reports_libusb(self):
+		dev = HIDDevice.__new__(HIDDevice)
+		dev.hidraw = None
+		dev.write = MagicMock()
+		frames = build_report2_frames(self.blob, 1024, pad=True)
+		dev.write_reports(frames, 1025)
+
+		reports = [call.args[0] for call in dev.write.call_args_list]
+		# pyusb is slow with memoryviews
+		self.assertTrue(all(type(report) is bytes for report in reports))
+		self.assertEqual(b"".join(reports), frames)
@@ -0,0 +1,143 @@
+import logging
+import os
+import struct
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from snagrecover.config import recovery_config
+from snagrecover.firmware.qcom_fw import qcom_load_images
+from snagrecover.protocols.qcom_sahara import QSahara
+
+EP_IN = 0x81
+EP_OUT = 0x01
+MAX_PACKET_SIZE = 512
+
+
+class SaharaDeviceMock:
+	"""
+	Sahara device which requests each image with the given READ_DATA
+	packets, then ends its transfer.
+	"""
+
+	def __init__(self, transfers):
+		self.writes = []
+		self.packets = []
+		for image_id, reads in transfers:
+			self.packets.append(
+				struct.pack("<II", QSahara.SAHARA_HELLO_REQ, 48) + bytes(40)
+			)
+			for command, offset, length in reads:
+				if command == QSahara.SAHARA_READ_DATA:
+					packet = struct.pack(
+						"<IIIII", command, 20, image_id, offset, length
+					)
+				else:
+					packet = struct.pack(
+						"<IIQqq", command, 32, image_id, offset, length
+					)
+				self.packets.append(packet)
+			self.packets.append(
+				struct.pack("<IIII", QSahara.SAHARA_END_IMAGE_TX, 16, image_id, 0)
+			)
+			self.packets.append(struct.pack("<III", QSahara.SAHARA_DONE_RESP, 12, 0))
+
+	def read(self, ep, length, timeout=None):
+		return self.packets.pop(0)
+
+	def write(self, ep, data, timeout=None):
+		self.writes.append(data)
+		return len(data)
+
+
+@patch.object(QSahara, "get_max_packet_size", return_value=MAX_PACKET_SIZE)
+@patch.object(QSahara, "find_endpoints")
+class TestQSahara(unittest.TestCase):
+	def transfer(self, image, reads) -> SaharaDeviceMock:
+		dev = SaharaDeviceMock([(0x25, reads)])
+		sahara = QSahara(dev)
+		sahara.ep_in, sahara.ep_out = EP_IN, EP_OUT
+		sahara.transfer_image(0x25, image)
+		return dev
+
+	def test_read_data(self, find_endpoints, get_max_packet_size):
+		image = bytes(range(256)) * 1024
+		reads = [
+			(QSahara.SAHARA_READ_DATA, 0, 80),
+			(QSahara.SAHARA_READ_DATA_64, 0x100, 0x20000),
+			(QSahara.SAHARA_READ_DATA, len(image) - 1024, 1024),
+		]
+		dev = self.transfer(image, reads)
+
+		# HELLO_RESP, data chunks and ZLPs, DONE
+		data = dev.writes[1:-1]
+		# pyusb copies memoryviews one element at a time
+		self.assertTrue(all(type(chunk) is bytes for chunk in data))
+		self.assertEqual(
+			[len(chunk) for chunk in data], [80, 0x10000, 0x10000, 0, 1024, 0]
+		)
+		self.assertEqual(bytes(data[0]), image[:80])
+		self.assertEqual(b"".join(data[1:3]), image[0x100:0x20100])
+		self.assertEqual(bytes(data[4]), image[-1024:])
+
+	def test_invalid_read(self, find_endpoints, get_max_packet_size):
+		image = bytes(1024)
+		with self.assertRaises(ValueError):
+			self.transfer(image, [(QSahara.SAHARA_READ_DATA_64, 1000, 100)])
+
+	@patch("snagrecover.protocols.qcom_sahara.logger")
+	def test_no_hexdump(self, logger, find_endpoints, get_max_packet_size):
+		logger.isEnabledFor.return_value = False
+		self.transfer(bytes(4096), [(QSahara.SAHARA_READ_DATA, 0, 4096)])
+		logger.isEnabledFor.assert_called_with(logging.DEBUG)
+		for call in logger.debug.call_args_list:
+			self.assertNotIn("bytes:", call.args[0])
+
+	def test_requested_order(self, find_endpoints, get_max_packet_size):
+		images = {0xD: bytes(range(256)) * 4, 0x5: bytes(range(255, -1, -1)) * 2}
+		read = QSahara.SAHARA_READ_DATA
+		dev = SaharaDeviceMock([(0x5, [(read, 0, 512)]), (0xD, [(read, 0, 1024)])])
+		sahara = QSahara(dev)
+		sahara.ep_in, sahara.ep_out = EP_IN, EP_OUT
+		sahara.transfer_images(images)
+
+		self.assertEqual(dev.packets, [])
+		# Sahara packets are shorter than the data chunks
+		data = [bytes(chunk) for chunk in dev.writes if len(chunk) >= 512]
+		self.assertEqual(data, [images[0x5], images[0xD]])
+
+	def test_unknown_image(self, find_endpoints, get_max_packet_size):
+		dev = SaharaDeviceMock([(0x7, [(QSahara.SAHARA_READ_DATA, 0, 16)])])
+		sahara = QSahara(dev)
+		sahara.ep_in, sahara.ep_out = EP_IN, EP_OUT
+		with self.assertRaises(ValueError):
+			sahara.transfer_images({0x5: bytes(16)})
+
+
+class TestQcomLoadImages(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.firmware = {}
+		for fw_name, image_id in [("xbl", 13), ("u-boot", 5)]:
+			path = os.path.join(self.tmpdir.name, f"{fw_name}.bin")
+			with open(path, "wb") as file:
+				file.write(bytes([image_id]) * 1000)
+			self.firmware[fw_name] = {"path": path, "image_id": image_id}
+
+		config = patch.dict(recovery_config, {"firmware": self.firmware})
+		config.start()
+		self.addCleanup(config.stop)
+
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def test_load_images(self):
+		images = qcom_load_images()
+		self.assertEqual(list(images), [13, 5])
+		self.assertIsInstance(images[13], memoryview)
+		self.assertEqual(images[5], bytes([5]) * 1000)
+
+	def test_duplicate_image_id(self):
+		self.firmware["u-boot"]["image_id"] = 13
+		with self.assertRaises(SystemExit):
+			qcom_load_images()
@@ -0,0 +1,165 @@
+import asyncio
+import os
+import random
+import socket
+import struct
+import tempfile
+import unittest
+
+from snagrecover.protocols import tftp
+
+
+class TFTPClient:
+	"""
+	Blocking TFTP client, which acknowledges the last block of each window
+	and can drop given DATA packets to simulate losses.
+	"""
+
+	def __init__(self, port: int, drop=()):
+		self.server = ("127.0.0.1", port)
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.settimeout(2)
+		self.drop = set(drop)
+		self.received = 0
+
+	def request(self, name: str, **options) -> bytes:
+		packet = struct.pack("!H", tftp.OPCODE_RRQ) + f"{name}\x00octet\x00".encode()
+		for option, value in options.items():
+			packet += f"{option}\x00{value}\x00".encode()
+		self.sock.sendto(packet, self.server)
+		return self.receive(int(options.get("blksize", 512)))
+
+	def receive(self, requested_blksize: int) -> bytes:
+		blksize = 512
+		windowsize = 1
+		data = bytearray()
+		expected = 1
+		in_window = 0
+		self.oack = {}
+		while True:
+			packet, addr = self.sock.recvfrom(65536)
+			opcode, block = struct.unpack_from("!HH", packet)
+			if opcode == tftp.OPCODE_ERROR:
+				raise tftp.TFTPError(block, packet[4:-1].decode())
+			if opcode == tftp.OPCODE_OACK:
+				fields = packet[2:].split(b"\x00")[:-1]
+				self.oack = {
+					fields[i].decode(): int(fields[i + 1])
+					for i in range(0, len(fields), 2)
+				}
+				blksize = self.oack.get("blksize", blksize)
+				windowsize = self.oack.get("windowsize", windowsize)
+				self.sock.sendto(struct.pack("!HH", tftp.OPCODE_ACK, 0), addr)
+				continue
+
+			self.received += 1
+			if self.received in self.drop:
+				continue
+
+			if block != expected & 0xFFFF:
+				# lost packet, acknowledge the last block received in order
+				self.sock.sendto(
+					struct.pack("!HH", tftp.OPCODE_ACK, (expected - 1) & 0xFFFF), addr
+				)
+				in_window = 0
+				continue
+
+			data += packet[4:]
+			in_window += 1
+			last = len(packet) - 4 < blksize
+			if in_window == windowsize or last:
+				self.sock.sendto(struct.pack("!HH", tftp.OPCODE_ACK, block), addr)
+				in_window = 0
+			if last:
+				return bytes(data)
+			expected += 1
+
+	def close(self):
+		self.sock.close()
+
+
+class TestTFTPServer(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.files = {}
+		for name, size in [("spl.bin", 5000), ("u-boot.img", 1468 * 40)]:
+			path = os.path.join(self.tmpdir.name, name)
+			with open(path, "wb") as file:
+				file.write(random.randbytes(size))
+			self.files[name] = path
+
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def read(self, name: str) -> bytes:
+		with open(self.files[name], "rb") as file:
+			return file.read()
+
+	def transfer(self, name: str, drop=(), max_windowsize=16, **options):
+		async def run():
+			completed = asyncio.Event()
+			server = tftp.TFTPServer(
+				self.files,
+				max_windowsize=max_windowsize,
+				timeout=0.05,
+				on_complete=lambda name, client: completed.set(),
+			)
+			await server.start("127.0.0.1", 0)
+			port = server.transport.get_extra_info("sockname")[1]
+			client = TFTPClient(port, drop)
+			try:
+				data = await asyncio.to_thread(client.request, name, **options)
+				await asyncio.wait_for(completed.wait(), 1)
+			finally:
+				client.close()
+				server.close()
+			return (data, client)
+
+		return asyncio.run(run())
+
+	def test_lockstep(self):
+		data, client = self.transfer("spl.bin")
+		self.assertEqual(data, self.read("spl.bin"))
+		self.assertEqual(client.oack, {})
+		self.assertEqual(client.received, 10)
+
+	def test_options(self):
+		data, client = self.transfer(
+			"u-boot.img", blksize=4096, windowsize=64, tsize=0, foo=1
+		)
+		self.assertEqual(data, self.read("u-boot.img"))
+		# capped to the server limits, the file size is a multiple of the
+		# block size so an empty block ends the transfer
+		self.assertEqual(
+			client.oack, {"blksize": 1468, "windowsize": 16, "tsize": 1468 * 40}
+		)
+		self.assertEqual(client.received, 41)
+
+	def test_lost_packets(self):
+		data, client = self.transfer(
+			"u-boot.img", drop=[3, 20, 21, 30], blksize=1468, windowsize=8
+		)
+		self.assertEqual(data, self.read("u-boot.img"))
+
+		# lock-step transfer, a lost block is resent after a timeout
+		data, client = self.transfer("spl.bin", drop=[4])
+		self.assertEqual(data, self.read("spl.bin"))
+		self.assertEqual(client.received, 11)
+
+	def test_block_number_rollover(self):
+		path = self.files["spl.bin"]
+		with open(path, "wb") as file:
+			file.write(random.randbytes(8 * 0x10000 + 100))
+
+		data, client = self.transfer(
+			"spl.bin", max_windowsize=64, blksize=8, windowsize=64
+		)
+		self.assertEqual(data, self.read("spl.bin"))
+
+	def test_errors(self):
+		with self.assertRaises(tftp.TFTPError) as err:
+			self.transfer("u-boot.bin")
+		self.assertEqual(err.exception.code, tftp.ERR_FILE_NOT_FOUND)
+
+		with self.assertRaises(tftp.TFTPError):
+			self.transfer("../spl.bin")
@@ -0,0 +1,159 @@
+import binascii
+import os
+import random
+import select
+import tempfile
+import threading
+import unittest
+
+import serial
+
+from snagrecover.protocols import ymodem
+
+
+class ModemReceiver(threading.Thread):
+	"""
+	XMODEM/YMODEM receiver on the master side of a pty, which NAKs the
+	first attempt of the given blocks and the first EOT.
+	"""
+
+	def __init__(self, fd: int, ymodem_mode: bool, nak_blocks=(), cancel=False):
+		super().__init__()
+		self.fd = fd
+		self.ymodem_mode = ymodem_mode
+		self.nak_blocks = set(nak_blocks)
+		self.cancel = cancel
+		self.blocks = []
+		self.header = None
+		self.batch_closed = False
+		self.error = None
+
+	def read(self, size: int) -> bytes:
+		data = b""
+		while len(data) < size:
+			r, _, _ = select.select([self.fd], [], [], 5)
+			if not r:
+				raise TimeoutError("Timeout reading from sender")
+			data += os.read(self.fd, size - len(data))
+		return data
+
+	def read_block(self) -> tuple:
+		start = self.read(1)
+		if start == ymodem.EOT:
+			return (None, None)
+		size = (
+			ymodem.SHORT_BLOCK_SIZE if start == ymodem.SOH else ymodem.LONG_BLOCK_SIZE
+		)
+		block = self.read(size + 4)
+		assert block[0] == 0xFF - block[1]
+		data = block[2:-2]
+		assert binascii.crc_hqx(data, 0) == int.from_bytes(block[-2:], "big")
+		return (block[0], data)
+
+	def run(self):
+		try:
+			self.receive()
+		except Exception as err:
+			self.error = err
+
+	def receive(self):
+		os.write(self.fd, ymodem.CRC)
+		if self.ymodem_mode:
+			_, self.header = self.read_block()
+			os.write(self.fd, ymodem.ACK + ymodem.CRC)
+
+		nak_eot = True
+		while True:
+			seq, data = self.read_block()
+			if seq is None:
+				if nak_eot:
+					nak_eot = False
+					os.write(self.fd, ymodem.NAK)
+					continue
+				os.write(self.fd, ymodem.ACK)
+				break
+
+			if self.cancel:
+				os.write(self.fd, ymodem.CAN * 2)
+				return
+			if seq in self.nak_blocks:
+				self.nak_blocks.discard(seq)
+				os.write(self.fd, ymodem.NAK)
+				continue
+
+			self.blocks.append((seq, data))
+			os.write(self.fd, ymodem.ACK)
+
+		if self.ymodem_mode:
+			os.write(self.fd, ymodem.CRC)
+			seq, data = self.read_block()
+			self.batch_closed = seq == 0 and data == bytes(ymodem.SHORT_BLOCK_SIZE)
+			os.write(self.fd, ymodem.ACK)
+
+
+class TestModemSender(unittest.TestCase):
+	def setUp(self):
+		master, slave = os.openpty()
+		self.master = master
+		self.port = serial.Serial(os.ttyname(slave), timeout=0.2, write_timeout=5)
+		os.close(slave)
+		self.file = tempfile.TemporaryFile()
+		self.blob = random.randbytes(5000)
+		self.file.write(self.blob)
+		self.file.seek(0)
+
+	def tearDown(self):
+		self.file.close()
+		self.port.close()
+		os.close(self.master)
+
+	def transfer(self, receiver, **kwargs) -> list:
+		progress = []
+		sender = ymodem.ModemSender(
+			self.port, timeout=2, callback=lambda sent, size: progress.append(sent)
+		)
+		receiver.start()
+		# the ping which starts the transfer
+		self.assertEqual(self.port.read(1), ymodem.CRC)
+		try:
+			sender.send(self.file, len(self.blob), **kwargs)
+		finally:
+			receiver.join()
+		self.assertIsNone(receiver.error)
+		return progress
+
+	def test_ymodem(self):
+		receiver = ModemReceiver(self.master, True, nak_blocks=[2])
+		progress = self.transfer(receiver, name="u-boot.img")
+
+		self.assertEqual(receiver.header.rstrip(b"\x00"), b"u-boot.img\x005000")
+		# the last 904 bytes don't fit in a 128-byte block
+		self.assertEqual([seq for seq, _ in receiver.blocks], [1, 2, 3, 4, 5])
+		self.assertEqual([len(data) for _, data in receiver.blocks], [1024] * 5)
+		data = b"".join(data for _, data in receiver.blocks)
+		self.assertEqual(data[: len(self.blob)], self.blob)
+		self.assertEqual(set(data[len(self.blob) :]), {ymodem.CPMEOF})
+		self.assertEqual(progress, [1024, 2048, 3072, 4096, 5000])
+		self.assertTrue(receiver.batch_closed)
+
+	def test_xmodem(self):
+		receiver = ModemReceiver(self.master, False)
+		self.transfer(receiver, block_size=ymodem.SHORT_BLOCK_SIZE)
+
+		self.assertEqual(len(receiver.blocks), 40)
+		self.assertEqual(receiver.blocks[-1][1][:8], self.blob[-8:])
+		data = b"".join(data for _, data in receiver.blocks)
+		self.assertEqual(data[: len(self.blob)], self.blob)
+
+	def test_short_last_block(self):
+		self.blob = self.blob[:1100]
+		self.file.truncate(1100)
+		receiver = ModemReceiver(self.master, True)
+		self.transfer(receiver, name="u-boot.img")
+
+		self.assertEqual([len(data) for _, data in receiver.blocks], [1024, 128])
+
+	def test_cancel(self):
+		receiver = ModemReceiver(self.master, False, cancel=True)
+		with self.assertRaisesRegex(Exception, "cancelled"):
+			self.transfer(receiver)
@@ -0,0 +1,128 @@
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+from snagrecover.usb import SnagbootUSBContext
+
+
+class BackendMock:
+	"""
+	libusb backend whose device handles are (bus, address) tuples.
+	"""
+
+	def __init__(self, handles):
+		self.handles = handles
+		self.descriptor_reads = 0
+
+	def enumerate_devices(self):
+		return iter(self.handles)
+
+	def get_device_descriptor(self, handle):
+		self.descriptor_reads += 1
+		return SimpleNamespace(bus=handle[0], address=handle[1])
+
+
+class DeviceMock(SimpleNamespace):
+	pass
+
+
+def make_device(handle, backend):
+	entry = next(
+		entry
+		for entry in SnagbootUSBContext.registry.values()
+		if (entry.bus, entry.address) == handle
+	)
+	return DeviceMock(**vars(entry))
+
+
+class TestUSBRegistry(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.sysfs = self.tmpdir.name
+		for name in ["usb1", "1-0:1.0", "1-2.4:1.0"]:
+			os.mkdir(os.path.join(self.sysfs, name))
+
+		self.add_device("1-2", 2, 0x05E3, 0x0610)
+		self.add_device("1-2.4", 5, 0x0483, 0xDF11)
+		self.add_device("3-1", 7, 0x0483, 0xDF11)
+
+		self.backend = BackendMock([(1, 2), (1, 5), (3, 7)])
+		patches = [
+			patch("snagrecover.usb.SYSFS_USB_DEVICES", self.sysfs),
+			patch.object(SnagbootUSBContext, "use_registry", True),
+			patch.object(SnagbootUSBContext, "registry", {}),
+			patch.object(SnagbootUSBContext, "devices", []),
+			patch.object(SnagbootUSBContext, "enumerated", False),
+			patch("snagrecover.usb.usb.backend.libusb1.get_backend", self.get_backend),
+			patch("snagrecover.usb.usb.core.Device", side_effect=make_device),
+			patch("snagrecover.usb.usb.core.find", MagicMock(return_value=[])),
+		]
+		for p in patches:
+			p.start()
+			self.addCleanup(p.stop)
+
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def get_backend(self):
+		return self.backend
+
+	def add_device(self, name, devnum, vid, pid):
+		path = os.path.join(self.sysfs, name)
+		os.makedirs(path, exist_ok=True)
+		for attr, value in [
+			("devnum", f"{devnum}"),
+			("idVendor", f"{vid:04x}"),
+			("idProduct", f"{pid:04x}"),
+		]:
+			with open(os.path.join(path, attr), "w") as f:
+				f.write(value + "\n")
+
+	def test_find_by_path(self):
+		SnagbootUSBContext.rescan()
+		devices = list(SnagbootUSBContext.find(bus=1, port_numbers=(2, 4)))
+
+		self.assertEqual([(dev.bus, dev.address) for dev in devices], [(1, 5)])
+		self.assertEqual(len(SnagbootUSBContext.devices), 1)
+		self.assertEqual(list(SnagbootUSBContext.find(bus=2, port_numbers=(2, 4))), [])
+
+	def test_find_by_ids(self):
+		SnagbootUSBContext.rescan()
+		devices = list(SnagbootUSBContext.find(idVendor=0x0483, idProduct=0xDF11))
+
+		self.assertEqual(
+			sorted((dev.bus, dev.port_numbers) for dev in devices),
+			[(1, (2, 4)), (3, (1,))],
+		)
+		# devices are only instantiated once per rescan
+		list(SnagbootUSBContext.find(bus=1, port_numbers=(2, 4)))
+		self.assertEqual(len(SnagbootUSBContext.devices), 2)
+
+	def test_incremental_refresh(self):
+		SnagbootUSBContext.rescan()
+		hub = SnagbootUSBContext.registry["1-2"]
+		board = SnagbootUSBContext.registry["1-2.4"]
+
+		# the board re-enumerates with other IDs, another one is removed
+		self.add_device("1-2.4", 6, 0x0483, 0x3753)
+		os.remove(os.path.join(self.sysfs, "3-1", "devnum"))
+		SnagbootUSBContext.rescan()
+
+		self.assertIs(SnagbootUSBContext.registry["1-2"], hub)
+		self.assertIsNot(SnagbootUSBContext.registry["1-2.4"], board)
+		self.assertNotIn("3-1", SnagbootUSBContext.registry)
+		self.assertEqual(
+			SnagbootUSBContext.lookup({"idVendor": 0x0483, "idProduct": 0x3753}),
+			[SnagbootUSBContext.registry["1-2.4"]],
+		)
+		self.assertEqual(
+			SnagbootUSBContext.lookup({"idVendor": 0x0483, "idProduct": 0xDF11}), []
+		)
+
+	def test_unindexed_query(self):
+		SnagbootUSBContext.rescan()
+		self.assertIsNone(SnagbootUSBContext.lookup({"idVendor": 0x0483}))
+		list(SnagbootUSBContext.find(idVendor=0x0483))
+		self.assertTrue(SnagbootUSBContext.enumerated)
@@ -0,0 +1,69 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+import usb
+
+from snagrecover import usb_stats
+from snagrecover.usb_stats import USBStats, percentile
+
+
+class TestUSBStats(unittest.TestCase):
+	def setUp(self):
+		self.stats = USBStats()
+		patcher = patch("snagrecover.usb_stats.stats", self.stats)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+		self.usb_dev = MagicMock(spec=usb.core.Device)
+		self.usb_dev.write.side_effect = lambda ep, data, timeout: len(data)
+		self.usb_dev.read.side_effect = lambda ep, size, timeout: b"OKAY"
+		self.usb_dev.ctrl_transfer.side_effect = lambda *args: len(args[4])
+		self.dev = usb_stats.instrument(self.usb_dev, "fastboot")
+
+	def test_disabled(self):
+		with patch("snagrecover.usb_stats.stats", None):
+			self.assertIs(usb_stats.instrument(self.usb_dev, "dfu"), self.usb_dev)
+			with usb_stats.label(self.usb_dev, "flash"):
+				pass
+
+	def test_transfers(self):
+		with usb_stats.label(self.dev, "download data"):
+			for _ in range(3):
+				self.dev.write(0x01, bytes(0x1000), timeout=100)
+		with usb_stats.label(self.dev, usb_stats.RESPONSE):
+			self.assertEqual(self.dev.read(0x81, 256, timeout=100), b"OKAY")
+		self.dev.ctrl_transfer(0x21, 1, wValue=0, wIndex=0, data_or_wLength=b"1234")
+
+		transfers = self.stats.transfers
+		data = transfers[("fastboot", "ep 0x01 OUT", "download data")]
+		self.assertEqual((data.transfers, data.bytes), (3, 0x3000))
+		response = transfers[("fastboot", "ep 0x81 IN", usb_stats.RESPONSE)]
+		self.assertEqual((response.transfers, response.bytes), (1, 4))
+		self.assertEqual(self.stats.response_wait(), response.busy)
+		ctrl = transfers[("fastboot", "ep0", "request 0x21/0x01")]
+		self.assertEqual(ctrl.bytes, 4)
+
+		summary = self.stats.summary()
+		self.assertTrue(summary[-1].startswith("time spent waiting for device"))
+		self.assertTrue(any(line.startswith("total: 5 transfers") for line in summary))
+
+	def test_stall(self):
+		self.usb_dev.read.side_effect = usb.core.USBError("Pipe error")
+		with self.assertRaises(usb.core.USBError):
+			self.dev.read(0x81, 256, timeout=100)
+
+		stats = self.stats.transfers[("fastboot", "ep 0x81 IN", "bulk")]
+		self.assertEqual(stats.bytes, 0)
+		self.assertEqual(stats.stalled, stats.busy)
+
+	def test_percentile(self):
+		values = list(range(1, 101))
+		self.assertEqual(percentile(values, 50), 50)
+		self.assertEqual(percentile(values, 99), 99)
+		self.assertEqual(percentile([3], 99), 3)
+
+	def test_histogram(self):
+		for latency in [0.00005, 0.0005, 0.005, 0.005, 2]:
+			self.stats.record(("fel", "ep0", "bulk"), 0, latency)
+		stats = self.stats.transfers[("fel", "ep0", "bulk")]
+		self.assertEqual(stats.histogram(), [1, 1, 2, 0, 0, 1])